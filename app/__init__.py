@@ -1,9 +1,11 @@
+import os
+import nutritionix
 from config import config 
 from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
+from app.routing import RoutingSQLAlchemy
 
-db = SQLAlchemy()
+db = RoutingSQLAlchemy()
 login_manager = LoginManager()
 login_manager.session_protection = 'strong'
 login_manager.login_view = 'auth.login'
@@ -18,17 +20,24 @@ def create_app(config_name):
   db.init_app(app)
   login_manager.init_app(app)
 
+  # disk tier of the Nutritionix response cache
+  if app.config.get('NUTRITIONIX_CACHE_PATH'):
+    os.makedirs(app.instance_path, exist_ok=True)
+    nutritionix.cache.set_path(os.path.join(app.instance_path, app.config['NUTRITIONIX_CACHE_PATH']))
+
   # Register blueprints
   from app.core import core as core_blueprint
   from app.foods import foods as foods_blueprint
   from app.errors import errors as errors_blueprint
   from app.auth import auth as auth_blueprint
   from app.carts import carts as carts_blueprint
+  from app.api import api as api_blueprint
   
   app.register_blueprint(core_blueprint)
   app.register_blueprint(foods_blueprint,url_prefix='/foods')
   app.register_blueprint(errors_blueprint)
   app.register_blueprint(auth_blueprint,url_prefix='/auth')
   app.register_blueprint(carts_blueprint,url_prefix='/carts')
+  app.register_blueprint(api_blueprint,url_prefix='/api/v1')
 
   return app
\ No newline at end of file
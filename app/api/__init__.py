@@ -0,0 +1,9 @@
+from flask import Blueprint
+from app import login_manager
+
+api = Blueprint('api',__name__)
+
+# answer unauthenticated API requests with 401 instead of redirecting to the login page
+login_manager.blueprint_login_views['api'] = None
+
+from app.api import views, errors
@@ -0,0 +1,37 @@
+import simplejson
+from datetime import date
+from flask import current_app, stream_with_context
+
+def encode_default(obj):
+  if isinstance(obj, date):
+    return obj.isoformat()
+  raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+# simplejson writes Decimals (nutrient amounts) as JSON numbers in its C encoder, without converting each value first
+encoder = simplejson.JSONEncoder(use_decimal=True, default=encode_default, separators=(',', ':'))
+
+def json_response(data, status=200):
+  return current_app.response_class(encoder.encode(data), status=status, mimetype='application/json')
+
+def stream_json(fields, key, items, chunk_size=100):
+  """Returns a streamed response of the JSON object fields with the array key holding items.
+
+  items is iterated while the response is sent (e.g. the rows of a query run with yield_per), and encoded and written
+  chunk_size items at a time, so large lists never have to be held in memory as a whole.
+
+  """
+  def generate():
+    head = encoder.encode(fields)[:-1]
+    yield head + (',' if fields else '') + encoder.encode(key) + ':['
+    chunk = []
+    separator = ''
+    for item in items:
+      chunk.append(encoder.encode(item))
+      if len(chunk) == chunk_size:
+        yield separator + ','.join(chunk)
+        separator = ','
+        chunk = []
+    if chunk:
+      yield separator + ','.join(chunk)
+    yield ']}'
+  return current_app.response_class(stream_with_context(generate()), mimetype='application/json')
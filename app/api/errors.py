@@ -0,0 +1,23 @@
+from app.api import api
+from app.api.encoding import json_response
+
+def error_response(status, error, message=None):
+  data = {'error': error}
+  if message is not None:
+    data['message'] = message
+  return json_response(data, status)
+
+def bad_request(message):
+  return error_response(400, 'bad request', message)
+
+@api.errorhandler(400)
+def bad_request_error(error):
+  return error_response(400, 'bad request')
+
+@api.errorhandler(401)
+def unauthorized_error(error):
+  return error_response(401, 'unauthorized', 'Please log in to access this resource.')
+
+@api.errorhandler(404)
+def not_found_error(error):
+  return error_response(404, 'not found')
@@ -0,0 +1,108 @@
+from decimal import Decimal, InvalidOperation
+from flask import request, url_for, abort, current_app
+from flask_login import current_user, login_required
+from app import db
+from app.api import api
+from app.api.encoding import json_response, stream_json
+from app.api.errors import bad_request
+from app.foods.views import search_foods, get_food_profile, get_nutrient_multiplier, is_in_tuple_list
+from app.models import Cart, FoodItem, User
+from app.pagination import KeysetPagination
+from app.routing import read_only
+from nutritionix import nutrient_categories
+
+# columns read for carts and foods; responses are built from these projections, never from ORM objects
+def cart_columns():
+  return [Cart.id, Cart.timestamp, Cart.version, User.username.label('username')] + [getattr(Cart, category) for category in nutrient_categories]
+
+def food_columns():
+  return [FoodItem.id, FoodItem.name, FoodItem.img_url, FoodItem.serving_qty, FoodItem.serving_unit] + [getattr(FoodItem, category) for category in nutrient_categories]
+
+# page of a cart projection query, continued with the 'cursor' argument
+def paginate_carts(query, sort_column, endpoint, **kwargs):
+  per_page = min(request.args.get('per_page', current_app.config['API_PER_PAGE'], type=int), current_app.config['API_MAX_PER_PAGE'])
+  if per_page < 1:
+    abort(400)
+  pagination = KeysetPagination(query, sort_column, Cart.id, cursor=request.args.get('cursor'), per_page=per_page)
+  next_url = url_for(endpoint, cursor=pagination.next_cursor, per_page=per_page, _external=True, **kwargs) if pagination.next_cursor else None
+  prev_url = url_for(endpoint, cursor=pagination.prev_cursor, per_page=per_page, _external=True, **kwargs) if pagination.prev_cursor else None
+  return json_response({'carts': pagination.items, 'next': next_url, 'prev': prev_url})
+
+# Carts of a user, newest first or by a nutrient (?nutrient=nf_calories)
+@api.route('/users/<username>/carts')
+@read_only
+def user_carts(username):
+  user = User.query.filter_by(username=username).first()
+  if user is None:
+    abort(404)
+
+  nutrient = request.args.get('nutrient')
+  if nutrient is None:
+    sort_column = Cart.timestamp
+  elif nutrient in nutrient_categories:
+    sort_column = getattr(Cart, nutrient)
+  else:
+    return bad_request('Unknown nutrient %s.' % nutrient)
+
+  query = db.session.query(*cart_columns()).join(User, User.id == Cart.user_id).filter(Cart.user_id == user.id)
+  return paginate_carts(query, sort_column, 'api.user_carts', username=username, nutrient=nutrient)
+
+# Carts of users followed by the current user, newest first
+@api.route('/followed_carts')
+@read_only
+@login_required
+def followed_carts():
+  query = current_user.followed_carts.join(User, User.id == Cart.user_id).with_entities(*cart_columns())
+  return paginate_carts(query, User.followed_carts_timestamp(), 'api.followed_carts')
+
+# Cart with its foods; the foods are streamed as they are read
+@api.route('/carts/<int:id>')
+@read_only
+def cart(id):
+  cart = db.session.query(*cart_columns()).join(User, User.id == Cart.user_id).filter(Cart.id == id).first()
+  if cart is None:
+    abort(404)
+  foods = db.session.query(*food_columns()).filter(FoodItem.cart_id == id).order_by(FoodItem.id).yield_per(100)
+  return stream_json({'cart': cart._asdict()}, 'foods', (food._asdict() for food in foods))
+
+# Food search, e.g. /api/v1/foods/search?q=brownie&filter=branded
+@api.route('/foods/search')
+def search():
+  query = request.args.get('q', '').strip()
+  filter = request.args.get('filter', 'common')
+  if not query:
+    return bad_request('Missing search query q.')
+  if filter not in ('common', 'branded'):
+    return bad_request('filter must be common or branded.')
+  return json_response({'query': query, 'filter': filter, 'foods': search_foods(query, filter)})
+
+# Nutrients of a common food name or branded nix_item_id, for its own serving or for serving_qty units of one of its
+# measures (?serving_unit=<weight of one unit, as listed in measures>&serving_qty=2)
+@api.route('/foods/<kind>/<value>')
+def food(kind, value):
+  if kind not in ('common', 'branded'):
+    abort(404)
+  profile = get_food_profile(kind, value)
+  if profile is None:
+    abort(404)
+
+  serving = None
+  nutrient_multiplier = Decimal(1)
+  if 'serving_unit' in request.args:
+    try:
+      serving_unit = round(Decimal(request.args['serving_unit']), 2)
+      serving_qty = round(Decimal(request.args.get('serving_qty', 1)), 2)
+    except InvalidOperation:
+      return bad_request('serving_unit and serving_qty must be numbers.')
+    if not is_in_tuple_list(str(serving_unit), profile.measure_units):
+      return bad_request('Unknown serving_unit %s.' % serving_unit)
+    serving = {'serving_weight': serving_unit, 'measure': profile.measure_units[str(serving_unit)], 'qty': serving_qty}
+    nutrient_multiplier = get_nutrient_multiplier(profile.serving_weight_grams, serving_unit, serving_qty)
+
+  food_info = profile.food_info(nutrient_multiplier)
+  fields = ['food_name', 'brand_name', 'nix_item_id', 'serving_qty', 'serving_unit', 'serving_weight_grams'] + nutrient_categories
+  food = {field: food_info.get(field) for field in fields}
+  food['photo'] = (food_info.get('photo') or {}).get('thumb')
+  food['measures'] = [{'serving_weight': Decimal(weight), 'measure': measure} for weight, measure in profile.measures]
+  food['serving'] = serving
+  return json_response({'food': food})
@@ -0,0 +1,77 @@
+import threading
+
+class PrefixIndex():
+  """In-memory trie answering prefix queries with the highest scored names.
+
+  Every node keeps only its top k (score, name) pairs, so a lookup is a walk down len(prefix) nodes with no scan of
+  the subtree. Names are indexed from the start of each of their words ('chicken breast' matches 'chi' and 'bre'),
+  at most max_depth characters deep; longer prefixes are answered by filtering the deepest node's names.
+  Scores only grow (add() increments them), which keeps the per node top k exact under incremental updates.
+
+  Parameters:
+    k (int): number of names kept per node (upper bound of a lookup's limit).
+    max_depth (int): number of characters of each word suffix that are indexed.
+
+  """
+
+  def __init__(self, k=10, max_depth=24):
+    self.k = k
+    self.max_depth = max_depth
+    self.scores = {}
+    self._root = {}
+    self._lock = threading.Lock()
+
+  @staticmethod
+  def normalize(text):
+    return ' '.join(str(text).lower().split())
+
+  def add(self, name, score=1):
+    """Adds score to name (inserting it when new) and updates the top k of every node on its paths."""
+    name = self.normalize(name)
+    if not name or score <= 0:
+      return
+    with self._lock:
+      total = self.scores.get(name, 0) + score
+      self.scores[name] = total
+      for suffix in self._suffixes(name):
+        node = self._root
+        for char in suffix[:self.max_depth]:
+          node = node.setdefault(char, {'': []})
+          top = [entry for entry in node[''] if entry[1] != name]
+          top.append((total, name))
+          top.sort(key=lambda entry: (-entry[0], entry[1]))
+          node[''] = top[:self.k]
+
+  def suggest(self, prefix, limit=None):
+    """Returns up to limit (at most k) names with a word starting with prefix, highest score first."""
+    prefix = self.normalize(prefix)
+    limit = self.k if limit is None else min(limit, self.k)
+    if not prefix or limit <= 0:
+      return []
+    with self._lock:
+      node = self._root
+      for char in prefix[:self.max_depth]:
+        node = node.get(char)
+        if node is None:
+          return []
+      names = [name for score, name in node['']]
+    if len(prefix) > self.max_depth:
+      names = [name for name in names if any(suffix.startswith(prefix) for suffix in self._suffixes(name))]
+    return names[:limit]
+
+  def clear(self):
+    with self._lock:
+      self.scores = {}
+      self._root = {}
+
+  def __len__(self):
+    return len(self.scores)
+
+  # the name from the start of each of its words
+  @staticmethod
+  def _suffixes(name):
+    suffixes = [name]
+    for i, char in enumerate(name):
+      if char == ' ':
+        suffixes.append(name[i + 1:])
+    return suffixes
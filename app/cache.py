@@ -0,0 +1,53 @@
+import time, threading
+from collections import OrderedDict
+
+class LRUCache():
+  """Thread-safe in-process LRU cache with per-entry expiry.
+
+  Parameters:
+    maxsize (int): maximum number of entries, least recently used entries are evicted first.
+    ttl (float): default seconds an entry stays valid (None never expires).
+
+  """
+
+  def __init__(self, maxsize=1024, ttl=None):
+    self.maxsize = maxsize
+    self.ttl = ttl
+    self.hits = 0
+    self.misses = 0
+    self._data = OrderedDict()
+    self._lock = threading.Lock()
+
+  def get(self, key, default=None):
+    with self._lock:
+      entry = self._data.get(key)
+      if entry is not None:
+        expires_at, value = entry
+        if expires_at is None or expires_at > time.time():
+          self._data.move_to_end(key)
+          self.hits += 1
+          return value
+        del self._data[key]
+      self.misses += 1
+      return default
+
+  def set(self, key, value, ttl=None):
+    ttl = self.ttl if ttl is None else ttl
+    expires_at = None if ttl is None else time.time() + ttl
+    with self._lock:
+      self._data[key] = (expires_at, value)
+      self._data.move_to_end(key)
+      while len(self._data) > self.maxsize:
+        self._data.popitem(last=False)
+
+  def delete(self, key):
+    with self._lock:
+      self._data.pop(key, None)
+
+  def clear(self):
+    with self._lock:
+      self._data.clear()
+      self.hits = self.misses = 0
+
+  def __len__(self):
+    return len(self._data)
@@ -0,0 +1,30 @@
+from flask import render_template
+from markupsafe import Markup
+from app import db
+from app.cache import LRUCache
+from app.models import Cart
+from nutritionix import nutrient_categories_units
+
+# rendered cart cards, keyed on cart id and stored with the cart version they were rendered from
+card_cache = LRUCache(maxsize=4096)
+
+def render_cart_card(cart):
+  """Returns the body of a cart card (owner, nutrient totals and link), rendering it at most once per cart version.
+
+  The parts of a card that depend on the page (its position and the delete button) are rendered by carts/_carts.html
+  around the cached fragment, so the same fragment is shared by every list and feed showing the cart.
+
+  """
+  entry = card_cache.get(cart.id)
+  if entry is not None and entry[0] == cart.version:
+    return entry[1]
+  html = Markup(render_template('carts/_cart_card.html', cart=cart, nutrient_categories_units=nutrient_categories_units))
+  card_cache.set(cart.id, (cart.version, html))
+  return html
+
+# drop cached cards when a cart changes (update_nutrients, add_food, ...) or is deleted; cards of carts updated in
+# bulk (repair_all_nutrients) are replaced on next render since their version no longer matches
+@db.event.listens_for(Cart, 'after_update')
+@db.event.listens_for(Cart, 'after_delete')
+def invalidate_cart_card(mapper, connection, target):
+  card_cache.delete(target.id)
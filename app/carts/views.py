@@ -1,12 +1,21 @@
 from app import db
 from app.carts import carts
-from app.models import Cart, User, FoodItem
+from app.carts.fragments import render_cart_card
+from app.models import Cart, User
 from flask_login import current_user,login_required
-from flask import render_template, redirect, url_for, request, abort,flash
+from flask import render_template, redirect, url_for, request, abort,flash, current_app, make_response
+from app.http_cache import not_modified, cache_headers, viewer_id
+from app.pagination import KeysetPagination
+from app.routing import read_only
 from nutritionix import nutrient_categories_units
 
+# use cursor pagination when configured or when a cursor is given
+def use_keyset_pagination():
+  return current_app.config['CARTS_PAGINATION'] == 'keyset' or 'cursor' in request.args
+
 @carts.route('/list/<username>')
 @carts.route('/list/<username>/sort_by/<nutrient>')
+@read_only
 def list(username,nutrient=None):
   page = request.args.get('page',1,type=int)
 
@@ -16,8 +25,10 @@ def list(username,nutrient=None):
     abort(404)
 
   # Order Carts (If sorting argument provided)
+  # (load cart owners eagerly so rendering cart.user does not issue a query per cart)
+  carts_query = user.carts.options(db.joinedload(Cart.user))
   if nutrient is None:
-    query = user.carts.order_by(Cart.timestamp.desc())
+    sort_column = Cart.timestamp
   else:
     sort_options = {
       'nf_calories' : Cart.nf_calories,
@@ -30,32 +41,74 @@ def list(username,nutrient=None):
       'nf_sugars' : Cart.nf_sugars,
       'nf_protein' : Cart.nf_protein
     } 
-    query = user.carts.order_by(sort_options[nutrient].desc())
-  pagination = query.paginate(page,per_page=4)
+    if nutrient not in sort_options:
+      abort(404)
+    sort_column = sort_options[nutrient]
+
+  # anonymous viewers all get the same page, which only changes with the user's carts and follow counts
+  # (Last-Modified is the latest cart change; If-None-Match, which also covers deletions and follows, takes precedence)
+  etag = last_modified = None
+  if not current_user.is_authenticated:
+    fingerprint = user.carts_fingerprint()
+    etag = 'list-%d-%s' % (user.id, '-'.join(str(value) for value in fingerprint))
+    last_modified = fingerprint[2]
+    response = not_modified(etag, last_modified)
+    if response is not None:
+      return response
+
+  if use_keyset_pagination():
+    pagination = KeysetPagination(carts_query,sort_column,Cart.id,cursor=request.args.get('cursor'),per_page=4)
+    prev_cart_num = pagination.offset
+  else:
+    pagination = carts_query.order_by(sort_column.desc()).paginate(page,per_page=4)
+    prev_cart_num = (page-1)*4
+
+  # follow state between viewer and user for the follow button and 'Follows you' label
+  following = follows_you = False
+  if current_user.is_authenticated and current_user != user:
+    following = current_user.following_status([user.id])[user.id]
+    follows_you = user.following_status([current_user.id])[current_user.id]
 
   carts = pagination.items
-  prev_cart_num = (page-1)*4
   cart_counter = [prev_cart_num+1,prev_cart_num+2,prev_cart_num+3,prev_cart_num+4]
-  return render_template('carts/list.html',carts=carts,pagination=pagination,cart_counter=cart_counter,nutrient_categories_units=nutrient_categories_units,
-  nutrient=nutrient,user=user)
+  response = make_response(render_template('carts/list.html',carts=carts,pagination=pagination,cart_counter=cart_counter,nutrient_categories_units=nutrient_categories_units,
+  nutrient=nutrient,user=user,cart_card=render_cart_card,following=following,follows_you=follows_you))
+  if etag is not None:
+    cache_headers(response, etag, last_modified, public=True)
+  return response
 
 @carts.route('/followed_carts')
+@read_only
 @login_required
 def followed_carts():
   page = request.args.get('page',1,type=int)
-  query = current_user.followed_carts
-  pagination = query.order_by(Cart.timestamp.desc()).paginate(page, per_page=4)
+  query = current_user.followed_carts.options(db.joinedload(Cart.user))
+  timestamp = User.followed_carts_timestamp()
+  if use_keyset_pagination():
+    pagination = KeysetPagination(query,timestamp,Cart.id,cursor=request.args.get('cursor'),per_page=4)
+    prev_cart_num = pagination.offset
+  else:
+    pagination = query.order_by(timestamp.desc()).paginate(page, per_page=4)
+    prev_cart_num = (page-1)*4
   carts = pagination.items
-  prev_cart_num = (page-1)*4
   cart_counter = [prev_cart_num+1,prev_cart_num+2,prev_cart_num+3,prev_cart_num+4]
-  return render_template('carts/followed_carts.html',carts=carts,pagination=pagination,cart_counter=cart_counter,nutrient_categories_units=nutrient_categories_units)
+  return render_template('carts/followed_carts.html',carts=carts,pagination=pagination,cart_counter=cart_counter,nutrient_categories_units=nutrient_categories_units,
+  cart_card=render_cart_card)
 
 @carts.route('/cart/<int:id>')
+@read_only
 def cart(id):
-  cart = Cart.query.get_or_404(id)
+  cart = Cart.query.options(db.joinedload(Cart.user)).get_or_404(id)
+  etag = 'cart-%d-%d-%d' % (cart.id, cart.version, viewer_id())
+  last_modified = cart.updated_at or cart.timestamp
+  response = not_modified(etag, last_modified)
+  if response is not None:
+    return response
+
   user = cart.user
   foods = cart.foods.all()
-  return render_template('carts/cart.html', cart=cart,foods=foods,user=user,nutrient_categories_units=nutrient_categories_units)
+  response = make_response(render_template('carts/cart.html', cart=cart,foods=foods,user=user,nutrient_categories_units=nutrient_categories_units))
+  return cache_headers(response, etag, last_modified, public=True)
 
 @carts.route('/add_cart')
 @login_required
@@ -83,32 +136,9 @@ def delete(id):
 @login_required
 def clone(id):
   cart = Cart.query.get_or_404(id)
-  foods = cart.foods.all()
 
   # clone cart
-  cart_copy = Cart()
-  cart_copy.user = current_user
-
-  for food in foods:
-    food_copy = FoodItem(name=food.name,
-                        img_url=food.img_url,
-                        nf_calories=food.nf_calories,
-                        nf_total_fat=food.nf_total_fat,
-                        nf_saturated_fat=food.nf_saturated_fat,
-                        nf_cholesterol=food.nf_cholesterol,
-                        nf_sodium=food.nf_sodium,
-                        nf_total_carbohydrate=food.nf_total_carbohydrate,
-                        nf_dietary_fiber=food.nf_dietary_fiber,
-                        nf_sugars=food.nf_sugars,
-                        nf_protein=food.nf_protein,
-                        serving_unit=food.serving_unit,
-                        serving_qty=food.serving_qty
-                        )
-    food_copy.cart = cart_copy
-    db.session.add(food_copy)
-
-  cart_copy.update_nutrients()
-  db.session.add(cart_copy)
+  cart_copy = cart.clone_to(current_user)
   db.session.commit()
 
   flash('Cart Has Been Cloned And Added To Your Carts')
@@ -1,9 +1,9 @@
 from flask import render_template, redirect, url_for,flash
 from flask_login import login_required,current_user
-from app import db
 from app.core import core 
 from app.core.forms import SearchForm
 from app.models import User
+from app.routing import read_only
 
 @core.route('/', methods=['GET','POST'])
 def index():
@@ -15,6 +15,7 @@ def index():
 
 @core.route('/users/<username>', methods=['GET','POST'])
 @core.route('/users', methods=['GET','POST'])
+@read_only
 def users(username=None):
   form = SearchForm()
   if form.validate_on_submit():
@@ -31,11 +32,9 @@ def follow(username):
   if user is None:
     flash('Invalid User')
     return redirect(url_for('core.index'))
-  if current_user.is_following(user):
+  if not current_user.follow(user):
     flash('You are already following this user.')
     return redirect(url_for('carts.list',username=username))
-  current_user.follow(user)
-  db.session.commit()
   flash(f"You are now following {username}")
   return redirect(url_for('carts.list',username=username))
 
@@ -46,10 +45,8 @@ def unfollow(username):
   if user is None:
     flash('Invalid User')
     return redirect(url_for('core.index'))
-  if not current_user.is_following(user):
+  if not current_user.unfollow(user):
     flash('You are currently not following this user.')
     return redirect(url_for('carts.list',username=username))
-  current_user.unfollow(user)
-  db.session.commit()
   flash(f"You are no longer following {username}")
   return redirect(url_for('carts.list',username=username))
\ No newline at end of file
@@ -1,5 +1,9 @@
-from flask import render_template
+from flask import render_template, redirect, request, session, url_for, flash
+from flask_login import logout_user
+from sqlalchemy.orm.exc import ObjectDeletedError
+from app import db
 from app.errors import errors
+from app.models import User, identity_cache
 
 @errors.app_errorhandler(404)
 def not_found_error(error):
@@ -8,3 +12,16 @@ def not_found_error(error):
 @errors.app_errorhandler(403)
 def forbidden_error(error):
   return render_template('errors/403.html'), 403
+
+# the logged in user was deleted by another worker while its identity cache snapshot was still served (see load_user):
+# log the session out instead of failing; other rows deleted under a request are still errors
+@errors.app_errorhandler(ObjectDeletedError)
+def deleted_user_error(error):
+  db.session.rollback()
+  user_id = session.get('_user_id')
+  if user_id is None or db.session.query(User.id).filter(User.id == int(user_id)).first() is not None:
+    raise error
+  identity_cache.delete(int(user_id))
+  logout_user()
+  flash('Your account no longer exists.')
+  return redirect(url_for('auth.login', next=request.path))
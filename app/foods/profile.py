@@ -0,0 +1,51 @@
+import copy
+from decimal import Decimal
+from types import MappingProxyType
+from app.cache import LRUCache
+from nutritionix import nutrient_categories
+
+# compiled profiles of recently viewed foods, keyed like the food catalog ('common:<name>' / 'branded:<nix_item_id>')
+profile_cache = LRUCache(maxsize=2048, ttl=3600)
+
+class NutritionProfile():
+  """Immutable nutrition data of one food, compiled once from a cleaned food record (see clean_food_data).
+
+  Holds the record's nutrients as a vector ordered like nutrient_categories (per the record's own serving, not per
+  gram), its serving weight and quantity, and its measures both as a list of (per unit weight, measure) choices and
+  as a dict, so serving unit checks are dict lookups and another serving is one multiplier applied to the vector.
+  The other fields of the record are copied once into a read-only mapping that food_info shares between calls.
+
+  Parameters:
+    food_info (dict): cleaned food record (Decimal serving weight, quantity and nutrients).
+    measures (list): (per unit weight, measure) tuples of the food, as returned by get_measures_tuple.
+
+  """
+  __slots__ = ('_fields', 'serving_weight_grams', 'serving_qty', 'nutrients', 'measures', 'measure_units')
+
+  def __init__(self, food_info, measures):
+    init = super().__setattr__
+    init('_fields', MappingProxyType(copy.deepcopy(food_info)))
+    init('serving_weight_grams', food_info['serving_weight_grams'])
+    init('serving_qty', food_info['serving_qty'])
+    init('nutrients', tuple(food_info[category] for category in nutrient_categories))
+    init('measures', tuple(tuple(measure) for measure in measures))
+    # first measure wins for duplicate weights, like a scan of the list would
+    measure_units = {}
+    for weight, measure in measures:
+      measure_units.setdefault(weight, measure)
+    init('measure_units', MappingProxyType(measure_units))
+
+  def __setattr__(self, name, value):
+    raise AttributeError('NutritionProfile is immutable')
+
+  def scale(self, nutrient_multiplier):
+    """Returns the nutrient vector multiplied by nutrient_multiplier and rounded to 2 decimals."""
+    return tuple(round(Decimal(value * nutrient_multiplier), 2) for value in self.nutrients)
+
+  def food_info(self, nutrient_multiplier):
+    """Returns the food record with its nutrients scaled by nutrient_multiplier and rounded to 2 decimals.
+
+    Only the top-level dict is new; nested values (alt_measures, photo) are shared by every call and must not be mutated.
+
+    """
+    return dict(self._fields, **dict(zip(nutrient_categories, self.scale(nutrient_multiplier))))
@@ -1,11 +1,17 @@
+import copy, time, hashlib
+from collections.abc import Mapping, MutableSequence
 from decimal import Decimal, InvalidOperation
-from flask import render_template, redirect, url_for,request,abort, session
+from flask import render_template, redirect, url_for,request,abort, session, current_app, jsonify, flash, make_response
 from flask_login import login_required, current_user
 from app import db
-from app.models import Cart, FoodItem
+from app.models import Cart, FoodItem, FoodCatalog, Job, PendingFood, job_queue_enabled
 from app.foods import foods
+from app.autocomplete import PrefixIndex
 from app.foods.forms import FoodServingForm, AddFoodForm, AddFoodToCartForm
-from nutritionix import search_item, get_common_nutrients, get_branded_nutrients, nutrient_categories, nutrient_categories_units
+from app.foods.profile import NutritionProfile, profile_cache
+from app.http_cache import not_modified, cache_headers, viewer_id
+from app.nutrients import NutrientVector
+from nutritionix import search_item, get_common_nutrients, get_branded_nutrients, gather_nutrients, normalize_query, nutrient_categories, nutrient_categories_units
 
 ######################################
 # VIEW FUNCTIONS
@@ -13,33 +19,39 @@ from nutritionix import search_item, get_common_nutrients, get_branded_nutrients
 # List all foods resulting from search, filtered by common and branded foods
 @foods.route('/list/<food_name>/<filter>')
 def list(food_name,filter):
-  search_result = search_item(food_name)
-  if filter == "common":
-    foods = search_result['common']
-  elif filter == "branded":
-    foods = search_result['branded']
-  else:
+  if filter not in ("common", "branded"):
     abort(404)
+  foods = search_foods(food_name, filter)
 
   return render_template('foods/list.html',food_name=food_name,foods=foods,filter=filter)
   
+# Typeahead suggestions for the food search box, e.g. /foods/autocomplete?q=chi
+@foods.route('/autocomplete')
+def autocomplete():
+  query = request.args.get('q','')
+  limit = request.args.get('limit',current_app.config['AUTOCOMPLETE_TOP_K'],type=int)
+  return jsonify(query=query, suggestions=get_food_index().suggest(query, limit))
+
 # Detail Page For Common Food
 @foods.route('/common/<food_name>', methods=['GET','POST'])
 @foods.route('/common/<food_name>/<serving_unit>/<serving_qty>',methods=['GET','POST'])
 def common_food(food_name, serving_unit=None, serving_qty=None):
-  # READ IN FOOD INFO
-  food_info = get_common_nutrients(food_name)
+  # answer unchanged pages before reading the food
+  response = not_modified(food_page_etag('common', food_name, serving_unit, serving_qty))
+  if response is not None:
+    return response
+
+  # READ IN FOOD PROFILE
+  profile = get_food_profile('common', food_name)
 
-  if food_info is None:
+  if profile is None:
     abort(404)
-    
-  clean_food_data(food_info, nutrient_categories)
 
   # URL PARAMETER PROCESSING
   if serving_unit is None:
-    serving_unit = food_info['serving_weight_grams']
+    serving_unit = profile.serving_weight_grams
   if serving_qty is None:
-    serving_qty = food_info['serving_qty']
+    serving_qty = profile.serving_qty
 
   try:
     serving_unit = round(Decimal(serving_unit),2)
@@ -47,15 +59,14 @@ def common_food(food_name, serving_unit=None, serving_qty=None):
   except InvalidOperation:
     abort(404)
 
-  measures_tuple = get_measures_tuple(food_info)
-  if not is_in_tuple_list(str(serving_unit),measures_tuple):
+  measures_tuple = profile.measures
+  if not is_in_tuple_list(str(serving_unit),profile.measure_units):
     abort(404)
 
   # UPDATE NUTRIENTS
-  nutrient_multiplier = get_nutrient_multiplier(food_info['serving_weight_grams'],
+  nutrient_multiplier = get_nutrient_multiplier(profile.serving_weight_grams,
   serving_unit, serving_qty)
-  update_nutrients(food_info,nutrient_multiplier,nutrient_categories)
-  round_food_data(food_info,nutrient_categories)
+  food_info = profile.food_info(nutrient_multiplier)
 
   # FORM PROCESSING
   form = FoodServingForm()
@@ -65,35 +76,42 @@ def common_food(food_name, serving_unit=None, serving_qty=None):
   if form.validate_on_submit() and form.submit.data:
     return redirect(url_for('foods.common_food',food_name=food_name,serving_unit=form.serving_unit.data,serving_qty=form.serving_qty.data))
   elif add_form.validate_on_submit() and add_form.add.data:
-    session['food_info'] = food_info
-    # get string representation of serving_unit
-    session['serving_unit'] = get_str_serving_unit(measures_tuple,str(round(serving_unit,2)))
-    session['serving_qty'] = serving_qty
+    # keep the selection server side, the session only carries its token
+    # (with string representation of serving_unit)
+    pending = PendingFood.create(food_info,
+    get_str_serving_unit(profile.measure_units,str(round(serving_unit,2))),
+    serving_qty, replace=session.get('pending_food'))
+    db.session.commit()
+    session['pending_food'] = pending.token
     return redirect(url_for('foods.add_food'))
   elif request.method == 'GET':
     form.serving_qty.data = Decimal(serving_qty)
     form.serving_unit.data = str(serving_unit)
 
 
-  return render_template('foods/food.html',food_info=food_info,form=form,add_form=add_form,nutrient_categories_units=nutrient_categories_units)
+  response = make_response(render_template('foods/food.html',food_info=food_info,form=form,add_form=add_form,nutrient_categories_units=nutrient_categories_units))
+  return cache_headers(response, food_page_etag('common', food_name, request.view_args.get('serving_unit'), request.view_args.get('serving_qty')))
 
 # Detail Page For Branded Food
 @foods.route('/branded/<nix_item_id>', methods=['GET','POST'])
 @foods.route('/branded/<nix_item_id>/<serving_unit>/<serving_qty>',methods=['GET','POST'])
 def branded_food(nix_item_id, serving_unit=None, serving_qty=None):
-  # READ IN FOOD INFO
-  food_info = get_branded_nutrients(nix_item_id)
+  # answer unchanged pages before reading the food
+  response = not_modified(food_page_etag('branded', nix_item_id, serving_unit, serving_qty))
+  if response is not None:
+    return response
 
-  if food_info is None:
+  # READ IN FOOD PROFILE
+  profile = get_food_profile('branded', nix_item_id)
+
+  if profile is None:
     abort(404)
-    
-  clean_food_data(food_info, nutrient_categories)
 
   # URL PARAMETER PROCESSING
   if serving_unit is None:
-    serving_unit = food_info['serving_weight_grams']
+    serving_unit = profile.serving_weight_grams
   if serving_qty is None:
-    serving_qty = food_info['serving_qty']
+    serving_qty = profile.serving_qty
 
   try:
     serving_unit = round(Decimal(serving_unit),2)
@@ -101,15 +119,14 @@ def branded_food(nix_item_id, serving_unit=None, serving_qty=None):
   except InvalidOperation:
     abort(404)
 
-  measures_tuple = get_measures_tuple(food_info)
-  if not is_in_tuple_list(str(serving_unit),measures_tuple):
+  measures_tuple = profile.measures
+  if not is_in_tuple_list(str(serving_unit),profile.measure_units):
     abort(404)
 
   # UPDATE NUTRIENTS
-  nutrient_multiplier = get_nutrient_multiplier(food_info['serving_weight_grams'],
+  nutrient_multiplier = get_nutrient_multiplier(profile.serving_weight_grams,
   serving_unit, serving_qty)
-  update_nutrients(food_info,nutrient_multiplier,nutrient_categories)
-  round_food_data(food_info,nutrient_categories)
+  food_info = profile.food_info(nutrient_multiplier)
 
   # FORM PROCESSING
   form = FoodServingForm()
@@ -119,20 +136,29 @@ def branded_food(nix_item_id, serving_unit=None, serving_qty=None):
   if form.validate_on_submit() and form.submit.data:
     return redirect(url_for('foods.branded_food',nix_item_id=nix_item_id,serving_unit=form.serving_unit.data,serving_qty=form.serving_qty.data))
   elif add_form.validate_on_submit() and add_form.add.data:
-    session['food_info'] = food_info
-    # get string representation of serving_unit
-    session['serving_unit'] = get_str_serving_unit(measures_tuple,str(round(serving_unit,2)))
-    session['serving_qty'] = serving_qty
+    # keep the selection server side, the session only carries its token
+    # (with string representation of serving_unit)
+    pending = PendingFood.create(food_info,
+    get_str_serving_unit(profile.measure_units,str(round(serving_unit,2))),
+    serving_qty, replace=session.get('pending_food'))
+    db.session.commit()
+    session['pending_food'] = pending.token
     return redirect(url_for('foods.add_food'))
   elif request.method == 'GET':
     form.serving_qty.data = Decimal(serving_qty)
     form.serving_unit.data = str(serving_unit)
 
-  return render_template('foods/food.html',food_info=food_info,form=form, add_form=add_form,nutrient_categories_units=nutrient_categories_units)
+  response = make_response(render_template('foods/food.html',food_info=food_info,form=form, add_form=add_form,nutrient_categories_units=nutrient_categories_units))
+  return cache_headers(response, food_page_etag('branded', nix_item_id, request.view_args.get('serving_unit'), request.view_args.get('serving_qty')))
 
 @foods.route('/add_food', methods=['POST','GET'])
 @login_required
 def add_food():
+  pending = PendingFood.get(session.get('pending_food'))
+  if pending is None:
+    flash('Food Selection Has Expired, Please Select The Food Again')
+    return redirect(url_for('core.index'))
+
   form = AddFoodToCartForm()
   
   # form processing
@@ -146,34 +172,86 @@ def add_food():
     # get cart
     cart = Cart.query.get_or_404(int(form.cart_id.data))
     
-    # create food and add to cart
-    food_info = session.get('food_info')
-    food = FoodItem(name=food_info['food_name'],
-    img_url=food_info['photo']['thumb'],
-    nf_calories=food_info['nf_calories'],
-    nf_total_fat=food_info['nf_total_fat'],
-    nf_saturated_fat=food_info['nf_saturated_fat'],
-    nf_cholesterol=food_info['nf_cholesterol'],
-    nf_sodium=food_info['nf_sodium'],
-    nf_total_carbohydrate=food_info['nf_total_carbohydrate'],
-    nf_dietary_fiber=food_info['nf_dietary_fiber'],
-    nf_sugars=food_info['nf_sugars'],
-    nf_protein=food_info['nf_protein'],
-    serving_unit=session.get('serving_unit'),
-    serving_qty=session.get('serving_qty')
-    )
-    food.cart = cart
-
-    # update cart nutrients too
-    cart.update_nutrients()
+    # create food from the pending selection and add to cart
+    food = pending.to_food_item()
+    # add food to cart, updating cart nutrients too
+    cart.add_food(food)
+    FoodCatalog.record_use({'food_name': pending.name, 'nix_item_id': pending.nix_item_id})
 
     db.session.add(food)
+    db.session.delete(pending)
     db.session.commit()
+    session.pop('pending_food', None)
+    update_food_index([food.name])
     
     return redirect(url_for('carts.list',username=current_user.username))
   
   return render_template('foods/add_food.html',form=form)
 
+# Add many foods to a cart with one request, e.g. POST JSON
+# {"cart_id": 1, "foods": [{"food_name": "apple", "serving_unit": "182.00", "serving_qty": 2}, {"nix_item_id": "513fc9e73fe3ffd40300109f"}]}
+# serving_unit is a per unit weight of the food's measures (defaults to the first one), serving_qty defaults to 1
+@foods.route('/add_foods', methods=['POST'])
+@login_required
+def add_foods():
+  data = request.get_json(silent=True) or {}
+  entries = data.get('foods')
+  # (list is shadowed by the list view)
+  if not isinstance(entries, MutableSequence) or not entries:
+    return jsonify(error='foods must be a non-empty list'), 400
+  if len(entries) > current_app.config['BULK_ADD_MAX_FOODS']:
+    return jsonify(error='at most %d foods can be added at once' % current_app.config['BULK_ADD_MAX_FOODS']), 400
+
+  cart_id = data.get('cart_id')
+  if not isinstance(cart_id, int) or isinstance(cart_id, bool):
+    return jsonify(error='cart_id must be an integer'), 400
+  cart = Cart.query.get_or_404(cart_id)
+  if cart.user_id != current_user.id:
+    abort(403)
+
+  # resolve every food (cache, catalog, then concurrent upstream requests)
+  refs = []
+  for i, entry in enumerate(entries):
+    if isinstance(entry, dict) and entry.get('nix_item_id'):
+      refs.append(('branded', str(entry['nix_item_id'])))
+    elif isinstance(entry, dict) and entry.get('food_name'):
+      refs.append(('common', str(entry['food_name'])))
+    else:
+      return jsonify(error='food %d needs a food_name or nix_item_id' % i), 400
+  profiles = get_food_profiles(refs)
+
+  rows = []
+  food_infos = []
+  for i, (entry, profile) in enumerate(zip(entries, profiles)):
+    if profile is None:
+      return jsonify(error='food %d could not be found' % i), 404
+    try:
+      serving_unit = round(Decimal(str(entry.get('serving_unit', profile.measures[0][0]))),2)
+      serving_qty = round(Decimal(str(entry.get('serving_qty', 1))),2)
+    except InvalidOperation:
+      return jsonify(error='food %d has an invalid serving_unit or serving_qty' % i), 400
+    if not is_in_tuple_list(str(serving_unit),profile.measure_units):
+      return jsonify(error='food %d has no measure weighing %s' % (i, serving_unit)), 400
+
+    nutrient_multiplier = get_nutrient_multiplier(profile.serving_weight_grams, serving_unit, serving_qty)
+    food_info = profile.food_info(nutrient_multiplier)
+    food_infos.append(food_info)
+    rows.append(dict({category: food_info[category] for category in nutrient_categories},
+      name=food_info['food_name'],
+      img_url=(food_info.get('photo') or {}).get('thumb'),
+      serving_unit=get_str_serving_unit(profile.measure_units,str(serving_unit)),
+      serving_qty=serving_qty,
+      cart_id=cart.id))
+
+  # one executemany, one aggregated delta on the cart totals, one commit
+  db.session.execute(FoodItem.__table__.insert(), rows)
+  cart.apply_nutrient_totals(NutrientVector.from_objects(rows).sum().to_decimals())
+  FoodCatalog.record_uses(food_infos)
+  db.session.commit()
+  update_food_index([row['name'] for row in rows])
+
+  return jsonify(cart_id=cart.id, added=len(rows), totals={category: str(round(getattr(cart, category), 2)) for category in nutrient_categories})
+
 @foods.route('/delete/<int:id>')
 @login_required
 def delete_food(id):
@@ -186,8 +264,7 @@ def delete_food(id):
     abort(403)
 
   # delete food and update cart
-  db.session.delete(food)
-  cart.update_nutrients()
+  cart.remove_food(food)
   db.session.commit()
 
   return redirect(url_for('carts.cart',id=cart.id))
@@ -195,6 +272,117 @@ def delete_food(id):
 ######################################
 # HELPER FUNCTIONS
 
+# Search results for a filter ("common" or "branded"), from the local food catalog when FOOD_SEARCH_POLICY allows it
+def search_foods(food_name, filter):
+  policy = current_app.config['FOOD_SEARCH_POLICY']
+  if policy != 'api':
+    foods = FoodCatalog.search(food_name, filter)
+    if policy == 'local_only' or len(foods) >= current_app.config['FOOD_SEARCH_MIN_RESULTS']:
+      return [food.to_search_result() for food in foods]
+
+  search_result = search_item(food_name)
+  if policy != 'api':
+    added = FoodCatalog.store_search_results(search_result)
+    # prefetch the records of the top results in the background, so opening one of them needs no upstream call
+    if job_queue_enabled():
+      refs = [[filter, food.get('nix_item_id') if filter == 'branded' else food.get('food_name')] for food in search_result[filter][:current_app.config['FOOD_PREWARM_RESULTS']]]
+      if refs:
+        Job.enqueue('warm_foods', [refs], dedup_key='warm_foods:%s:%s' % (filter, normalize_query(food_name)))
+    db.session.commit()
+    update_food_index([entry.food_name for entry in added])
+  return search_result[filter]
+
+# Autocomplete index of the app, built on first use from the names of foods in carts (ranked by how often they were
+# added) and of the food catalog
+def get_food_index():
+  index = current_app.extensions.get('food_index')
+  if index is None:
+    index = PrefixIndex(k=current_app.config['AUTOCOMPLETE_TOP_K'])
+    for name, count in db.session.query(FoodItem.name, db.func.count(FoodItem.id)).group_by(FoodItem.name):
+      index.add(name, count)
+    for name, in db.session.query(FoodCatalog.food_name):
+      index.add(name)
+    current_app.extensions['food_index'] = index
+  return index
+
+# Count newly added foods in the autocomplete index (an index that was not built yet reads them from the database)
+def update_food_index(names):
+  index = current_app.extensions.get('food_index')
+  if index is not None:
+    for name in names:
+      index.add(name)
+
+# ETag of a food page; the page's forms embed a CSRF token tied to the session, so validators include the session's
+# token and change every half CSRF time limit (before rendered tokens expire)
+def food_page_etag(kind, value, serving_unit, serving_qty):
+  window = (current_app.config.get('WTF_CSRF_TIME_LIMIT') or 3600) / 2
+  key = [FoodCatalog.catalog_key(kind, value), serving_unit, serving_qty, viewer_id(), session.get('csrf_token'), int(time.time() // window)]
+  return 'food-' + hashlib.sha1(repr(key).encode('utf-8')).hexdigest()[:20]
+
+# Compiled nutrition profile of a common food name or branded nix_item_id, cached in process
+def get_food_profile(kind, value):
+  key = FoodCatalog.catalog_key(kind, value)
+  profile = profile_cache.get(key)
+  if profile is None:
+    food_info = get_food_info(kind, value)
+    if food_info is None:
+      return None
+    profile = compile_food_profile(food_info)
+    profile_cache.set(key, profile)
+  return profile
+
+# Profiles of many (kind, value) food references; misses are read from the catalog with one query and then
+# fetched from Nutritionix concurrently. Foods that cannot be found get None.
+def get_food_profiles(refs):
+  policy = current_app.config['FOOD_SEARCH_POLICY']
+  profiles = {}
+  for kind, value in refs:
+    key = FoodCatalog.catalog_key(kind, value)
+    if key not in profiles:
+      profiles[key] = profile_cache.get(key)
+
+  missing = [(kind, value) for kind, value in refs if profiles[FoodCatalog.catalog_key(kind, value)] is None]
+  records = FoodCatalog.lookup_many(missing) if policy != 'api' else {}
+  fetch = {}
+  for kind, value in missing:
+    key = FoodCatalog.catalog_key(kind, value)
+    if key in records:
+      profiles[key] = compile_food_profile(records[key])
+      profile_cache.set(key, profiles[key])
+    else:
+      fetch.setdefault(key, (kind, value))
+
+  if fetch:
+    for (kind, value), food_info in zip(fetch.values(), gather_nutrients([ref for ref in fetch.values()])):
+      if food_info is None:
+        continue
+      if policy != 'api':
+        FoodCatalog.store_food(kind, food_info)
+      key = FoodCatalog.catalog_key(kind, value)
+      profiles[key] = compile_food_profile(food_info)
+      profile_cache.set(key, profiles[key])
+
+  return [profiles[FoodCatalog.catalog_key(kind, value)] for kind, value in refs]
+
+def compile_food_profile(food_info):
+  food_info = copy.deepcopy(food_info)
+  clean_food_data(food_info, nutrient_categories)
+  return NutritionProfile(food_info, get_measures_tuple(food_info))
+
+# Food record of a common food name or branded nix_item_id, from the local food catalog when it has been fetched before
+def get_food_info(kind, value):
+  policy = current_app.config['FOOD_SEARCH_POLICY']
+  if policy != 'api':
+    food_info = FoodCatalog.lookup(kind, value)
+    if food_info is not None:
+      return food_info
+
+  food_info = get_common_nutrients(value) if kind == 'common' else get_branded_nutrients(value)
+  if food_info is not None and policy != 'api':
+    FoodCatalog.store_food(kind, food_info)
+    db.session.commit()
+  return food_info
+
 # Construct tuple of measures (serving weight/qty, measure unit) for a food product 
 def get_measures_tuple(food_info):
   if food_info.get('alt_measures') is None:
@@ -273,16 +461,20 @@ def round_food_data(food_info,nutrient_categories):
   for category in nutrient_categories:
     food_info[category] = round(food_info[category],2)
 
-# function to check if argument is contained in list of tuples
+# function to check if argument is contained in list of tuples (or is a key of a dict)
 def is_in_tuple_list(arg,tuple_list):
+  if isinstance(tuple_list, Mapping):
+    return arg in tuple_list
   for tuple in tuple_list:
     if arg == tuple[0]:
       return True
   
   return False
 
-# function to retrieve specific serving_unit from measures_tuple
+# function to retrieve specific serving_unit from measures_tuple (or from a dict of measures)
 def get_str_serving_unit(measures_tuple,serving_unit):
+  if isinstance(measures_tuple, Mapping):
+    return measures_tuple.get(serving_unit)
   for measure in measures_tuple:
     if measure[0] == serving_unit:
       return measure[1]
@@ -0,0 +1,46 @@
+from flask import request, session, current_app
+from flask_login import current_user
+
+# pages render differently for every logged in user, so their validators include who is looking
+def viewer_id():
+  return current_user.id if current_user.is_authenticated else 0
+
+def not_modified(etag, last_modified=None):
+  """Returns an empty 304 response when the request's If-None-Match (or If-Modified-Since) validators match the page, else None.
+
+  Call it before loading anything else the page needs, so unchanged pages are answered without rendering a template.
+
+  """
+  # pending flash messages have to be rendered (and consumed) by a full page
+  if request.method not in ('GET', 'HEAD') or session.get('_flashes'):
+    return None
+  if request.if_none_match:
+    matched = request.if_none_match.contains_weak(etag)
+  elif last_modified is not None and request.if_modified_since is not None:
+    matched = request.if_modified_since >= last_modified.replace(microsecond=0)
+  else:
+    matched = False
+  if not matched:
+    return None
+  return cache_headers(current_app.response_class(status=304), etag, last_modified)
+
+def cache_headers(response, etag, last_modified=None, public=False):
+  """Adds validators and Cache-Control to a GET response.
+
+  public pages may be cached by shared caches (reverse proxies) for PAGE_CACHE_MAX_AGE seconds when the viewer is
+  anonymous; every other page is private and revalidated with its ETag on each use.
+
+  """
+  if request.method not in ('GET', 'HEAD') or response.status_code not in (200, 304):
+    return response
+  response.set_etag(etag, weak=True)
+  if last_modified is not None:
+    response.last_modified = last_modified
+  if public and not current_user.is_authenticated:
+    response.cache_control.public = True
+    response.cache_control.max_age = current_app.config['PAGE_CACHE_MAX_AGE']
+  else:
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+  response.vary.add('Cookie')
+  return response
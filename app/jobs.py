@@ -0,0 +1,157 @@
+import json, threading, traceback
+from datetime import datetime, timedelta
+from flask import current_app, g
+from app import db
+from app.foods.profile import profile_cache
+from app.foods.views import get_food_profiles
+from app.models import Cart, FeedEntry, FoodCatalog, Job
+from nutritionix import gather_nutrients
+
+# task name -> function; jobs call them with their JSON args inside an app context
+tasks = {}
+
+def task(f):
+  tasks[f.__name__] = f
+  return f
+
+def enqueue(name, *args, dedup_key=None, delay=0):
+  """Queues task name with args in the current transaction, or runs it right away when the job queue is off.
+
+  Returns whether a job was added (False for a duplicate of a queued job).
+
+  """
+  if name not in tasks:
+    raise KeyError('unknown task %s' % name)
+  if current_app.config['JOB_QUEUE'] != 'db':
+    tasks[name](*args)
+    return False
+  return Job.enqueue(name, args, dedup_key=dedup_key, delay=delay)
+
+def heartbeat():
+  """Commits the work done so far by the running job and extends its lease, for long tasks to call between batches.
+
+  Returns False when the job was claimed again by another worker after its visibility timeout (the task should stop).
+  Tasks run inline (job queue off) keep their work in the caller's transaction and always get True.
+
+  """
+  job = g.get('job')
+  if job is None:
+    return True
+  return job.extend(current_app.config['JOB_VISIBILITY_TIMEOUT'])
+
+def run_job(job):
+  """Runs a claimed job, deleting it when its task succeeds and scheduling a retry when it raises."""
+  g.job = job
+  try:
+    tasks[job.task](*json.loads(job.args))
+    job.complete()
+    db.session.commit()
+    return True
+  except Exception:
+    db.session.rollback()
+    current_app.logger.exception('job %d (%s) failed, attempt %d of %d', job.id, job.task, job.attempts, job.max_attempts)
+    job.fail(traceback.format_exc(limit=5), current_app.config['JOB_RETRY_DELAY'])
+    db.session.commit()
+    return False
+  finally:
+    g.pop('job', None)
+
+def run_pending(limit=None):
+  """Runs visible jobs one after another in the current thread until none is left (or limit jobs ran); returns the number run."""
+  count = 0
+  while limit is None or count < limit:
+    job = Job.claim(current_app.config['JOB_VISIBILITY_TIMEOUT'])
+    if job is None:
+      break
+    run_job(job)
+    count += 1
+  return count
+
+class WorkerPool():
+  """Threads running jobs of the jobs table, each with its own app context and database session.
+
+  Idle threads poll for visible jobs every poll_interval seconds.
+
+  Parameters:
+    app (Flask): application the jobs run in.
+    threads (int): number of worker threads.
+    poll_interval (float): seconds an idle thread waits before looking for jobs again.
+
+  """
+
+  def __init__(self, app, threads=4, poll_interval=1.0):
+    self.app = app
+    self.threads = threads
+    self.poll_interval = poll_interval
+    self._stop = threading.Event()
+    self._workers = []
+
+  def start(self):
+    for i in range(self.threads):
+      worker = threading.Thread(target=self._work, name='job-worker-%d' % i, daemon=True)
+      worker.start()
+      self._workers.append(worker)
+
+  def stop(self, timeout=None):
+    self._stop.set()
+    for worker in self._workers:
+      worker.join(timeout)
+    self._workers = []
+
+  def _work(self):
+    with self.app.app_context():
+      while not self._stop.is_set():
+        try:
+          ran = run_pending(limit=1)
+        except Exception:
+          current_app.logger.exception('job worker could not claim a job')
+          ran = 0
+        finally:
+          db.session.remove()
+        if not ran:
+          self._stop.wait(self.poll_interval)
+
+# add a new cart to the feeds of its owner's followers; entries added meanwhile (by a follow's backfill) are replaced
+@task
+def fan_out_cart(cart_id):
+  cart = Cart.query.get(cart_id)
+  if cart is None or cart.user_id is None:
+    return
+  db.session.execute(FeedEntry.__table__.delete().where(FeedEntry.cart_id == cart.id))
+  db.session.execute(FeedEntry.fan_out_statement(cart.id, cart.user_id, cart.timestamp))
+
+# recompute the totals of carts (all carts when cart_ids is None) that differ from their foods, batch_size carts per
+# transaction, extending the job's lease after each batch
+@task
+def repair_carts(cart_ids=None, batch_size=1000):
+  query = db.session.query(Cart.id).order_by(Cart.id)
+  if cart_ids is not None:
+    query = query.filter(Cart.id.in_(cart_ids))
+  last_id = 0
+  while True:
+    batch = [id for id, in query.filter(Cart.id > last_id).limit(batch_size)]
+    if not batch:
+      break
+    wrong = Cart.verify_all_nutrients(batch, batch_size=batch_size)
+    if wrong:
+      Cart.repair_all_nutrients(cart_ids=wrong, batch_size=batch_size)
+    if not heartbeat():
+      # the job is being rerun by another worker; the batches committed so far stay repaired
+      return
+    last_id = batch[-1]
+
+# fetch the full records of [kind, value] foods missing from the food catalog, so their detail pages need no upstream call
+@task
+def warm_foods(refs):
+  get_food_profiles([tuple(ref) for ref in refs])
+
+# refetch full catalog records last updated more than max_age_days ago, most popular first
+@task
+def refresh_foods(max_age_days=7, limit=100):
+  cutoff = datetime.utcnow() - timedelta(days=max_age_days)
+  entries = FoodCatalog.query.filter(FoodCatalog.data.isnot(None), FoodCatalog.updated_at < cutoff).order_by(FoodCatalog.popularity.desc()).limit(limit).all()
+  refs = [(entry.kind, entry.nix_item_id if entry.kind == 'branded' else entry.food_name) for entry in entries]
+  for entry, food_info in zip(entries, gather_nutrients(refs)):
+    if food_info is not None:
+      FoodCatalog.store_food(entry.kind, food_info)
+      profile_cache.delete(entry.key)
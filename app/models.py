@@ -1,25 +1,94 @@
+import json, secrets
+import numpy as np
 from app import db, login_manager
+from flask import current_app
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import make_transient_to_detached
+from app.cache import LRUCache
+from app.nutrients import NutrientVector
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
 from decimal import Decimal
-from datetime import datetime
+from datetime import datetime, timedelta
+from nutritionix import nutrient_categories, normalize_query
+
+# short-lived snapshots of logged in users so load_user does not query on every request; a worker drops its own
+# snapshots when a user changes, but another worker may serve a changed or deleted user's snapshot for up to
+# USER_CACHE_TTL seconds (a deleted user's session is logged out once its missing row is noticed, see app.errors)
+identity_cache = LRUCache(maxsize=10000)
 
 @login_manager.user_loader
 def load_user(user_id):
-  return User.query.get(int(user_id))
+  user_id = int(user_id)
+  snapshot = identity_cache.get(user_id)
+  if snapshot is not None:
+    # attach a persistent User built from the snapshot without a SELECT; other columns load on access
+    user = User(**snapshot)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+  user = User.query.get(user_id)
+  ttl = current_app.config.get('USER_CACHE_TTL', 0)
+  if user is not None and ttl > 0:
+    identity_cache.set(user_id, {'id': user.id, 'username': user.username, 'email': user.email}, ttl=ttl)
+  return user
 
 class Follow(db.Model):
   __tablename__ = 'follows'
   follower_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
-  followed_id = db.Column(db.Integer, db.ForeignKey('users.id'),primary_key=True)
+  followed_id = db.Column(db.Integer, db.ForeignKey('users.id'),primary_key=True,index=True)
   timestamp = db.Column(db.DateTime, default=datetime.utcnow)
 
+# followed carts feeds are either joined at read time ('pull') or materialized in feed_entries on write ('push')
+def feed_push_mode():
+  return current_app.config.get('FEED_MODE') == 'push'
+
+class FeedEntry(db.Model):
+  __tablename__ = 'feed_entries'
+  user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+  cart_id = db.Column(db.Integer, db.ForeignKey('carts.id'), primary_key=True, index=True)
+  timestamp = db.Column(db.DateTime)
+  # feed reads are a range scan over one user's entries in timestamp order
+  __table_args__ = (db.Index('ix_feed_entries_user_id_timestamp', 'user_id', 'timestamp', 'cart_id'),)
+
+  # add carts of followed user to follower's feed
+  @classmethod
+  def backfill(cls, follower, followed):
+    carts = Cart.__table__
+    select = db.select([db.literal(follower.id), carts.c.id, carts.c.timestamp]).where(carts.c.user_id == followed.id)
+    db.session.execute(cls.__table__.insert().from_select(['user_id', 'cart_id', 'timestamp'], select))
+
+  # remove carts of followed user from follower's feed
+  @classmethod
+  def prune(cls, follower, followed):
+    carts = Cart.__table__
+    feed = cls.__table__
+    db.session.execute(feed.delete().where(db.and_(feed.c.user_id == follower.id, feed.c.cart_id.in_(db.select([carts.c.id]).where(carts.c.user_id == followed.id)))))
+
+  # statement adding a new cart to the feeds of its owner's followers
+  @classmethod
+  def fan_out_statement(cls, cart_id, user_id, timestamp):
+    follows = Follow.__table__
+    select = db.select([follows.c.follower_id, db.literal(cart_id), db.literal(timestamp, db.DateTime)]).where(follows.c.followed_id == user_id)
+    return cls.__table__.insert().from_select(['user_id', 'cart_id', 'timestamp'], select)
+
+  # repopulate every feed from follows (e.g. when switching from pull to push mode)
+  @classmethod
+  def rebuild(cls):
+    carts = Cart.__table__
+    follows = Follow.__table__
+    select = db.select([follows.c.follower_id, carts.c.id, carts.c.timestamp]).select_from(follows.join(carts, carts.c.user_id == follows.c.followed_id))
+    db.session.execute(cls.__table__.delete())
+    db.session.execute(cls.__table__.insert().from_select(['user_id', 'cart_id', 'timestamp'], select))
+
 class User(db.Model, UserMixin):
   __tablename__ = 'users'
   id = db.Column(db.Integer, primary_key=True)
   username = db.Column(db.String(64), unique=True, index=True)
   email = db.Column(db.String(64), unique=True, index=True)
   password_hash = db.Column(db.String(128))
+  # bumped in the database whenever one of the user's carts is added or deleted, for carts list ETags
+  carts_changes = db.Column(db.Integer, nullable=False, default=0, server_default='0')
   carts = db.relationship('Cart', backref='user', lazy='dynamic',cascade="all, delete-orphan")
   followed = db.relationship('Follow',
                             foreign_keys=[Follow.follower_id],
@@ -34,8 +103,17 @@ class User(db.Model, UserMixin):
 
   @property
   def followed_carts(self):
+    if feed_push_mode():
+      return Cart.query.join(FeedEntry, FeedEntry.cart_id == Cart.id).filter(FeedEntry.user_id == self.id)
     return Cart.query.join(Follow, Follow.followed_id == Cart.user_id).filter(Follow.follower_id == self.id)
 
+  # column followed_carts should be ordered by to read the feed in index order
+  @staticmethod
+  def followed_carts_timestamp():
+    if feed_push_mode():
+      return FeedEntry.timestamp
+    return Cart.timestamp
+
   @property
   def password(self):
     raise AttributeError('password is not a readable attribute')
@@ -57,17 +135,49 @@ class User(db.Model, UserMixin):
   def is_followed_by(self,user):
     return self.followers.filter_by(follower_id=user.id).first() is not None
   
+  # follow state towards many users with a single query, as {user_id: is_following}
+  def following_status(self,user_ids):
+    user_ids = set(user_ids)
+    followed = set()
+    if user_ids:
+      rows = db.session.query(Follow.followed_id).filter(Follow.follower_id == self.id, Follow.followed_id.in_(user_ids))
+      followed = {row.followed_id for row in rows}
+    return {user_id: user_id in followed for user_id in user_ids}
+
+  # changes whenever the user's carts list page changes (carts added, deleted or changed, follower counts), for ETags
+  # (carts_changes only grows, so a cart deleted and another added never give back an earlier fingerprint)
+  def carts_fingerprint(self):
+    carts = db.session.query(db.func.count(Cart.id), db.func.coalesce(db.func.sum(Cart.version), 0),
+      db.func.max(db.func.coalesce(Cart.updated_at, Cart.timestamp))).filter(Cart.user_id == self.id)
+    changes = db.session.query(User.carts_changes).filter(User.id == self.id).as_scalar()
+    followers = db.session.query(db.func.count(Follow.follower_id)).filter(Follow.followed_id == self.id).as_scalar()
+    followed = db.session.query(db.func.count(Follow.followed_id)).filter(Follow.follower_id == self.id).as_scalar()
+    return tuple(carts.add_columns(changes, followers, followed).one())
+
+  # follow user with a single idempotent INSERT ... SELECT WHERE NOT EXISTS, returns whether a new follow was created
   def follow(self,user):
-    if not self.is_following(user):
-      f = Follow(follower=self,followed=user)
-      db.session.add(f)
-      db.session.commit()
+    follows = Follow.__table__
+    exists = db.exists().where(db.and_(follows.c.follower_id == self.id, follows.c.followed_id == user.id))
+    select = db.select([db.literal(self.id), db.literal(user.id), db.literal(datetime.utcnow(), db.DateTime)]).where(~exists)
+    try:
+      created = db.session.execute(follows.insert().from_select(['follower_id', 'followed_id', 'timestamp'], select)).rowcount > 0
+    except IntegrityError:
+      # a concurrent request created the same follow
+      db.session.rollback()
+      return False
+    if created and feed_push_mode():
+      FeedEntry.backfill(self,user)
+    db.session.commit()
+    return created
   
+  # unfollow user with a single DELETE, returns whether a follow was removed
   def unfollow(self,user):
-    f = self.followed.filter_by(followed_id=user.id).first()
-    if f:
-      db.session.delete(f)
-      db.session.commit()
+    follows = Follow.__table__
+    deleted = db.session.execute(follows.delete().where(db.and_(follows.c.follower_id == self.id, follows.c.followed_id == user.id))).rowcount > 0
+    if deleted and feed_push_mode():
+      FeedEntry.prune(self,user)
+    db.session.commit()
+    return deleted
 
 class FoodItem(db.Model):
   __tablename__ = 'food_items'
@@ -87,7 +197,7 @@ class FoodItem(db.Model):
   serving_qty = db.Column(db.Numeric(decimal_return_scale=2,asdecimal=True))
   serving_unit = db.Column(db.String(32))
 
-  cart_id = db.Column(db.Integer, db.ForeignKey('carts.id'))
+  cart_id = db.Column(db.Integer, db.ForeignKey('carts.id'),index=True)
 
   def __init__(self,name,img_url,nf_calories=None,nf_total_fat=None,nf_saturated_fat=None,nf_cholesterol=None,nf_sodium=None,nf_total_carbohydrate=None,nf_dietary_fiber=None,nf_sugars=None,nf_protein=None, serving_qty=None, serving_unit=None):
   
@@ -110,6 +220,10 @@ class FoodItem(db.Model):
 
 class Cart(db.Model):
   __tablename__ = 'carts'
+  # per-user indexes matching every ordering offered by carts.list and the followed carts join
+  __table_args__ = tuple(
+    db.Index(f'ix_carts_user_id_{column}', 'user_id', column) for column in ['timestamp'] + nutrient_categories
+  )
 
   id = db.Column(db.Integer, primary_key=True)
   timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
@@ -126,38 +240,180 @@ class Cart(db.Model):
   nf_sugars = db.Column(db.Numeric(asdecimal=True,decimal_return_scale=2))
   nf_protein = db.Column(db.Numeric(asdecimal=True,decimal_return_scale=2))
 
-  # update total nutrients 
+  # bumped (in the database) whenever foods or totals change, for ETags and cached fragments
+  version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+  updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+  # add food to cart, applying its nutrients to the cart totals in O(1)
+  def add_food(self, food):
+    food.cart = self
+    self.apply_nutrient_delta(food, 1)
+
+  # remove food from cart, subtracting its nutrients from the cart totals in O(1)
+  def remove_food(self, food):
+    self.apply_nutrient_delta(food, -1)
+    db.session.delete(food)
+
+  def apply_nutrient_delta(self, food, sign):
+    self.apply_nutrient_totals({category: sign * (getattr(food, category) or Decimal(0)) for category in nutrient_categories})
+
+  # add the summed nutrients of many foods (e.g. inserted in bulk) to the cart totals at once; saved carts are
+  # incremented by the UPDATE itself (total = total + delta), so concurrent changes are never lost
+  def apply_nutrient_totals(self, totals):
+    persistent = db.inspect(self).persistent
+    for category in nutrient_categories:
+      if persistent:
+        setattr(self, category, getattr(Cart, category) + totals[category])
+      else:
+        setattr(self, category, (getattr(self, category) or Decimal(0)) + totals[category])
+    self.touch()
+
+  # mark cart as changed; the version is incremented by the UPDATE itself so concurrent changes never share a version
+  def touch(self):
+    self.updated_at = datetime.utcnow()
+    if db.inspect(self).persistent:
+      self.version = Cart.version + 1
+      # run the UPDATE right away and reload its results on access, so the attributes never hold SQL expressions
+      db.session.flush()
+      db.session.expire(self, nutrient_categories + ['version'])
+
+  # sum nutrients over every food in cart with one aggregate query (in fixed-point, without loading FoodItem objects)
+  def compute_nutrients(self):
+    if self.id is None:
+      # foods of an unsaved cart only exist in memory
+      return NutrientVector.from_objects(self.foods).sum().to_decimals()
+    sums = db.session.query(*NutrientVector.sum_columns(FoodItem)).filter(FoodItem.cart_id == self.id).one()
+    return NutrientVector.from_rows([sums]).sum().to_decimals()
+
+  # update total nutrients from scratch (repair path for add_food/remove_food)
   def update_nutrients(self):
-    nf_calories_sum = 0
-    nf_total_fat_sum = 0
-    nf_saturated_fat_sum = 0
-    nf_cholesterol_sum = 0
-    nf_sodium_sum = 0
-    nf_total_carbohydrate_sum = 0
-    nf_dietary_fiber_sum = 0
-    nf_sugars_sum = 0
-    nf_protein_sum = 0
-
-    for food in self.foods:
-      nf_calories_sum += food.nf_calories
-      nf_total_fat_sum += food.nf_total_fat
-      nf_saturated_fat_sum += food.nf_saturated_fat
-      nf_cholesterol_sum += food.nf_cholesterol
-      nf_sodium_sum += food.nf_sodium
-      nf_total_carbohydrate_sum += food.nf_total_carbohydrate
-      nf_dietary_fiber_sum += food.nf_dietary_fiber
-      nf_sugars_sum += food.nf_sugars
-      nf_protein_sum += food.nf_protein
-    
-    self.nf_calories = nf_calories_sum
-    self.nf_total_fat = nf_total_fat_sum
-    self.nf_saturated_fat = nf_saturated_fat_sum
-    self.nf_cholesterol = nf_cholesterol_sum
-    self.nf_sodium = nf_sodium_sum
-    self.nf_total_carbohydrate = nf_total_carbohydrate_sum
-    self.nf_dietary_fiber = nf_dietary_fiber_sum
-    self.nf_sugars = nf_sugars_sum
-    self.nf_protein = nf_protein_sum
+    for category, total in self.compute_nutrients().items():
+      setattr(self, category, total)
+    self.touch()
+
+  # check incrementally maintained totals against a full recompute
+  def verify_nutrients(self):
+    for category, total in self.compute_nutrients().items():
+      if round(getattr(self, category) or Decimal(0), 2) != round(total, 2):
+        return False
+    return True
+
+  # copy cart to user, copying its foods server side with a single INSERT ... SELECT and its totals directly
+  def clone_to(self, user):
+    cart = Cart()
+    cart.user_id = user.id
+    for category in nutrient_categories:
+      setattr(cart, category, getattr(self, category))
+    db.session.add(cart)
+    db.session.flush()
+
+    foods = FoodItem.__table__
+    columns = [column.name for column in foods.c if column.name not in ('id', 'cart_id')]
+    select = db.select([foods.c[column] for column in columns] + [db.literal(cart.id)]).where(foods.c.cart_id == self.id).order_by(foods.c.id)
+    db.session.execute(foods.insert().from_select(columns + ['cart_id'], select))
+    return cart
+
+  # recompute totals with a single aggregate query in the database (repair path without loading foods)
+  def repair_nutrients(self):
+    self.update_nutrients()
+
+  @classmethod
+  def repair_all_nutrients(cls, cart_ids=None, batch_size=1000):
+    """Recomputes the nutrient totals of many carts in the database.
+
+    Totals are computed with one grouped aggregate query over food_items and written back in batched executemany
+    UPDATEs, so no ORM objects are loaded. Carts without foods are reset to zero. Only carts whose stored totals differ
+    (to the cent) are written, so carts that were right keep their version and updated_at (and so their ETags and
+    cached cards). Given cart_ids are handled batch_size at a time to stay below the database's bound parameter limit.
+
+    Parameters:
+      cart_ids (list): ids of carts to repair (None repairs every cart).
+      batch_size (int): number of carts updated per executemany.
+
+    Returns:
+      int: number of carts whose totals changed.
+
+    """
+    foods = FoodItem.__table__
+    carts = cls.__table__
+
+    def differs(column, value):
+      return db.or_(column.is_(None), db.func.round(column, 2) != value)
+
+    sums = db.select([foods.c.cart_id.label('cart_id')] + [db.func.coalesce(db.func.sum(foods.c[category]), 0).label(category) for category in nutrient_categories]).where(foods.c.cart_id.isnot(None)).group_by(foods.c.cart_id)
+    changed = {'version': carts.c.version + 1, 'updated_at': datetime.utcnow()}
+    empty = carts.update().where(~db.exists().where(foods.c.cart_id == carts.c.id)).where(db.or_(*[differs(carts.c[category], 0) for category in nutrient_categories])).values(
+      dict({category: 0 for category in nutrient_categories}, **changed))
+    update = carts.update().where(carts.c.id == db.bindparam('_cart_id')).where(db.or_(*[differs(carts.c[category], db.bindparam('_' + category, type_=carts.c[category].type)) for category in nutrient_categories])).values(
+      dict({category: db.bindparam('_' + category, type_=carts.c[category].type) for category in nutrient_categories}, **changed))
+
+    connection = db.session.connection()
+    count = 0
+    cart_ids = None if cart_ids is None else [int(id) for id in cart_ids]
+    for start in [0] if cart_ids is None else range(0, len(cart_ids), batch_size):
+      chunk_sums, chunk_empty = sums, empty
+      if cart_ids is not None:
+        chunk = cart_ids[start:start + batch_size]
+        chunk_sums = sums.where(foods.c.cart_id.in_(chunk))
+        chunk_empty = empty.where(carts.c.id.in_(chunk))
+
+      result = connection.execute(chunk_sums)
+      while True:
+        rows = result.fetchmany(batch_size)
+        if not rows:
+          break
+        # totals rounded to the cent like the stored ones, so float sums never look like a change
+        totals = NutrientVector.from_rows([[row[category] for category in nutrient_categories] for row in rows]).to_decimals()
+        params = [dict({'_' + category: total[category] for category in nutrient_categories}, _cart_id=row['cart_id']) for row, total in zip(rows, totals)]
+        count += connection.execute(update, params).rowcount
+      count += connection.execute(chunk_empty).rowcount
+    return count
+
+  @classmethod
+  def verify_all_nutrients(cls, cart_ids=None, batch_size=1000):
+    """Finds carts whose stored nutrient totals differ from the sum of their foods.
+
+    Carts are checked batch_size at a time in cart id ranges. For each range the foods are summed per cart in the
+    database (GROUP BY cart_id), so one row is read per cart, and the sums are compared against the stored totals in
+    one vectorized comparison.
+
+    Parameters:
+      cart_ids (list): ids of carts to check (None checks every cart).
+      batch_size (int): number of carts checked per range.
+
+    Returns:
+      list: ids of carts with wrong totals (repair them with repair_all_nutrients).
+
+    """
+    carts = db.session.query(cls.id, *NutrientVector.columns(cls)).order_by(cls.id)
+    sums = db.session.query(FoodItem.cart_id, *NutrientVector.sum_columns(FoodItem)).group_by(FoodItem.cart_id)
+    if cart_ids is not None:
+      carts = carts.filter(cls.id.in_(cart_ids))
+      sums = sums.filter(FoodItem.cart_id.in_(cart_ids))
+
+    wrong = []
+    last_id = None
+    while True:
+      rows = (carts if last_id is None else carts.filter(cls.id > last_id)).limit(batch_size).all()
+      if not rows:
+        break
+      ids = np.array([row[0] for row in rows], dtype=np.int64)
+      stored = NutrientVector.from_rows([row[1:] for row in rows])
+
+      expected = NutrientVector.zeros(len(ids))
+      sum_rows = sums.filter(FoodItem.cart_id.between(int(ids[0]), int(ids[-1]))).all()
+      if sum_rows:
+        food_cart_ids = np.array([row[0] for row in sum_rows], dtype=np.int64)
+        positions = np.searchsorted(ids, food_cart_ids)
+        found = positions < len(ids)
+        found[found] = ids[positions[found]] == food_cart_ids[found]
+        expected.hundredths[positions[found]] = NutrientVector.from_rows([row[1:] for row in sum_rows]).hundredths[found]
+      wrong.extend(ids[~stored.equals(expected)].tolist())
+
+      if len(rows) < batch_size:
+        break
+      last_id = int(ids[-1])
+    return wrong
 
   def __init__(self):
     self.nf_calories = Decimal(0)
@@ -171,4 +427,331 @@ class Cart(db.Model):
     self.nf_protein = Decimal(0)
 
   def __repr__(self):
-    return f"Cart of {self.user}"
\ No newline at end of file
+    return f"Cart of {self.user}"
+
+# fan new carts out to followers' feeds (in a job when the job queue is enabled)
+@db.event.listens_for(Cart, 'after_insert')
+def fan_out_cart(mapper, connection, target):
+  if feed_push_mode() and target.user_id is not None:
+    if job_queue_enabled():
+      connection.execute(Job.enqueue_statement('fan_out_cart', [target.id], dedup_key='fan_out_cart:%d' % target.id))
+    else:
+      connection.execute(FeedEntry.fan_out_statement(target.id, target.user_id, target.timestamp))
+
+# count added and deleted carts on their owner (a changed cart bumps its own version)
+@db.event.listens_for(Cart, 'after_insert')
+@db.event.listens_for(Cart, 'after_delete')
+def count_carts_change(mapper, connection, target):
+  if target.user_id is not None:
+    users = User.__table__
+    connection.execute(users.update().where(users.c.id == target.user_id).values(carts_changes=users.c.carts_changes + 1))
+
+# feed entries are removed in both modes so switching modes never leaves dangling entries
+@db.event.listens_for(Cart, 'before_delete')
+def prune_cart_feed_entries(mapper, connection, target):
+  connection.execute(FeedEntry.__table__.delete().where(FeedEntry.cart_id == target.id))
+
+@db.event.listens_for(User, 'before_delete')
+def prune_user_feed_entries(mapper, connection, target):
+  connection.execute(FeedEntry.__table__.delete().where(FeedEntry.user_id == target.id))
+
+# drop cached snapshots when a user changes (e.g. password change) or is deleted
+@db.event.listens_for(User, 'after_update')
+@db.event.listens_for(User, 'after_delete')
+def invalidate_identity_cache(mapper, connection, target):
+  identity_cache.delete(target.id)
+
+class PendingFood(db.Model):
+  """Compact record of a food selected on a detail page, waiting for foods.add_food to pick a cart.
+
+  The cookie session only carries the record's token. Records expire after PENDING_FOOD_TTL seconds and the table
+  keeps at most PENDING_FOOD_MAX_ROWS of them (older ids are dropped first).
+
+  """
+  __tablename__ = 'pending_foods'
+  id = db.Column(db.Integer, primary_key=True)
+  token = db.Column(db.String(32), unique=True)
+  name = db.Column(db.String(128))
+  img_url = db.Column(db.String(256))
+  nix_item_id = db.Column(db.String(32))
+  nf_calories = db.Column(db.Numeric(decimal_return_scale=2,asdecimal=True))
+  nf_total_fat = db.Column(db.Numeric(decimal_return_scale=2,asdecimal=True))
+  nf_saturated_fat = db.Column(db.Numeric(decimal_return_scale=2,asdecimal=True))
+  nf_cholesterol = db.Column(db.Numeric(decimal_return_scale=2,asdecimal=True))
+  nf_sodium = db.Column(db.Numeric(decimal_return_scale=2,asdecimal=True))
+  nf_total_carbohydrate = db.Column(db.Numeric(decimal_return_scale=2,asdecimal=True))
+  nf_dietary_fiber = db.Column(db.Numeric(decimal_return_scale=2,asdecimal=True))
+  nf_sugars = db.Column(db.Numeric(decimal_return_scale=2,asdecimal=True))
+  nf_protein = db.Column(db.Numeric(decimal_return_scale=2,asdecimal=True))
+  serving_qty = db.Column(db.Numeric(decimal_return_scale=2,asdecimal=True))
+  serving_unit = db.Column(db.String(32))
+  created_at = db.Column(db.DateTime, index=True, default=datetime.utcnow)
+
+  @staticmethod
+  def expiry():
+    return datetime.utcnow() - timedelta(seconds=current_app.config['PENDING_FOOD_TTL'])
+
+  @classmethod
+  def create(cls, food_info, serving_unit, serving_qty, replace=None):
+    """Stores a scaled food record (replacing the record of token replace) and prunes expired and excess records."""
+    table = cls.__table__
+    if replace:
+      db.session.execute(table.delete().where(table.c.token == replace))
+    entry = cls(token=secrets.token_urlsafe(16), name=food_info['food_name'], img_url=(food_info.get('photo') or {}).get('thumb'),
+      nix_item_id=food_info.get('nix_item_id'), serving_unit=serving_unit, serving_qty=serving_qty)
+    for category in nutrient_categories:
+      setattr(entry, category, food_info[category])
+    db.session.add(entry)
+    db.session.flush()
+    db.session.execute(table.delete().where(db.or_(table.c.created_at < cls.expiry(), table.c.id <= entry.id - current_app.config['PENDING_FOOD_MAX_ROWS'])))
+    return entry
+
+  @classmethod
+  def get(cls, token):
+    if not token:
+      return None
+    return cls.query.filter(cls.token == token, cls.created_at >= cls.expiry()).first()
+
+  def to_food_item(self):
+    return FoodItem(name=self.name, img_url=self.img_url, serving_unit=self.serving_unit, serving_qty=self.serving_qty,
+      **{category: getattr(self, category) for category in nutrient_categories})
+
+class FoodCatalog(db.Model):
+  """Local copy of Nutritionix food records, so popular foods can be searched and shown without an upstream call.
+
+  Rows are keyed like the Nutritionix response cache ('common:<normalized food name>' or 'branded:<nix_item_id>').
+  Search results only fill in names and photos; data holds the full food record (nutrients, alt_measures, ...) once
+  its detail page was fetched. On SQLite, food names are indexed in the food_catalog_fts FTS5 table.
+
+  """
+  __tablename__ = 'food_catalog'
+  id = db.Column(db.Integer, primary_key=True)
+  key = db.Column(db.String(160), unique=True)
+  kind = db.Column(db.String(16))
+  food_name = db.Column(db.String(128))
+  brand_name = db.Column(db.String(128))
+  nix_item_id = db.Column(db.String(32))
+  photo = db.Column(db.String(256))
+  data = db.Column(db.Text)
+  popularity = db.Column(db.Integer, default=0)
+  updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+  __table_args__ = (db.Index('ix_food_catalog_kind_popularity', 'kind', 'popularity'),)
+
+  @staticmethod
+  def catalog_key(kind, value):
+    if kind == 'branded':
+      return 'branded:' + str(value).strip()
+    return 'common:' + normalize_query(value)
+
+  @property
+  def record(self):
+    return json.loads(self.data) if self.data else None
+
+  # shaped like an item of the search/instant endpoint's 'common'/'branded' lists
+  def to_search_result(self):
+    result = {'food_name': self.food_name, 'photo': {'thumb': self.photo}}
+    if self.kind == 'branded':
+      result.update({'nix_item_id': self.nix_item_id, 'brand_name': self.brand_name})
+    return result
+
+  @classmethod
+  def search(cls, query, kind, limit=20):
+    """Returns up to limit catalog entries of kind whose names start with the words of query, most popular first."""
+    words = normalize_query(query).split()
+    if not words:
+      return []
+    q = cls.query.filter(cls.kind == kind)
+    if db.session.get_bind().dialect.name == 'sqlite':
+      # every word as a quoted prefix term, so user input is never parsed as FTS5 syntax
+      match = ' '.join('"%s"*' % word.replace('"', '""') for word in words)
+      fts = db.table('food_catalog_fts', db.column('rowid'))
+      q = q.join(fts, fts.c.rowid == cls.id).filter(db.text('food_catalog_fts MATCH :match').bindparams(match=match))
+      q = q.order_by(cls.popularity.desc(), db.text('food_catalog_fts.rank'))
+    else:
+      for word in words:
+        q = q.filter(db.or_(cls.food_name.ilike('%' + word + '%'), cls.brand_name.ilike('%' + word + '%')))
+      q = q.order_by(cls.popularity.desc())
+    return q.limit(limit).all()
+
+  @classmethod
+  def lookup(cls, kind, value):
+    """Returns the stored food record for a common food name or branded nix_item_id, or None."""
+    entry = cls.query.filter_by(key=cls.catalog_key(kind, value)).first()
+    return entry.record if entry is not None else None
+
+  @classmethod
+  def lookup_many(cls, refs):
+    """Returns {catalog key: food record} for the stored records among (kind, value) pairs, with a single query."""
+    keys = {cls.catalog_key(kind, value) for kind, value in refs}
+    if not keys:
+      return {}
+    return {key: json.loads(data) for key, data in db.session.query(cls.key, cls.data).filter(cls.key.in_(keys), cls.data.isnot(None))}
+
+  @classmethod
+  def store_search_results(cls, search_result):
+    """Adds the foods of a search/instant response that are not in the catalog yet and returns the added entries."""
+    entries = {}
+    for kind in ('common', 'branded'):
+      for food in search_result.get(kind) or []:
+        value = food.get('nix_item_id') if kind == 'branded' else food.get('food_name')
+        if value and food.get('food_name'):
+          entries.setdefault(cls.catalog_key(kind, value), (kind, food))
+    if not entries:
+      return []
+    existing = {key for key, in db.session.query(cls.key).filter(cls.key.in_(entries.keys()))}
+    added = [cls(key=key, kind=kind, food_name=food['food_name'], brand_name=food.get('brand_name'),
+      nix_item_id=food.get('nix_item_id'), photo=(food.get('photo') or {}).get('thumb'), popularity=0)
+      for key, (kind, food) in entries.items() if key not in existing]
+    db.session.add_all(added)
+    return added
+
+  @classmethod
+  def store_food(cls, kind, food_info):
+    """Adds or updates the full record of a food returned by the nutrients endpoints."""
+    value = food_info.get('nix_item_id') if kind == 'branded' else food_info.get('food_name')
+    key = cls.catalog_key(kind, value)
+    entry = cls.query.filter_by(key=key).first()
+    if entry is None:
+      entry = cls(key=key, kind=kind, popularity=0)
+      db.session.add(entry)
+    entry.food_name = food_info.get('food_name')
+    entry.brand_name = food_info.get('brand_name')
+    entry.nix_item_id = food_info.get('nix_item_id')
+    entry.photo = (food_info.get('photo') or {}).get('thumb')
+    entry.data = json.dumps(food_info, default=str)
+    entry.updated_at = datetime.utcnow()
+    return entry
+
+  @classmethod
+  def record_use(cls, food_info):
+    """Counts a food being added to a cart, which ranks it higher in local search."""
+    cls.record_uses([food_info])
+
+  @classmethod
+  def record_uses(cls, food_infos):
+    """Counts many foods being added to carts with a single executemany."""
+    counts = {}
+    for food_info in food_infos:
+      kind = 'branded' if food_info.get('nix_item_id') else 'common'
+      value = food_info.get('nix_item_id') if kind == 'branded' else food_info.get('food_name')
+      key = cls.catalog_key(kind, value)
+      counts[key] = counts.get(key, 0) + 1
+    if counts:
+      table = cls.__table__
+      update = table.update().where(table.c.key == db.bindparam('_key')).values(popularity=table.c.popularity + db.bindparam('_count', type_=db.Integer))
+      db.session.execute(update, [{'_key': key, '_count': count} for key, count in counts.items()])
+
+  # seed the catalog with the names of foods already added to carts, ranked by how often they were added
+  @classmethod
+  def seed_from_food_items(cls):
+    counts = db.session.query(FoodItem.name, db.func.min(FoodItem.img_url), db.func.count(FoodItem.id)).group_by(FoodItem.name).all()
+    existing = {key for key, in db.session.query(cls.key)}
+    added = 0
+    for name, img_url, count in counts:
+      key = cls.catalog_key('common', name)
+      if name and key not in existing:
+        db.session.add(cls(key=key, kind='common', food_name=name, photo=img_url, popularity=count))
+        existing.add(key)
+        added += 1
+    return added
+
+# external content FTS5 index over food_catalog names, kept in sync by triggers (SQLite only)
+food_catalog_fts_ddl = [
+  """CREATE VIRTUAL TABLE IF NOT EXISTS food_catalog_fts USING fts5(food_name, brand_name, content='food_catalog', content_rowid='id', tokenize='porter unicode61')""",
+  """CREATE TRIGGER IF NOT EXISTS food_catalog_ai AFTER INSERT ON food_catalog BEGIN
+    INSERT INTO food_catalog_fts(rowid, food_name, brand_name) VALUES (new.id, new.food_name, new.brand_name);
+  END""",
+  """CREATE TRIGGER IF NOT EXISTS food_catalog_ad AFTER DELETE ON food_catalog BEGIN
+    INSERT INTO food_catalog_fts(food_catalog_fts, rowid, food_name, brand_name) VALUES ('delete', old.id, old.food_name, old.brand_name);
+  END""",
+  """CREATE TRIGGER IF NOT EXISTS food_catalog_au AFTER UPDATE OF food_name, brand_name ON food_catalog BEGIN
+    INSERT INTO food_catalog_fts(food_catalog_fts, rowid, food_name, brand_name) VALUES ('delete', old.id, old.food_name, old.brand_name);
+    INSERT INTO food_catalog_fts(rowid, food_name, brand_name) VALUES (new.id, new.food_name, new.brand_name);
+  END"""
+]
+for statement in food_catalog_fts_ddl:
+  db.event.listen(FoodCatalog.__table__, 'after_create', db.DDL(statement).execute_if(dialect='sqlite'))
+db.event.listen(FoodCatalog.__table__, 'before_drop', db.DDL('DROP TABLE IF EXISTS food_catalog_fts').execute_if(dialect='sqlite'))
+
+# slow work is queued in the jobs table ('db') for the worker pool of app.jobs, or run inline ('off')
+def job_queue_enabled():
+  return current_app.config.get('JOB_QUEUE') == 'db'
+
+class Job(db.Model):
+  """Unit of background work, run by the worker pool of app.jobs (manage.py worker); no broker besides the database.
+
+  A job can be claimed once visible_at has passed. Claiming it moves visible_at JOB_VISIBILITY_TIMEOUT seconds ahead
+  under a new lease, so the job of a worker that died becomes visible again and is retried. Finished jobs are
+  deleted; failed jobs are retried with exponential backoff and kept with status 'failed' after max_attempts.
+  Enqueueing a job whose dedup_key matches a queued job is a no-op.
+
+  """
+  __tablename__ = 'jobs'
+  id = db.Column(db.Integer, primary_key=True)
+  task = db.Column(db.String(64))
+  args = db.Column(db.Text)
+  dedup_key = db.Column(db.String(160), index=True)
+  status = db.Column(db.String(16), default='queued')
+  attempts = db.Column(db.Integer, default=0)
+  max_attempts = db.Column(db.Integer, default=3)
+  visible_at = db.Column(db.DateTime, default=datetime.utcnow)
+  lease = db.Column(db.String(32))
+  last_error = db.Column(db.Text)
+  created_at = db.Column(db.DateTime, default=datetime.utcnow)
+  # workers scan queued jobs in visible_at order
+  __table_args__ = (db.Index('ix_jobs_status_visible_at', 'status', 'visible_at'),)
+
+  @classmethod
+  def enqueue_statement(cls, task, args=(), dedup_key=None, delay=0):
+    """Statement inserting a job (tried up to JOB_MAX_ATTEMPTS times), unless dedup_key is given and a queued job already has it."""
+    now = datetime.utcnow()
+    max_attempts = current_app.config['JOB_MAX_ATTEMPTS']
+    values = [db.literal(task), db.literal(json.dumps(list(args))), db.literal(dedup_key, db.String), db.literal('queued'), db.literal(0),
+      db.literal(max_attempts), db.literal(now + timedelta(seconds=delay), db.DateTime), db.literal(now, db.DateTime)]
+    select = db.select(values)
+    if dedup_key is not None:
+      jobs = cls.__table__
+      select = select.where(~db.exists().where(db.and_(jobs.c.dedup_key == dedup_key, jobs.c.status == 'queued')))
+    columns = ['task', 'args', 'dedup_key', 'status', 'attempts', 'max_attempts', 'visible_at', 'created_at']
+    return cls.__table__.insert().from_select(columns, select)
+
+  @classmethod
+  def enqueue(cls, task, args=(), dedup_key=None, delay=0):
+    """Adds a job in the current transaction; returns whether it was added (False for a duplicate)."""
+    return db.session.execute(cls.enqueue_statement(task, args, dedup_key, delay)).rowcount > 0
+
+  @classmethod
+  def claim(cls, visibility_timeout):
+    """Leases the next visible job (committing the claim) and returns it, or None when no job is visible."""
+    now = datetime.utcnow()
+    candidates = db.session.query(cls.id, cls.visible_at).filter(cls.status == 'queued', cls.visible_at <= now).order_by(cls.visible_at, cls.id).limit(10).all()
+    for id, visible_at in candidates:
+      # the update only matches while no other worker claimed the job since it was read
+      lease = secrets.token_hex(16)
+      claimed = cls.query.filter(cls.id == id, cls.status == 'queued', cls.visible_at == visible_at).update(
+        {'visible_at': now + timedelta(seconds=visibility_timeout), 'lease': lease, 'attempts': cls.attempts + 1}, synchronize_session=False)
+      db.session.commit()
+      if claimed:
+        return cls.query.filter_by(id=id, lease=lease).first()
+    return None
+
+  def extend(self, visibility_timeout):
+    """Moves visible_at visibility_timeout seconds ahead while this lease still holds the job, committing the session; returns whether it did."""
+    extended = Job.query.filter_by(id=self.id, lease=self.lease).update({'visible_at': datetime.utcnow() + timedelta(seconds=visibility_timeout)}, synchronize_session=False)
+    db.session.commit()
+    return extended > 0
+
+  def complete(self):
+    Job.query.filter_by(id=self.id, lease=self.lease).delete(synchronize_session=False)
+
+  def fail(self, error, retry_delay):
+    """Makes the job visible again after retry_delay * 2 ** (attempts - 1) seconds, or marks it failed after max_attempts."""
+    changes = {'lease': None, 'last_error': error}
+    if self.attempts >= self.max_attempts:
+      changes['status'] = 'failed'
+    else:
+      changes['visible_at'] = datetime.utcnow() + timedelta(seconds=retry_delay * 2 ** (self.attempts - 1))
+    Job.query.filter_by(id=self.id, lease=self.lease).update(changes, synchronize_session=False)
+
+  def __repr__(self):
+    return f"<Job {self.id} {self.task}>"
@@ -0,0 +1,91 @@
+from decimal import Decimal
+import numpy as np
+from app import db
+from nutritionix import nutrient_categories
+
+class NutrientVector():
+  """Nutrient amounts of one or many foods or carts, stored as int64 fixed-point hundredths.
+
+  The last axis is ordered like nutrient_categories, so a (9,) array holds one food or cart and an (n, 9) array
+  holds n of them. Sums and comparisons of amounts with 2 decimals are exact integer arithmetic; amounts are only
+  turned back into Decimals (with exactly 2 decimals) by to_decimals, at the presentation edge.
+
+  Parameters:
+    hundredths (array): amounts in hundredths, of shape (9,) or (n, 9).
+
+  """
+  categories = tuple(nutrient_categories)
+
+  def __init__(self, hundredths):
+    self.hundredths = np.asarray(hundredths, dtype=np.int64)
+    if self.hundredths.ndim not in (1, 2) or self.hundredths.shape[-1] != len(self.categories):
+      raise ValueError('expected an array of shape (%d,) or (n, %d)' % (len(self.categories), len(self.categories)))
+
+  @classmethod
+  def from_rows(cls, rows):
+    """Builds an (n, 9) vector from rows of amounts (numbers, Decimals or None for 0), e.g. the rows of columns()."""
+    values = np.array(rows if isinstance(rows, np.ndarray) else [tuple(row) for row in rows], dtype=np.float64).reshape(-1, len(cls.categories))
+    return cls(np.rint(np.nan_to_num(values) * 100))
+
+  @classmethod
+  def from_objects(cls, objects):
+    """Builds an (n, 9) vector from objects with nutrient attributes (FoodItem, Cart, food_info dicts)."""
+    def amounts(obj):
+      if isinstance(obj, dict):
+        return [obj.get(category) for category in cls.categories]
+      return [getattr(obj, category) for category in cls.categories]
+    return cls.from_rows([amounts(obj) for obj in objects])
+
+  @classmethod
+  def zeros(cls, n=None):
+    return cls(np.zeros(len(cls.categories) if n is None else (n, len(cls.categories)), dtype=np.int64))
+
+  @classmethod
+  def columns(cls, model):
+    """Nutrient columns of model read as floats, skipping Decimal conversion of every value."""
+    return [db.type_coerce(getattr(model, category), db.Float()) for category in cls.categories]
+
+  @classmethod
+  def sum_columns(cls, model):
+    """SUM aggregates of the nutrient columns of model read as floats (None when no row is summed)."""
+    return [db.type_coerce(db.func.sum(getattr(model, category)), db.Float()) for category in cls.categories]
+
+  def sum(self):
+    """Returns the total over all rows as a (9,) vector."""
+    return NutrientVector(self.hundredths.reshape(-1, len(self.categories)).sum(axis=0))
+
+  def group_sum(self, keys):
+    """Sums rows sharing a key; returns (sorted unique keys, (len(keys), 9) vector of their totals)."""
+    unique, inverse = np.unique(np.asarray(keys), return_inverse=True)
+    totals = np.zeros((len(unique), len(self.categories)), dtype=np.int64)
+    np.add.at(totals, inverse, self.hundredths)
+    return unique, NutrientVector(totals)
+
+  def scale(self, multiplier):
+    """Returns the amounts multiplied by multiplier (a number or one per row), rounded to hundredths."""
+    multiplier = np.asarray(multiplier, dtype=np.float64)
+    if multiplier.ndim == 1:
+      multiplier = multiplier[:, np.newaxis]
+    return NutrientVector(np.rint(self.hundredths * multiplier))
+
+  def equals(self, other):
+    """Returns whether all nutrients match, per row for (n, 9) vectors."""
+    return (self.hundredths == other.hundredths).all(axis=-1)
+
+  def __add__(self, other):
+    return NutrientVector(self.hundredths + other.hundredths)
+
+  def __sub__(self, other):
+    return NutrientVector(self.hundredths - other.hundredths)
+
+  def __len__(self):
+    return len(self.hundredths) if self.hundredths.ndim == 2 else 1
+
+  def to_decimals(self):
+    """Returns {category: Decimal} for a (9,) vector, or a list of them for an (n, 9) vector."""
+    if self.hundredths.ndim == 2:
+      return [NutrientVector(row).to_decimals() for row in self.hundredths]
+    return {category: Decimal(int(value)).scaleb(-2) for category, value in zip(self.categories, self.hundredths)}
+
+  def __repr__(self):
+    return f"NutrientVector({self.hundredths.tolist()})"
@@ -0,0 +1,100 @@
+import base64, json
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+from app import db
+
+class KeysetPagination():
+  """Cursor based pagination over a query ordered by (sort column, id) descending.
+
+  Instead of OFFSET, every page continues from the (sort value, id) of the last row of the previous page, so each page costs the same index range scan no matter how deep it is. Pages are addressed by opaque next/prev cursor tokens. The total row count is only computed when count is True.
+
+  Parameters:
+    query (Query): query to paginate, without ordering (of one entity, or of columns including id_column).
+    sort_column (Column): column results are ordered by (descending).
+    id_column (Column): unique column used to break ties in sort_column.
+    cursor (str): token of the page to load (None loads the first page).
+    per_page (int): number of items per page.
+    count (bool): whether to also compute the total number of rows.
+
+  """
+
+  def __init__(self, query, sort_column, id_column, cursor=None, per_page=4, count=False):
+    self.per_page = per_page
+    self.total = query.order_by(None).count() if count else None
+
+    direction, key, offset = self.decode_cursor(cursor, sort_column)
+    if key is not None:
+      value, id = key
+      if direction == 'next':
+        query = query.filter(db.or_(sort_column < value, db.and_(sort_column == value, id_column < id)))
+      else:
+        query = query.filter(db.or_(sort_column > value, db.and_(sort_column == value, id_column > id)))
+
+    # walk backwards in ascending order for previous pages and flip the result
+    if direction == 'next':
+      query = query.order_by(sort_column.desc(), id_column.desc())
+    else:
+      query = query.order_by(sort_column.asc(), id_column.asc())
+
+    # read the unrounded sort value, a value rounded by decimal_return_scale would not compare equal to the stored one
+    # (SQLite stores NUMERIC values as REAL, so read those as floats)
+    key_column = sort_column
+    if isinstance(sort_column.type, db.Numeric):
+      if query.session.get_bind().dialect.name == 'sqlite':
+        key_column = db.type_coerce(sort_column, db.Float())
+      else:
+        key_column = db.type_coerce(sort_column, db.Numeric(asdecimal=True))
+    # queries of one entity page over its objects, column (projection) queries over dicts of their columns
+    entity = query.column_descriptions[0]
+    objects = len(query.column_descriptions) == 1 and entity['type'] is entity['entity']
+    rows = query.add_columns(key_column).limit(per_page + 1).all()
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+    if direction == 'prev':
+      rows.reverse()
+    if objects:
+      items = [row[0] for row in rows]
+      keys = [(row[-1], getattr(row[0], id_column.key)) for row in rows]
+    else:
+      items = [dict(zip(row.keys()[:-1], row[:-1])) for row in rows]
+      keys = [(row[-1], item[id_column.key]) for row, item in zip(rows, items)]
+
+    self.items = items
+    self.offset = offset
+    if direction == 'next':
+      self.has_next = more
+      self.has_prev = key is not None
+    else:
+      self.has_next = True
+      self.has_prev = more
+
+    self.next_cursor = self.encode_cursor('next', keys[-1], offset + len(items)) if self.has_next and items else None
+    self.prev_cursor = self.encode_cursor('prev', keys[0], max(offset - per_page, 0)) if self.has_prev and items else None
+
+  @staticmethod
+  def encode_cursor(direction, key, offset):
+    value, id = key
+    if isinstance(value, datetime):
+      value = value.isoformat()
+    elif isinstance(value, Decimal):
+      value = str(value)
+    data = json.dumps([direction, value, id, offset], separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii').rstrip('=')
+
+  @staticmethod
+  def decode_cursor(cursor, sort_column):
+    """Returns (direction, (sort value, id) or None, offset of first item) for a cursor token; invalid tokens load the first page."""
+    if not cursor:
+      return 'next', None, 0
+    try:
+      data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+      direction, value, id, offset = json.loads(data.decode('utf-8'))
+      if sort_column.type.python_type is datetime:
+        value = datetime.fromisoformat(value)
+      elif sort_column.type.python_type is Decimal:
+        value = Decimal(value)
+      if direction not in ('next', 'prev'):
+        raise ValueError(direction)
+      return direction, (value, int(id)), int(offset)
+    except (ValueError, TypeError, InvalidOperation, NotImplementedError):
+      return 'next', None, 0
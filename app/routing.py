@@ -0,0 +1,113 @@
+import time
+from functools import wraps
+from flask import g, session, has_request_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, _EngineConnector, get_state
+from sqlalchemy import event, orm
+from sqlalchemy.sql.expression import Select, CompoundSelect, UpdateBase
+
+REPLICA_BIND = 'replica'
+
+class RoutingSession(SignallingSession):
+  """Session sending the SELECT statements of read-only views to the 'replica' bind and everything else to the primary.
+
+  A request stays on the primary once it has written, and for REPLICA_STICKY_SECONDS afterwards (tracked in the user's
+  session cookie) so users read their own writes before the replica catches up.
+
+  """
+
+  def __init__(self, db, **options):
+    SignallingSession.__init__(self, db, **options)
+    event.listen(self, 'after_flush', lambda session, context: mark_write())
+
+  def get_bind(self, mapper=None, clause=None):
+    if isinstance(clause, UpdateBase):
+      mark_write()
+    elif isinstance(clause, (Select, CompoundSelect)) and not self._flushing and self.use_replica():
+      return get_state(self.app).db.get_engine(self.app, bind=REPLICA_BIND)
+    return SignallingSession.get_bind(self, mapper, clause)
+
+  def use_replica(self):
+    if not has_request_context() or g.get('db_route') != REPLICA_BIND or g.get('db_wrote'):
+      return False
+    if REPLICA_BIND not in (self.app.config.get('SQLALCHEMY_BINDS') or {}):
+      return False
+    return time.time() - session.get('db_write_at', 0) >= self.app.config['REPLICA_STICKY_SECONDS']
+
+class BindEngineConnector(_EngineConnector):
+  """Engine connector configuring every engine from its own bind's settings.
+
+  Binds take their create_engine options from SQLALCHEMY_BIND_ENGINE_OPTIONS[bind] instead of the primary's
+  SQLALCHEMY_ENGINE_OPTIONS (a SQLite replica rejects the pool sizes of a server primary), and SQLALCHEMY_ON_CONNECT
+  is listened to on the app's own engines only, not on every engine of the process.
+
+  """
+
+  def __init__(self, sa, app, bind=None):
+    _EngineConnector.__init__(self, sa, app, bind)
+    self._hooked = None
+
+  def get_engine(self):
+    engine = _EngineConnector.get_engine(self)
+    if engine is not self._hooked:
+      self._hooked = engine
+      on_connect = self._app.config.get('SQLALCHEMY_ON_CONNECT')
+      if on_connect is not None:
+        event.listen(engine, 'connect', on_connect)
+    return engine
+
+  def get_options(self, sa_url, echo):
+    if self._bind is None:
+      return _EngineConnector.get_options(self, sa_url, echo)
+    options = {}
+    self._sa.apply_pool_defaults(self._app, options)
+    self._sa.apply_driver_hacks(self._app, sa_url, options)
+    if echo:
+      options['echo'] = echo
+    options.update((self._app.config.get('SQLALCHEMY_BIND_ENGINE_OPTIONS') or {}).get(self._bind, {}))
+    options.update(self._sa._engine_options)
+    return options
+
+class RoutingSQLAlchemy(SQLAlchemy):
+  def create_session(self, options):
+    return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+  def make_connector(self, app=None, bind=None):
+    return BindEngineConnector(self, self.get_app(app), bind)
+
+  def init_app(self, app):
+    SQLAlchemy.init_app(self, app)
+    app.config.setdefault('REPLICA_STICKY_SECONDS', 5)
+
+    # g lives on the app context, which may outlive a single request
+    @app.before_request
+    def reset_route():
+      g.pop('db_route', None)
+      g.pop('db_wrote', None)
+
+    @app.after_request
+    def remember_write(response):
+      # start the read-your-writes window once the request has written
+      if g.get('db_wrote'):
+        session['db_write_at'] = time.time()
+      return response
+
+def mark_write():
+  if has_request_context():
+    g.db_wrote = True
+
+def read_only(f):
+  """Routes the SELECT statements of a view to the replica bind (when one is configured)."""
+  @wraps(f)
+  def decorated_function(*args, **kwargs):
+    if g.get('db_route') is None:
+      g.db_route = REPLICA_BIND
+    return f(*args, **kwargs)
+  return decorated_function
+
+def use_primary(f):
+  """Keeps every statement of a view on the primary, overriding read_only."""
+  @wraps(f)
+  def decorated_function(*args, **kwargs):
+    g.db_route = 'primary'
+    return f(*args, **kwargs)
+  return decorated_function
@@ -0,0 +1,74 @@
+# Benchmark of cart listing queries with and without the composite indexes added in migration 3f9c2a7d1b64
+#
+# Usage: python benchmarks/cart_indexes.py [--users N] [--carts N] [--foods N] [--follows N]
+
+import os, sys, time, random, sqlite3, argparse, tempfile
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from sqlalchemy import create_engine
+from app import db
+from app.models import User, Follow, Cart, FoodItem
+from nutritionix import nutrient_categories
+
+new_indexes = ['ix_carts_user_id_' + column for column in ['timestamp'] + nutrient_categories] + ['ix_food_items_cart_id', 'ix_follows_followed_id']
+
+# queries issued by carts.list, carts.followed_carts, carts.cart and the follow counts in carts/list.html
+queries = {
+  'carts.list (timestamp)': 'SELECT * FROM carts WHERE carts.user_id = :user_id ORDER BY carts.timestamp DESC LIMIT 4',
+  'carts.list (nf_protein)': 'SELECT * FROM carts WHERE carts.user_id = :user_id ORDER BY carts.nf_protein DESC LIMIT 4',
+  'carts.followed_carts': 'SELECT carts.* FROM carts JOIN follows ON follows.followed_id = carts.user_id WHERE follows.follower_id = :user_id ORDER BY carts.timestamp DESC LIMIT 4',
+  'carts.cart (foods)': 'SELECT * FROM food_items WHERE food_items.cart_id = :cart_id',
+  'followers count': 'SELECT count(*) FROM follows WHERE follows.followed_id = :user_id'
+}
+
+def seed(path, users, carts, foods, follows):
+  engine = create_engine('sqlite:///' + path)
+  db.metadata.create_all(engine, tables=[User.__table__, Follow.__table__, Cart.__table__, FoodItem.__table__])
+  engine.dispose()
+
+  rng = random.Random(0)
+  conn = sqlite3.connect(path)
+  conn.executemany('INSERT INTO users (id, username, email) VALUES (?, ?, ?)', ((i, 'user%d' % i, 'user%d@test.com' % i) for i in range(1, users + 1)))
+  conn.executemany('INSERT OR IGNORE INTO follows (follower_id, followed_id, timestamp) VALUES (?, ?, ?)', ((i, rng.randint(1, users), '2020-01-01 00:00:00') for i in range(1, users + 1) for j in range(follows)))
+  cart_columns = ', '.join(nutrient_categories)
+  conn.executemany('INSERT INTO carts (id, user_id, timestamp, %s) VALUES (?, ?, ?, %s)' % (cart_columns, ', '.join('?' * len(nutrient_categories))),
+    ((i, rng.randint(1, users), '2020-%02d-%02d %02d:%02d:%02d.%06d' % (rng.randint(1, 12), rng.randint(1, 28), rng.randint(0, 23), rng.randint(0, 59), rng.randint(0, 59), i % 1000000)) + tuple(rng.uniform(0, 2000) for c in nutrient_categories) for i in range(1, carts + 1)))
+  conn.executemany('INSERT INTO food_items (name, cart_id, %s) VALUES (?, ?, %s)' % (cart_columns, ', '.join('?' * len(nutrient_categories))),
+    (('food', rng.randint(1, carts)) + tuple(rng.uniform(0, 200) for c in nutrient_categories) for i in range(carts * foods)))
+  conn.commit()
+  return conn
+
+def run(conn, label, users, carts, repeat):
+  rng = random.Random(1)
+  print('\n== %s ==' % label)
+  for name, sql in queries.items():
+    params = [{'user_id': rng.randint(1, users), 'cart_id': rng.randint(1, carts)} for i in range(repeat)]
+    plan = ' | '.join(row[-1] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params[0]))
+    start = time.perf_counter()
+    for p in params:
+      conn.execute(sql, p).fetchall()
+    elapsed = (time.perf_counter() - start) / repeat * 1000
+    print('%-26s %9.3f ms   %s' % (name, elapsed, plan))
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--users', type=int, default=2000)
+  parser.add_argument('--carts', type=int, default=200000)
+  parser.add_argument('--foods', type=int, default=5, help='foods per cart')
+  parser.add_argument('--follows', type=int, default=50, help='follows per user')
+  parser.add_argument('--repeat', type=int, default=200)
+  args = parser.parse_args()
+
+  with tempfile.TemporaryDirectory() as tmpdir:
+    conn = seed(os.path.join(tmpdir, 'bench.sqlite'), args.users, args.carts, args.foods, args.follows)
+    for index in new_indexes:
+      conn.execute('DROP INDEX %s' % index)
+    conn.execute('ANALYZE')
+    run(conn, 'without composite indexes', args.users, args.carts, args.repeat)
+
+    for index in db.metadata.tables['carts'].indexes | db.metadata.tables['food_items'].indexes | db.metadata.tables['follows'].indexes:
+      if index.name in new_indexes:
+        conn.execute('CREATE INDEX %s ON %s (%s)' % (index.name, index.table.name, ', '.join(column.name for column in index.columns)))
+    conn.execute('ANALYZE')
+    run(conn, 'with composite indexes', args.users, args.carts, args.repeat)
+    conn.close()
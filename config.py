@@ -1,9 +1,74 @@
-import os 
+import os, sqlite3
 basedir = os.path.abspath(os.path.dirname(__file__))
 
+def engine_options(database_uri):
+  """SQLAlchemy create_engine options for database_uri, tuned from DATABASE_* environment variables."""
+  # drop connections the server closed and recycle them before any idle timeout
+  options = {
+    'pool_pre_ping': os.environ.get('DATABASE_POOL_PRE_PING', '1') != '0',
+    'pool_recycle': int(os.environ.get('DATABASE_POOL_RECYCLE', 1800)),
+  }
+  # SQLite file databases use a NullPool, which takes no size options
+  if not database_uri.startswith('sqlite'):
+    options.update({
+      'pool_size': int(os.environ.get('DATABASE_POOL_SIZE', 10)),
+      'max_overflow': int(os.environ.get('DATABASE_MAX_OVERFLOW', 20)),
+      'pool_timeout': int(os.environ.get('DATABASE_POOL_TIMEOUT', 30)),
+    })
+  return options
+
+def set_sqlite_pragmas(dbapi_connection, connection_record=None):
+  """Connect hook letting several workers share a SQLite file: WAL readers don't block the writer and writers wait instead of failing with 'database is locked'."""
+  if not isinstance(dbapi_connection, sqlite3.Connection):
+    return
+  cursor = dbapi_connection.cursor()
+  cursor.execute('PRAGMA journal_mode=WAL')
+  cursor.execute('PRAGMA synchronous=NORMAL')
+  # negative cache_size is in KiB
+  cursor.execute('PRAGMA cache_size=%d' % int(os.environ.get('SQLITE_CACHE_SIZE', -64000)))
+  cursor.execute('PRAGMA mmap_size=%d' % int(os.environ.get('SQLITE_MMAP_SIZE', 268435456)))
+  cursor.execute('PRAGMA busy_timeout=%d' % int(os.environ.get('SQLITE_BUSY_TIMEOUT', 5000)))
+  cursor.close()
+
 class Config():
   SECRET_KEY = os.environ.get('SECRET_KEY')
   SQLALCHEMY_TRACK_MODIFICATIONS = False
+  # 'offset' (numbered pages) or 'keyset' (cursor pages) for cart feeds
+  CARTS_PAGINATION = os.environ.get('CARTS_PAGINATION', 'offset')
+  # 'pull' (join follows at read time) or 'push' (materialized feed, run 'manage.py rebuild_feed' when switching)
+  FEED_MODE = os.environ.get('FEED_MODE', 'pull')
+  # seconds load_user may serve a cached user snapshot, and so how long other workers may still see a changed or deleted
+  # user (0 disables the identity cache)
+  USER_CACHE_TTL = int(os.environ.get('USER_CACHE_TTL', 30))
+  # seconds a user's reads stay on the primary after they write (read-your-writes while the replica catches up)
+  REPLICA_STICKY_SECONDS = int(os.environ.get('REPLICA_STICKY_SECONDS', 5))
+  # food search: 'local_first' (food catalog, then Nutritionix when it has fewer than FOOD_SEARCH_MIN_RESULTS matches),
+  # 'local_only' (never call the search endpoint) or 'api' (always call Nutritionix, catalog unused)
+  FOOD_SEARCH_POLICY = os.environ.get('FOOD_SEARCH_POLICY', 'local_first')
+  FOOD_SEARCH_MIN_RESULTS = int(os.environ.get('FOOD_SEARCH_MIN_RESULTS', 8))
+  # suggestions kept per prefix by the in-memory food name autocomplete index
+  AUTOCOMPLETE_TOP_K = int(os.environ.get('AUTOCOMPLETE_TOP_K', 10))
+  # largest number of foods foods.add_foods accepts in one request
+  BULK_ADD_MAX_FOODS = int(os.environ.get('BULK_ADD_MAX_FOODS', 50))
+  # foods selected for foods.add_food are kept server side for PENDING_FOOD_TTL seconds, at most PENDING_FOOD_MAX_ROWS of them
+  PENDING_FOOD_TTL = int(os.environ.get('PENDING_FOOD_TTL', 3600))
+  PENDING_FOOD_MAX_ROWS = int(os.environ.get('PENDING_FOOD_MAX_ROWS', 100000))
+  # seconds reverse proxies may serve public cart pages to anonymous viewers without revalidating
+  PAGE_CACHE_MAX_AGE = int(os.environ.get('PAGE_CACHE_MAX_AGE', 60))
+  # default and largest page size of /api/v1 cart lists
+  API_PER_PAGE = int(os.environ.get('API_PER_PAGE', 20))
+  API_MAX_PER_PAGE = int(os.environ.get('API_MAX_PER_PAGE', 100))
+  # 'off' (slow work runs inline) or 'db' (slow work is queued in the jobs table and run by 'manage.py worker')
+  JOB_QUEUE = os.environ.get('JOB_QUEUE', 'off')
+  # seconds a claimed job stays invisible to other workers before it is considered lost and retried
+  JOB_VISIBILITY_TIMEOUT = int(os.environ.get('JOB_VISIBILITY_TIMEOUT', 300))
+  # tries per job, the n-th retry waits JOB_RETRY_DELAY * 2 ** (n - 1) seconds
+  JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 5))
+  JOB_RETRY_DELAY = int(os.environ.get('JOB_RETRY_DELAY', 10))
+  # top results of an upstream food search whose detail records are prefetched by a job (when the job queue is on)
+  FOOD_PREWARM_RESULTS = int(os.environ.get('FOOD_PREWARM_RESULTS', 5))
+  # SQLite file keeping Nutritionix responses across restarts, relative to the instance folder (None keeps them in memory only)
+  NUTRITIONIX_CACHE_PATH = os.environ.get('NUTRITIONIX_CACHE_PATH', 'nutritionix-cache.sqlite')
 
   @staticmethod
   def init_app(app):
@@ -16,10 +81,19 @@ class DevelopmentConfig(Config):
 class TestingConfig(Config):
   TESTING = True
   WTF_CSRF_ENABLED = False
+  USER_CACHE_TTL = 0
+  NUTRITIONIX_CACHE_PATH = None
   SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(basedir,'data-test.sqlite')
 
 class ProductionConfig(Config):
-  SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(basedir,'data.sqlite')
+  SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///' + os.path.join(basedir,'data.sqlite')
+  SQLALCHEMY_ENGINE_OPTIONS = engine_options(SQLALCHEMY_DATABASE_URI)
+  # SELECTs of read_only views go to the replica when one is configured; it may be another kind of database than the
+  # primary (e.g. a SQLite copy), so its engine gets options of its own
+  SQLALCHEMY_BINDS = {'replica': os.environ['DATABASE_REPLICA_URL']} if os.environ.get('DATABASE_REPLICA_URL') else None
+  SQLALCHEMY_BIND_ENGINE_OPTIONS = {bind: engine_options(uri) for bind, uri in (SQLALCHEMY_BINDS or {}).items()}
+  # listened to on this app's engines when they connect (only changes SQLite connections)
+  SQLALCHEMY_ON_CONNECT = set_sqlite_pragmas
 
 config = {
   'development' : DevelopmentConfig,
@@ -1,7 +1,8 @@
-import os
+import os, time, json
 from flask_script import Manager
 from flask_migrate import Migrate
-from app import create_app, db
+from app import create_app, db, jobs
+from app.models import Cart, FeedEntry, FoodCatalog
 
 app = create_app('default')
 manager = Manager(app)
@@ -38,5 +39,62 @@ def test(coverage=False):
     print('HTML version: file://%s/index.html'%covdir)
     COV.erase()
 
+@manager.command
+def repair_carts(batch_size=1000):
+  """Recompute Nutrient Totals Of All Carts In The Database"""
+  count = Cart.repair_all_nutrients(batch_size=int(batch_size))
+  db.session.commit()
+  print('Repaired %d carts' % count)
+
+@manager.command
+def verify_carts(repair=False):
+  """Find Carts Whose Nutrient Totals Differ From Their Foods, Optionally Repairing Them"""
+  cart_ids = Cart.verify_all_nutrients()
+  print('Found %d carts with wrong totals' % len(cart_ids))
+  if repair and cart_ids:
+    count = Cart.repair_all_nutrients(cart_ids=cart_ids)
+    db.session.commit()
+    print('Repaired %d carts' % count)
+
+@manager.command
+def rebuild_feed():
+  """Repopulate Materialized Followed Carts Feeds From Follows"""
+  FeedEntry.rebuild()
+  db.session.commit()
+  print('Rebuilt %d feed entries' % FeedEntry.query.count())
+
+@manager.command
+def seed_catalog():
+  """Add Foods Already In Carts To The Local Food Catalog"""
+  count = FoodCatalog.seed_from_food_items()
+  db.session.commit()
+  print('Added %d foods to the catalog' % count)
+
+@manager.command
+def worker(threads=4, poll_interval=1, burst=False):
+  """Run Queued Background Jobs With A Pool Of Worker Threads (With --burst, Run Visible Jobs Once And Exit)"""
+  if burst:
+    print('Ran %d jobs' % jobs.run_pending())
+    return
+  pool = jobs.WorkerPool(app, threads=int(threads), poll_interval=float(poll_interval))
+  pool.start()
+  print('Started %d job workers, press Ctrl+C to stop' % pool.threads)
+  try:
+    while True:
+      time.sleep(1)
+  except KeyboardInterrupt:
+    pool.stop()
+
+@manager.command
+def enqueue(task, args='[]', dedup_key=None):
+  """Queue A Background Job, e.g. 'enqueue repair_carts' or 'enqueue refresh_foods --args [7,100]'"""
+  # the same task with the same arguments is only queued once unless another dedup key is given
+  added = jobs.enqueue(task, *json.loads(args), dedup_key=dedup_key or '%s:%s' % (task, args))
+  db.session.commit()
+  if app.config['JOB_QUEUE'] != 'db':
+    print('Ran %s (job queue is off)' % task)
+  else:
+    print('Queued %s' % task if added else '%s is already queued' % task)
+
 if __name__ == '__main__':
   manager.run()
\ No newline at end of file
@@ -0,0 +1,32 @@
+"""Add composite indexes for cart sorting and the follow feed
+
+Revision ID: 3f9c2a7d1b64
+Revises: 20879de4b2f2
+Create Date: 2026-10-18 10:12:31.402118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f9c2a7d1b64'
+down_revision = '20879de4b2f2'
+branch_labels = None
+depends_on = None
+
+cart_sort_columns = ['timestamp', 'nf_calories', 'nf_total_fat', 'nf_saturated_fat', 'nf_cholesterol', 'nf_sodium', 'nf_total_carbohydrate', 'nf_dietary_fiber', 'nf_sugars', 'nf_protein']
+
+
+def upgrade():
+    for column in cart_sort_columns:
+        op.create_index('ix_carts_user_id_' + column, 'carts', ['user_id', column], unique=False)
+    op.create_index(op.f('ix_food_items_cart_id'), 'food_items', ['cart_id'], unique=False)
+    op.create_index(op.f('ix_follows_followed_id'), 'follows', ['followed_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_follows_followed_id'), table_name='follows')
+    op.drop_index(op.f('ix_food_items_cart_id'), table_name='food_items')
+    for column in reversed(cart_sort_columns):
+        op.drop_index('ix_carts_user_id_' + column, table_name='carts')
@@ -1,6 +1,16 @@
 # Functions to interact with Nutritionix API for nutrition information retrieval
 
-import os, requests 
+import os, copy, json, time, sqlite3, hashlib, asyncio, threading, aiohttp, requests
+from collections import OrderedDict
+from contextlib import contextmanager
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# file locks used to coalesce requests across processes are only available on POSIX
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
 
 headers = {
   'x-app-id' : os.environ.get('X_APP_ID'),
@@ -18,6 +28,514 @@ url_search_instant = "https://trackapi.nutritionix.com/v2/search/instant"
 url_natural_nutrients = "https://trackapi.nutritionix.com/v2/natural/nutrients"
 url_search_item = "https://trackapi.nutritionix.com/v2/search/item"
 
+class ResponseCache():
+  """Two-tier cache for Nutritionix API responses.
+
+  Responses are kept as JSON strings in an in-process LRU tier backed by an on-disk SQLite tier, so repeated lookups of the same food skip the network (and survive restarts). Every entry expires after ttl seconds. Values are decoded on every read so callers may freely mutate what they get back.
+
+  Parameters:
+    path (str): location of the SQLite file for the disk tier (falsy disables the disk tier).
+    ttl (int): seconds an entry stays valid.
+    maxsize (int): maximum number of entries held in memory.
+    max_disk_entries (int): maximum number of entries held on disk, oldest entries are evicted first.
+
+  """
+
+  def __init__(self, path=None, ttl=86400, maxsize=512, max_disk_entries=50000):
+    self.path = path
+    self.ttl = ttl
+    self.maxsize = maxsize
+    self.max_disk_entries = max_disk_entries
+    self.hits = 0
+    self.disk_hits = 0
+    self.misses = 0
+    self._memory = OrderedDict()
+    self._lock = threading.Lock()
+    self._local = threading.local()
+    self._writes = 0
+
+  def set_path(self, path):
+    """Moves the disk tier to path (falsy disables it); every thread reconnects on its next access."""
+    self.path = path
+    self._local = threading.local()
+
+  def get(self, key):
+    """Returns the cached value for key, or None on a miss or expired entry."""
+    now = time.time()
+    with self._lock:
+      entry = self._memory.get(key)
+      if entry is not None:
+        if entry[0] > now:
+          self._memory.move_to_end(key)
+          self.hits += 1
+          return json.loads(entry[1])
+        del self._memory[key]
+
+    row = None
+    conn = self._connection()
+    if conn is not None:
+      row = conn.execute('SELECT value, expires_at FROM responses WHERE key = ?', (key,)).fetchone()
+
+    with self._lock:
+      if row is None or row[1] <= now:
+        self.misses += 1
+        return None
+      self.disk_hits += 1
+      self._remember(key, row[1], row[0])
+    return json.loads(row[0])
+
+  def set(self, key, value):
+    """Stores a JSON serializable value under key in both tiers."""
+    expires_at = time.time() + self.ttl
+    data = json.dumps(value)
+    with self._lock:
+      self._remember(key, expires_at, data)
+      self._writes += 1
+      prune = self._writes % 100 == 0
+
+    conn = self._connection()
+    if conn is not None:
+      with conn:
+        conn.execute('INSERT OR REPLACE INTO responses (key, value, expires_at) VALUES (?, ?, ?)', (key, data, expires_at))
+      if prune:
+        self.prune()
+
+  def delete(self, key):
+    with self._lock:
+      self._memory.pop(key, None)
+    conn = self._connection()
+    if conn is not None:
+      with conn:
+        conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+
+  def clear(self):
+    with self._lock:
+      self._memory.clear()
+      self.hits = self.disk_hits = self.misses = 0
+    conn = self._connection()
+    if conn is not None:
+      with conn:
+        conn.execute('DELETE FROM responses')
+
+  def prune(self):
+    """Drops expired disk entries and evicts the oldest ones beyond max_disk_entries."""
+    conn = self._connection()
+    if conn is None:
+      return
+    with conn:
+      conn.execute('DELETE FROM responses WHERE expires_at <= ?', (time.time(),))
+      conn.execute('DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY expires_at DESC LIMIT -1 OFFSET ?)', (self.max_disk_entries,))
+
+  def stats(self):
+    with self._lock:
+      return {
+        'hits': self.hits,
+        'disk_hits': self.disk_hits,
+        'misses': self.misses,
+        'size': len(self._memory)
+      }
+
+  # keep entry in memory tier, evicting least recently used entries (caller holds lock)
+  def _remember(self, key, expires_at, data):
+    self._memory[key] = (expires_at, data)
+    self._memory.move_to_end(key)
+    while len(self._memory) > self.maxsize:
+      self._memory.popitem(last=False)
+
+  # sqlite connections cannot be shared across threads, so open one per thread
+  def _connection(self):
+    if not self.path:
+      return None
+    conn = getattr(self._local, 'conn', None)
+    if conn is None:
+      conn = sqlite3.connect(self.path, timeout=30)
+      conn.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)')
+      conn.execute('CREATE INDEX IF NOT EXISTS ix_responses_expires_at ON responses (expires_at)')
+      self._local.conn = conn
+    return conn
+
+def normalize_query(query):
+  """Normalizes a query so that differently cased or spaced queries share a cache entry."""
+  return ' '.join(str(query).lower().split())
+
+# memory only until an app gives it a disk tier (create_app, NUTRITIONIX_CACHE_PATH), so importing touches no files
+cache = ResponseCache(
+  path=None,
+  ttl=int(os.environ.get('NUTRITIONIX_CACHE_TTL', 86400)),
+  maxsize=int(os.environ.get('NUTRITIONIX_CACHE_SIZE', 512))
+)
+
+class SingleFlight():
+  """Coalesces concurrent calls for the same key into a single call.
+
+  The first caller for a key runs the function while every concurrent caller for that key waits for and receives (a copy of) its result, or its exception. When lock_dir is given, the call additionally holds an exclusive lock file per key so that processes on the same machine take turns as well; together with a shared disk cache this means only the first process goes upstream.
+
+  Parameters:
+    lock_dir (str): directory for per-key lock files (falsy coalesces within the process only).
+
+  """
+
+  def __init__(self, lock_dir=None):
+    self.lock_dir = lock_dir
+    self.shared = 0
+    self._lock = threading.Lock()
+    self._calls = {}
+    if lock_dir:
+      os.makedirs(lock_dir, exist_ok=True)
+
+  def do(self, key, fn):
+    """Runs fn() once for all concurrent callers of key and returns its result."""
+    with self._lock:
+      call = self._calls.get(key)
+      leader = call is None
+      if leader:
+        call = self._calls[key] = _Call()
+      else:
+        self.shared += 1
+
+    if not leader:
+      call.done.wait()
+      if call.error is not None:
+        raise call.error
+      return copy.deepcopy(call.result)
+
+    try:
+      with self._process_lock(key):
+        call.result = fn()
+      return call.result
+    except Exception as e:
+      call.error = e
+      raise
+    finally:
+      with self._lock:
+        del self._calls[key]
+      call.done.set()
+
+  @contextmanager
+  def _process_lock(self, key):
+    if not self.lock_dir or fcntl is None:
+      yield
+      return
+    name = hashlib.sha1(key.encode('utf-8')).hexdigest() + '.lock'
+    with open(os.path.join(self.lock_dir, name), 'a') as lock_file:
+      fcntl.flock(lock_file, fcntl.LOCK_EX)
+      try:
+        yield
+      finally:
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+class _Call():
+  def __init__(self):
+    self.done = threading.Event()
+    self.result = None
+    self.error = None
+
+class NutritionixClient():
+  """Client for the Nutritionix API that reuses pooled keep-alive connections.
+
+  Requests go through a single requests.Session so TCP/TLS connections to trackapi.nutritionix.com are reused between calls. Every request is bounded by connect/read timeouts, and 429/5xx responses are retried with exponential backoff. Responses are looked up in and stored to the given ResponseCache.
+
+  Parameters:
+    headers (dict): authentication headers sent with every request.
+    cache (ResponseCache): cache consulted before hitting the network (None disables caching).
+    singleflight (SingleFlight): coalesces identical concurrent requests (None disables coalescing).
+    pool_size (int): maximum number of pooled connections.
+    connect_timeout (float): seconds to wait for a connection to be established.
+    read_timeout (float): seconds to wait for the server to send a response.
+    retries (int): maximum number of retries of connection errors and 429/5xx responses (read timeouts are not retried).
+    backoff_factor (float): base delay between retries, doubled on every attempt.
+
+  """
+
+  retry_statuses = (429, 500, 502, 503, 504)
+
+  def __init__(self, headers=headers, cache=None, singleflight=None, pool_size=10, connect_timeout=3.05, read_timeout=10, retries=3, backoff_factor=0.5):
+    self.cache = cache
+    self.singleflight = singleflight
+    self.timeout = (connect_timeout, read_timeout)
+    self.session = requests.Session()
+    self.session.headers.update(headers)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=self._retry(retries, backoff_factor))
+    self.session.mount('https://', adapter)
+    self.session.mount('http://', adapter)
+
+  def search_item(self, food_name):
+    """Retrieves basic food information for foods related to query from the search/instant endpoint."""
+    def fetch():
+      body = {
+            "query":food_name,
+      }
+
+      response = self.session.get(url_search_instant,params=body,timeout=self.timeout)
+      return response.json(), response.ok
+
+    return self._fetch('search:' + normalize_query(food_name), fetch)
+
+  def get_common_nutrients(self, food_name):
+    """Retrieves nutrition information for common foods from the natural/nutrients endpoint."""
+    def fetch():
+      body = {
+              "query":food_name,
+      }
+
+      response = self.session.post(url_natural_nutrients,data=body,timeout=self.timeout)
+      nutrients = self._first_food(response)
+      return nutrients, nutrients is not None
+
+    return self._fetch('common:' + normalize_query(food_name), fetch)
+
+  def get_branded_nutrients(self, nix_item_id):
+    """Retrieves nutrition information for branded foods from the search/item endpoint."""
+    def fetch():
+      body = {
+          "nix_item_id":nix_item_id,
+      }
+
+      response = self.session.get(url_search_item,params=body,timeout=self.timeout)
+      nutrients = self._first_food(response)
+      return nutrients, nutrients is not None
+
+    return self._fetch('branded:' + str(nix_item_id).strip(), fetch)
+
+  def close(self):
+    self.session.close()
+
+  def _cached(self, key):
+    if self.cache is None:
+      return None
+    return self.cache.get(key)
+
+  def _store(self, key, value):
+    if self.cache is not None:
+      self.cache.set(key, value)
+
+  # fetch() returns (value, cacheable); concurrent misses for the same key share a single fetch
+  def _fetch(self, key, fetch):
+    value = self._cached(key)
+    if value is not None:
+      return value
+
+    def load():
+      # another thread or process may have filled the cache while we waited for the flight
+      value = self._cached(key)
+      if value is not None:
+        return value
+      value, cacheable = fetch()
+      if cacheable:
+        self._store(key, value)
+      return value
+
+    if self.singleflight is None:
+      return load()
+    return self.singleflight.do(key, load)
+
+  # catch errors resulting from empty, incorrect or non JSON responses
+  @staticmethod
+  def _first_food(response):
+    try:
+      return response.json()['foods'][0]
+    except (KeyError, IndexError, ValueError):
+      return None
+
+  # urllib3 renamed method_whitelist to allowed_methods in 1.26; read timeouts are not retried (read=0), since a server
+  # that is slow to answer would hold the worker for read_timeout on every attempt
+  def _retry(self, retries, backoff_factor):
+    options = {
+      'total': retries,
+      'read': 0,
+      'backoff_factor': backoff_factor,
+      'status_forcelist': self.retry_statuses,
+      'raise_on_status': False
+    }
+    try:
+      return Retry(allowed_methods=frozenset(['GET', 'POST']), **options)
+    except TypeError:
+      return Retry(method_whitelist=frozenset(['GET', 'POST']), **options)
+
+singleflight = SingleFlight(lock_dir=os.environ.get('NUTRITIONIX_LOCK_DIR'))
+
+# worst case for a request that never gets an answer: retries + 1 connect timeouts, the backoff sleeps and one read
+# timeout, about 4 * 3.05 + 3 + 10 = 25s with the defaults
+client = NutritionixClient(
+  cache=cache,
+  singleflight=singleflight,
+  pool_size=int(os.environ.get('NUTRITIONIX_POOL_SIZE', 10)),
+  connect_timeout=float(os.environ.get('NUTRITIONIX_CONNECT_TIMEOUT', 3.05)),
+  read_timeout=float(os.environ.get('NUTRITIONIX_READ_TIMEOUT', 10)),
+  retries=int(os.environ.get('NUTRITIONIX_RETRIES', 3))
+)
+
+class AsyncNutritionixClient():
+  """asyncio counterpart of NutritionixClient built on aiohttp.
+
+  Shares the retry policy and cache of the sync client, and adds gather_nutrients to fetch nutrition information for many foods concurrently. The underlying aiohttp session is created lazily inside the running event loop, so the client should be used as an async context manager (or closed with close()).
+
+  Parameters:
+    headers (dict): authentication headers sent with every request.
+    cache (ResponseCache): cache consulted before hitting the network (None disables caching).
+    pool_size (int): maximum number of simultaneous connections.
+    connect_timeout (float): seconds to wait for a connection to be established.
+    read_timeout (float): seconds to wait for the server to send data.
+    retries (int): maximum number of retries of connection errors and 429/5xx responses (read timeouts are not retried).
+    backoff_factor (float): base delay between retries, doubled on every attempt.
+
+  """
+
+  retry_statuses = NutritionixClient.retry_statuses
+
+  def __init__(self, headers=headers, cache=None, pool_size=10, connect_timeout=3.05, read_timeout=10, retries=3, backoff_factor=0.5):
+    self.headers = {key: value for key, value in headers.items() if value is not None}
+    self.cache = cache
+    self.pool_size = pool_size
+    self.connect_timeout = connect_timeout
+    self.read_timeout = read_timeout
+    self.retries = retries
+    self.backoff_factor = backoff_factor
+    self._session = None
+
+  async def __aenter__(self):
+    return self
+
+  async def __aexit__(self, *args):
+    await self.close()
+
+  async def search_item(self, food_name):
+    """Retrieves basic food information for foods related to query from the search/instant endpoint."""
+    key = 'search:' + normalize_query(food_name)
+    data = self._cached(key)
+    if data is not None:
+      return data
+
+    status, data = await self._request('GET', url_search_instant, params={"query":food_name})
+    if status < 400 and data is not None:
+      self._store(key, data)
+    return data
+
+  async def get_common_nutrients(self, food_name):
+    """Retrieves nutrition information for common foods from the natural/nutrients endpoint."""
+    key = 'common:' + normalize_query(food_name)
+    nutrients = self._cached(key)
+    if nutrients is not None:
+      return nutrients
+
+    status, data = await self._request('POST', url_natural_nutrients, data={"query":food_name})
+    nutrients = self._first_food(data)
+    if nutrients is not None:
+      self._store(key, nutrients)
+    return nutrients
+
+  async def get_branded_nutrients(self, nix_item_id):
+    """Retrieves nutrition information for branded foods from the search/item endpoint."""
+    key = 'branded:' + str(nix_item_id).strip()
+    nutrients = self._cached(key)
+    if nutrients is not None:
+      return nutrients
+
+    status, data = await self._request('GET', url_search_item, params={"nix_item_id":nix_item_id})
+    nutrients = self._first_food(data)
+    if nutrients is not None:
+      self._store(key, nutrients)
+    return nutrients
+
+  async def gather_nutrients(self, refs, concurrency=10):
+    """Retrieves nutrition information for many foods concurrently.
+
+    Parameters:
+      refs (list): (kind, value) pairs, a common food name for kind 'common' or a nix_item_id for kind 'branded'.
+      concurrency (int): maximum number of requests in flight at once.
+
+    Returns:
+      list: nutrition information for every entry in the order given, None for foods that could not be retrieved.
+
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    flights = {}
+
+    async def fetch(kind, value):
+      async with semaphore:
+        try:
+          if kind == 'branded':
+            return await self.get_branded_nutrients(value)
+          return await self.get_common_nutrients(value)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+          return None
+
+    # duplicate entries share one request, but every entry gets its own copy of the result
+    keys = [(kind, normalize_query(value)) for kind, value in refs]
+    for key, (kind, value) in zip(keys, refs):
+      if key not in flights:
+        flights[key] = asyncio.ensure_future(fetch(kind, value))
+    await asyncio.gather(*flights.values())
+    return [copy.deepcopy(flights[key].result()) for key in keys]
+
+  async def close(self):
+    if self._session is not None:
+      await self._session.close()
+      self._session = None
+
+  def _cached(self, key):
+    if self.cache is None:
+      return None
+    return self.cache.get(key)
+
+  def _store(self, key, value):
+    if self.cache is not None:
+      self.cache.set(key, value)
+
+  @staticmethod
+  def _first_food(data):
+    try:
+      return data['foods'][0]
+    except (KeyError, IndexError, TypeError):
+      return None
+
+  def _get_session(self):
+    if self._session is None:
+      self._session = aiohttp.ClientSession(
+        headers=self.headers,
+        connector=aiohttp.TCPConnector(limit=self.pool_size),
+        timeout=aiohttp.ClientTimeout(connect=self.connect_timeout, sock_read=self.read_timeout)
+      )
+    return self._session
+
+  # returns (status, decoded JSON or None), retrying 429/5xx responses and connection errors with backoff
+  async def _request(self, method, url, **kwargs):
+    session = self._get_session()
+    attempt = 0
+    while True:
+      try:
+        async with session.request(method, url, **kwargs) as response:
+          if response.status not in self.retry_statuses or attempt >= self.retries:
+            try:
+              return response.status, await response.json(content_type=None)
+            except ValueError:
+              return response.status, None
+      except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+        if attempt >= self.retries:
+          raise
+      await asyncio.sleep(self.backoff_factor * (2 ** attempt))
+      attempt += 1
+
+def gather_nutrients(refs, concurrency=10):
+  """Retrieves nutrition information for many foods concurrently from synchronous code.
+
+  Runs AsyncNutritionixClient.gather_nutrients in a fresh event loop, sharing the module-level cache and client settings.
+
+  Parameters:
+    refs (list): (kind, value) pairs, a common food name for kind 'common' or a nix_item_id for kind 'branded'.
+    concurrency (int): maximum number of requests in flight at once.
+
+  Returns:
+    list: nutrition information for every entry in the order given, None for foods that could not be retrieved.
+
+  """
+
+  async def run():
+    async with AsyncNutritionixClient(cache=cache, pool_size=max(concurrency, 1), connect_timeout=client.timeout[0], read_timeout=client.timeout[1]) as async_client:
+      return await async_client.gather_nutrients(refs, concurrency)
+
+  return asyncio.run(run())
+
 def search_item(food_name):
   """Retrieves basic food information for foods related to query.
 
@@ -31,12 +549,7 @@ def search_item(food_name):
 
   """
 
-  body = {
-        "query":food_name,
-  }
-
-  response = requests.get(url_search_instant,headers=headers,params=body)
-  return response.json()
+  return client.search_item(food_name)
 
 def get_common_nutrients(food_name):
   """Retrieves nutrition information for common foods. 
@@ -51,19 +564,7 @@ def get_common_nutrients(food_name):
 
   """
 
-  body = {
-          "query":food_name,
-  }
-
-  response = requests.post(url_natural_nutrients,headers=headers,data=body)
-
-  # catch KeyError resulting from empty or incorrect response
-  try:
-    nutrients = response.json()['foods'][0]
-  except KeyError:
-    nutrients = None
-
-  return nutrients
+  return client.get_common_nutrients(food_name)
 
 def get_branded_nutrients(nix_item_id):
   """Retrieves nutrition information for branded foods. 
@@ -77,17 +578,8 @@ def get_branded_nutrients(nix_item_id):
     dict: Contains nutrition information (e.g. calories) with specific nutrients as keys and their respective amounts as values
 
   """
-  body = {
-      "nix_item_id":nix_item_id,
-  }
-  response = requests.get(url_search_item,headers=headers,params=body)
-  # catch KeyError resulting from empty or incorrect response
-  try:
-    nutrients = response.json()['foods'][0]
-  except KeyError:
-    nutrients = None
-
-  return nutrients
+
+  return client.get_branded_nutrients(nix_item_id)
 
 # Contains nutrient categories to display
 nutrient_categories = ['nf_calories', 'nf_total_fat',
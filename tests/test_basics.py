@@ -1,6 +1,7 @@
-import unittest
+import os, sqlite3, tempfile, unittest
 from flask import current_app
 from app import create_app, db
+from config import engine_options, set_sqlite_pragmas
 
 class BasicsTestCase(unittest.TestCase):
   def setUp(self):
@@ -18,4 +19,48 @@ class BasicsTestCase(unittest.TestCase):
     self.assertFalse(current_app is None)
   
   def test_app_is_testing(self):
-    self.assertTrue(current_app.config['TESTING'])
\ No newline at end of file
+    self.assertTrue(current_app.config['TESTING'])
+
+class ProductionConfigTestCase(unittest.TestCase):
+  def test_engine_options(self):
+    options = engine_options('postgresql://nutri@localhost/nutricart')
+    self.assertTrue(options['pool_pre_ping'])
+    self.assertIn('pool_recycle', options)
+    self.assertIn('pool_size', options)
+    self.assertIn('max_overflow', options)
+
+    # NullPool backed SQLite engines reject pool sizing
+    options = engine_options('sqlite:///data.sqlite')
+    self.assertNotIn('pool_size', options)
+    self.assertNotIn('max_overflow', options)
+
+  def test_sqlite_pragmas(self):
+    with tempfile.TemporaryDirectory() as tmp:
+      conn = sqlite3.connect(os.path.join(tmp, 'data.sqlite'))
+      set_sqlite_pragmas(conn)
+      self.assertEqual(conn.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+      self.assertEqual(conn.execute('PRAGMA synchronous').fetchone()[0], 1)
+      self.assertEqual(conn.execute('PRAGMA busy_timeout').fetchone()[0], 5000)
+      conn.close()
+
+  def test_bind_engine_options(self):
+    with tempfile.TemporaryDirectory() as tmp:
+      app = create_app('testing')
+      app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options('postgresql://nutri@localhost/nutricart')
+      app.config['SQLALCHEMY_BINDS'] = {'replica': 'sqlite:///' + os.path.join(tmp, 'replica.sqlite')}
+      app.config['SQLALCHEMY_BIND_ENGINE_OPTIONS'] = {'replica': engine_options(app.config['SQLALCHEMY_BINDS']['replica'])}
+      app.config['SQLALCHEMY_ON_CONNECT'] = set_sqlite_pragmas
+      other = create_app('testing')
+      other.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(tmp, 'other.sqlite')
+
+      # a SQLite replica gets its own options (no pool sizing) and the connect hook
+      with app.app_context():
+        replica = db.get_engine(bind='replica')
+        self.assertEqual(replica.execute('PRAGMA journal_mode').scalar(), 'wal')
+        replica.dispose()
+
+      # engines of other apps keep their own settings
+      with other.app_context():
+        engine = db.get_engine()
+        self.assertEqual(engine.execute('PRAGMA journal_mode').scalar(), 'delete')
+        engine.dispose()
@@ -1,13 +1,30 @@
-import unittest
+import os, copy, json, tempfile, unittest
+from unittest import mock
 from datetime import datetime
 from decimal import Decimal
-from flask import url_for
+from flask import url_for, g, session
 from flask_login import current_user
+from flask_sqlalchemy import get_debug_queries
 from app import create_app, db
-from app.foods.views import get_measures_tuple, get_nutrient_multiplier,update_nutrients,clean_food_data,round_food_data,is_in_tuple_list,get_str_serving_unit
-from app.models import User, Cart, FoodItem
+from app.autocomplete import PrefixIndex
+from app.carts.fragments import card_cache
+from app.foods.profile import NutritionProfile, profile_cache
+from app.foods.views import update_food_index, get_measures_tuple, get_nutrient_multiplier,update_nutrients,clean_food_data,round_food_data,is_in_tuple_list,get_str_serving_unit
+from app.jobs import run_pending
+from app.models import User, Cart, FoodItem, FoodCatalog, FeedEntry, Job, PendingFood, identity_cache
+from app.pagination import KeysetPagination
+from app.routing import read_only, use_primary
 from nutritionix import nutrient_categories
 
+# counts queries issued inside a with block (queries are recorded while TESTING is set)
+class QueryCounter():
+  def __enter__(self):
+    self.start = len(get_debug_queries())
+    return self
+
+  def __exit__(self, *args):
+    self.count = len(get_debug_queries()) - self.start
+
 class FlaskClientTestCase(unittest.TestCase):
   def setUp(self):
     self.app = create_app('testing')
@@ -19,6 +36,8 @@ class FlaskClientTestCase(unittest.TestCase):
   def tearDown(self):
     db.session.remove()
     db.drop_all()
+    profile_cache.clear()
+    card_cache.clear()
     self.app_context.pop()
 
 # test class for 'core' blueprint
@@ -67,6 +86,7 @@ class FlaskCoreTestCase(FlaskClientTestCase):
     user2 = User(email='two@two.com',username='two',password='two')
     db.session.add_all([user1,user2])
     db.session.commit()
+    user2.follow(user1)
     
     with self.client:
       self.client.post(url_for('auth.login'), data=
@@ -87,6 +107,8 @@ class FlaskCoreTestCase(FlaskClientTestCase):
       response2 = self.client.get(url_for('core.follow',username='two'),follow_redirects=True)
       data2 = response2.get_data(as_text=True)
       self.assertTrue('You are now following two' in data2)
+      self.assertTrue(url_for('core.unfollow',username='two') in data2)
+      self.assertTrue('Follows you' in data2)
       one = User.query.filter_by(username='one').first()
       two = User.query.filter_by(username='two').first()
       self.assertTrue(one.is_following(two))
@@ -130,6 +152,8 @@ class FlaskCoreTestCase(FlaskClientTestCase):
       response2 = self.client.get(url_for('core.unfollow',username='two'),follow_redirects=True)
       data2 = response2.get_data(as_text=True)
       self.assertTrue('You are no longer following two' in data2)
+      self.assertTrue(url_for('core.follow',username='two') in data2)
+      self.assertFalse('Follows you' in data2)
       self.assertFalse(one.is_following(two))
       self.assertFalse(two.is_followed_by(one))
 
@@ -159,6 +183,177 @@ class FlaskFoodsTestCase(FlaskClientTestCase):
     response3 = self.client.get(url_for('foods.list',food_name='Brownie',filter='notCommonOrBranded'))
     self.assertTrue(response3.status_code == 404)
   
+  def test_foods_local_catalog(self):
+    FoodCatalog.store_search_results({'common': [{'food_name': 'brownie', 'photo': {'thumb': 'brownie.jpg'}}], 'branded': []})
+    FoodCatalog.store_food('common', {'food_name': 'brownie', 'serving_qty': 1, 'serving_unit': 'square', 'serving_weight_grams': 56,
+      'nf_calories': 227.36, 'nf_total_fat': 10.92, 'nf_saturated_fat': 2.74, 'nf_cholesterol': 9.52, 'nf_sodium': 163.52, 'nf_total_carbohydrate': 35.84,
+      'nf_dietary_fiber': 1.23, 'nf_sugars': 20.49, 'nf_protein': 2.69, 'alt_measures': [{'serving_weight': 56, 'measure': 'square', 'qty': 1}],
+      'photo': {'thumb': 'brownie.jpg'}})
+    db.session.commit()
+
+    # search and detail pages are served from the catalog, without calling Nutritionix
+    self.app.config['FOOD_SEARCH_POLICY'] = 'local_only'
+    response1 = self.client.get(url_for('foods.list',food_name='Brownie',filter='common'))
+    self.assertEqual(response1.status_code, 200)
+    self.assertTrue('brownie.jpg' in response1.get_data(as_text=True))
+
+    response2 = self.client.get(url_for('foods.list',food_name='Brownie',filter='branded'))
+    self.assertEqual(response2.status_code, 200)
+    self.assertFalse('brownie.jpg' in response2.get_data(as_text=True))
+
+    self.app.config['FOOD_SEARCH_POLICY'] = 'local_first'
+    self.app.config['FOOD_SEARCH_MIN_RESULTS'] = 1
+    response3 = self.client.get(url_for('foods.list',food_name='brown',filter='common'))
+    self.assertTrue('brownie.jpg' in response3.get_data(as_text=True))
+
+    response4 = self.client.get(url_for('foods.common_food',food_name='Brownie'))
+    self.assertEqual(response4.status_code, 200)
+    self.assertTrue('Calories: 227.36' in response4.get_data(as_text=True))
+
+    # unchanged food pages are answered with 304 before the food is read
+    response5 = self.client.get(url_for('foods.common_food',food_name='Brownie'), headers={'If-None-Match': response4.headers['ETag']})
+    self.assertEqual(response5.status_code, 304)
+    self.assertTrue(response4.cache_control.private)
+
+  def test_foods_search_prewarm(self):
+    # top results of an upstream search are fetched by a job instead of when their page is opened
+    self.app.config['JOB_QUEUE'] = 'db'
+    self.app.config['FOOD_PREWARM_RESULTS'] = 1
+    results = {'common': [{'food_name': 'brownie', 'photo': {'thumb': 'brownie.jpg'}}, {'food_name': 'brown rice', 'photo': {'thumb': 'rice.jpg'}}], 'branded': []}
+    with mock.patch('app.foods.views.search_item',return_value=results):
+      response1 = self.client.get(url_for('foods.list',food_name='Brownie',filter='common'))
+      self.client.get(url_for('foods.list',food_name='brownie ',filter='common'))
+    self.assertTrue('brownie.jpg' in response1.get_data(as_text=True))
+    job = Job.query.one()
+    self.assertEqual((job.task, json.loads(job.args)), ('warm_foods', [[['common', 'brownie']]]))
+
+    brownie = {'food_name': 'brownie', 'serving_qty': 1, 'serving_unit': 'square', 'serving_weight_grams': 56, 'nf_calories': 227.36, 'nf_total_fat': 10.92,
+      'nf_saturated_fat': 2.74, 'nf_cholesterol': 9.52, 'nf_sodium': 163.52, 'nf_total_carbohydrate': 35.84, 'nf_dietary_fiber': 1.23, 'nf_sugars': 20.49,
+      'nf_protein': 2.69, 'alt_measures': None, 'photo': {'thumb': 'brownie.jpg'}}
+    with mock.patch('app.foods.views.gather_nutrients',return_value=[brownie]):
+      self.assertEqual(run_pending(), 1)
+    self.assertEqual(FoodCatalog.lookup('common','brownie')['nf_calories'], 227.36)
+
+  def test_foods_add_food(self):
+    user = User(email='one@one.com',username='one',password='one')
+    cart = Cart()
+    cart.user = user
+    db.session.add_all([user,cart])
+    FoodCatalog.store_food('common', {'food_name':'brownie','serving_qty':1,'serving_unit':'square','serving_weight_grams':56,
+      'nf_calories':227.36,'nf_total_fat':10.92,'nf_saturated_fat':2.74,'nf_cholesterol':9.52,'nf_sodium':163.52,'nf_total_carbohydrate':35.84,
+      'nf_dietary_fiber':1.23,'nf_sugars':20.49,'nf_protein':2.69,'alt_measures':[{'serving_weight':56,'measure':'square','qty':1}],
+      'photo':{'thumb':'brownie.jpg'},'tags':{'item':'brownie'}})
+    db.session.commit()
+
+    with self.client:
+      self.client.post(url_for('auth.login'), data={'email':'one@one.com','password':'one'})
+
+      # nothing selected yet
+      response1 = self.client.get(url_for('foods.add_food'))
+      self.assertEqual(response1.status_code,302)
+
+      # selecting a food twice keeps one server side record, the session only holds its token
+      for qty in ['1.00','2.00']:
+        response2 = self.client.post(url_for('foods.common_food',food_name='brownie',serving_unit='56.00',serving_qty=qty),data={'add':'y'})
+        self.assertEqual(response2.status_code,302)
+      self.assertEqual(PendingFood.query.count(),1)
+      self.assertEqual(set(session.keys()) & {'food_info','serving_unit','serving_qty'},set())
+      self.assertEqual(PendingFood.get(session['pending_food']).serving_qty,Decimal(2))
+
+      response3 = self.client.post(url_for('foods.add_food'),data={'cart_id':str(cart.id)})
+      self.assertEqual(response3.status_code,302)
+      db.session.expire_all()
+      food = cart.foods.first()
+      self.assertEqual((food.name,food.img_url,food.serving_unit,food.serving_qty),('brownie','brownie.jpg','square',Decimal(2)))
+      self.assertEqual(cart.nf_calories,Decimal('454.72'))
+      self.assertEqual(PendingFood.query.count(),0)
+      self.assertFalse('pending_food' in session)
+
+  def test_foods_add_foods(self):
+    user1 = User(email='one@one.com',username='one',password='one')
+    user2 = User(email='two@two.com',username='two',password='two')
+    cart1 = Cart()
+    cart1.user = user1
+    cart2 = Cart()
+    cart2.user = user2
+    db.session.add_all([user1,user2,cart1,cart2])
+    def record(food_name, calories, **extra):
+      return dict({'food_name':food_name,'serving_qty':1,'serving_unit':'serving','serving_weight_grams':100,
+        'nf_calories':calories,'nf_total_fat':1.5,'nf_saturated_fat':0,'nf_cholesterol':0,'nf_sodium':10,'nf_total_carbohydrate':20,
+        'nf_dietary_fiber':0,'nf_sugars':0,'nf_protein':None,'alt_measures':[{'serving_weight':100,'measure':'serving','qty':1},{'serving_weight':50,'measure':'half','qty':1}],
+        'photo':{'thumb':food_name + '.jpg'}}, **extra)
+    FoodCatalog.store_food('common',record('brownie',227.36))
+    db.session.commit()
+
+    with self.client:
+      self.client.post(url_for('auth.login'), data={'email':'one@one.com','password':'one'})
+
+      # catalog foods resolve locally, the others with one concurrent upstream batch
+      nuggets = record('nuggets',100,nix_item_id='513fc9e73fe3ffd40300109f')
+      with mock.patch('app.foods.views.gather_nutrients',return_value=[nuggets]) as gather:
+        response = self.client.post(url_for('foods.add_foods'),json={'cart_id':cart1.id,'foods':[
+          {'food_name':'Brownie'},
+          {'food_name':'brownie','serving_unit':'50.00','serving_qty':3},
+          {'nix_item_id':'513fc9e73fe3ffd40300109f','serving_qty':'0.5'}
+        ]})
+      gather.assert_called_once_with([('branded','513fc9e73fe3ffd40300109f')])
+      self.assertEqual(response.status_code,200)
+      self.assertEqual(response.get_json()['added'],3)
+      self.assertEqual(response.get_json()['totals']['nf_calories'],'618.40')
+
+      db.session.expire_all()
+      self.assertEqual(cart1.foods.count(),3)
+      self.assertEqual([food.serving_unit for food in cart1.foods.order_by(FoodItem.id)],['serving','half','serving'])
+      self.assertEqual(cart1.nf_calories,Decimal('618.40'))
+      self.assertTrue(cart1.verify_nutrients())
+      self.assertEqual(FoodCatalog.query.filter_by(food_name='brownie').first().popularity,2)
+
+      # invalid requests change nothing
+      with mock.patch('app.foods.views.gather_nutrients',return_value=[None]):
+        self.assertEqual(self.client.post(url_for('foods.add_foods'),json={'cart_id':cart1.id,'foods':[{'food_name':'brownie'},{'food_name':'unknown'}]}).status_code,404)
+      self.assertEqual(self.client.post(url_for('foods.add_foods'),json={'cart_id':cart1.id,'foods':[{'food_name':'brownie','serving_unit':'42'}]}).status_code,400)
+      self.assertEqual(self.client.post(url_for('foods.add_foods'),json={'cart_id':cart1.id,'foods':[{'serving_qty':1}]}).status_code,400)
+      self.assertEqual(self.client.post(url_for('foods.add_foods'),json={'cart_id':cart1.id,'foods':[]}).status_code,400)
+      self.assertEqual(self.client.post(url_for('foods.add_foods'),json={'cart_id':cart1.id,'foods':[{'food_name':'brownie'}] * 51}).status_code,400)
+      self.assertEqual(self.client.post(url_for('foods.add_foods'),json={'cart_id':cart2.id,'foods':[{'food_name':'brownie'}]}).status_code,403)
+      self.assertEqual(self.client.post(url_for('foods.add_foods'),json={'cart_id':100,'foods':[{'food_name':'brownie'}]}).status_code,404)
+      for cart_id in [{'a':1},[cart1.id],str(cart1.id),True,None]:
+        response = self.client.post(url_for('foods.add_foods'),json={'cart_id':cart_id,'foods':[{'food_name':'brownie'}]})
+        self.assertEqual(response.status_code,400)
+        self.assertEqual(response.get_json()['error'],'cart_id must be an integer')
+      self.assertEqual(cart1.foods.count(),3)
+
+  def test_foods_autocomplete(self):
+    cart = Cart()
+    for name in ['chicken wings', 'chicken wings', 'chicken breast', 'cheese']:
+      cart.foods.append(FoodItem(name=name,img_url='',nf_calories=0,nf_total_fat=0,nf_saturated_fat=0,nf_cholesterol=0,nf_sodium=0,nf_total_carbohydrate=0,nf_dietary_fiber=0,nf_sugars=0,nf_protein=0,serving_unit='serving'))
+    db.session.add(cart)
+    FoodCatalog.store_search_results({'common': [{'food_name': 'chickpeas'}, {'food_name': 'cheese'}]})
+    db.session.commit()
+
+    # ranked by number of times added to carts (plus one for catalog entries), words other than the first match too
+    response1 = self.client.get(url_for('foods.autocomplete',q='Chi'))
+    self.assertEqual(response1.get_json(), {'query': 'Chi', 'suggestions': ['chicken wings', 'chicken breast', 'chickpeas']})
+    self.assertEqual(self.client.get(url_for('foods.autocomplete',q='bre')).get_json()['suggestions'], ['chicken breast'])
+    self.assertEqual(self.client.get(url_for('foods.autocomplete',q='ch',limit=2)).get_json()['suggestions'], ['cheese', 'chicken wings'])
+    self.assertEqual(self.client.get(url_for('foods.autocomplete',q='')).get_json()['suggestions'], [])
+
+    # incremental updates
+    update_food_index(['chickpeas', 'chickpeas', 'chickpeas'])
+    self.assertEqual(self.client.get(url_for('foods.autocomplete',q='chi')).get_json()['suggestions'], ['chickpeas', 'chicken wings', 'chicken breast'])
+
+    # nodes keep the top k names only; prefixes deeper than max_depth filter the deepest node
+    index = PrefixIndex(k=2, max_depth=3)
+    for name, score in [('apple', 3), ('apple pie', 2), ('applesauce', 1)]:
+      index.add(name, score)
+    self.assertEqual(index.suggest('app'), ['apple', 'apple pie'])
+    self.assertEqual(index.suggest('app', limit=5), ['apple', 'apple pie'])
+    self.assertEqual(index.suggest('apple p'), ['apple pie'])
+    self.assertEqual(index.suggest('pie'), ['apple pie'])
+    index.add('applesauce', 5)
+    self.assertEqual(index.suggest('app'), ['applesauce', 'apple'])
+    self.assertEqual(len(index), 3)
+
   def test_foods_helper_functions(self):
     # get_measures_tuple()
       # When 'alt_measures' is None
@@ -307,6 +502,46 @@ class FlaskFoodsTestCase(FlaskClientTestCase):
     self.assertTrue(get_str_serving_unit(measures_tuple,'42.0') == 'serving1')
     self.assertTrue(get_str_serving_unit(measures_tuple,'21.00') == 'serving2')
 
+    # dicts of measures are looked up directly
+    measures = {'42.0':'serving1', '21.00':'serving2'}
+    self.assertTrue(is_in_tuple_list('42.0',measures))
+    self.assertFalse(is_in_tuple_list('serving1',measures))
+    self.assertTrue(get_str_serving_unit(measures,'21.00') == 'serving2')
+    self.assertTrue(get_str_serving_unit(measures,'1.00') is None)
+
+  def test_foods_nutrition_profile(self):
+    food_info = {'food_name':'brownie','serving_qty':2,'serving_unit':'square','serving_weight_grams':'112',
+      'nf_calories':454.72,'nf_total_fat':21.84,'nf_saturated_fat':None,'nf_cholesterol':19.04,'nf_sodium':327.04,'nf_total_carbohydrate':71.68,
+      'nf_dietary_fiber':2.46,'nf_sugars':40.98,'nf_protein':5.38,
+      'alt_measures':[{'serving_weight':56,'measure':'square','qty':1},{'serving_weight':224,'measure':'cup','qty':2},{'serving_weight':'56','measure':'piece','qty':'1'}]}
+
+    # same values as cleaning, scaling and rounding the record itself
+    cleaned = copy.deepcopy(food_info)
+    clean_food_data(cleaned,nutrient_categories)
+    profile = NutritionProfile(cleaned,get_measures_tuple(cleaned))
+    self.assertEqual(profile.measures,(('56.00','square'),('112.00','cup'),('56.00','piece')))
+    self.assertEqual(dict(profile.measure_units),{'56.00':'square','112.00':'cup'})
+    for serving_unit, serving_qty in [('56.00','1'),('112.00','2.5'),('56.00','0.33')]:
+      expected = copy.deepcopy(cleaned)
+      multiplier = get_nutrient_multiplier(expected['serving_weight_grams'],serving_unit,serving_qty)
+      update_nutrients(expected,multiplier,nutrient_categories)
+      round_food_data(expected,nutrient_categories)
+      self.assertEqual(profile.food_info(multiplier),expected)
+
+    # profiles and their measures are immutable, scaling does not change them
+    with self.assertRaises(AttributeError):
+      profile.serving_qty = 1
+    with self.assertRaises(TypeError):
+      profile.measure_units['1.00'] = 'gram'
+    scaled = profile.food_info(Decimal(3))
+    scaled['nf_calories'] = Decimal(0)
+    scaled['alt_measures'] = []
+    self.assertEqual(profile.food_info(Decimal(1))['nf_calories'],Decimal('454.72'))
+    self.assertEqual(len(profile.food_info(Decimal(1))['alt_measures']),3)
+
+    # records are copied once, not per call
+    self.assertTrue(profile.food_info(Decimal(1))['alt_measures'] is profile.food_info(Decimal(2))['alt_measures'])
+
   def test_foods_delete_food(self):
     user = User(email='one@one.com',username='one',password='one')
     user2 = User(email='two@two.com',username='two',password='two')
@@ -707,6 +942,7 @@ class FlaskCartsTestCase(unittest.TestCase):
   def tearDown(self):
     db.session.remove()
     db.drop_all()
+    card_cache.clear()
     self.app_context.pop()
 
   def test_carts_list(self):
@@ -797,6 +1033,59 @@ class FlaskCartsTestCase(unittest.TestCase):
       self.assertTrue('Cart 2' in data2)
       self.assertTrue('@one' in data2)
 
+  def test_carts_card_cache(self):
+    # cards are rendered once per cart version and shared by lists and feeds
+    response1 = self.client.get(url_for('carts.list',username='one',nutrient='nf_calories'))
+    self.assertTrue('Calories: 12.00 kcal' in response1.get_data(as_text=True))
+    self.assertEqual(len(card_cache), 4)
+    self.assertEqual(card_cache.get(1)[0], 1)
+    with mock.patch('app.carts.fragments.render_template') as render:
+      response2 = self.client.get(url_for('carts.list',username='one',nutrient='nf_calories'))
+      self.assertFalse(render.called)
+    self.assertEqual(response1.get_data(), response2.get_data())
+
+    # updating nutrients invalidates the card, and the next render is cached with the new version
+    cart = Cart.query.get(1)
+    cart.remove_food(cart.foods.first())
+    db.session.commit()
+    self.assertTrue(card_cache.get(1) is None)
+    data3 = self.client.get(url_for('carts.list',username='one',nutrient='nf_calories')).get_data(as_text=True)
+    self.assertFalse('Calories: 12.00 kcal' in data3)
+    self.assertTrue('Calories: 11.00 kcal' in data3)
+    self.assertEqual(card_cache.get(1)[0], 2)
+
+    # stale entries (e.g. after bulk repairs that skip ORM events) are not served
+    card_cache.set(1, (1, 'stale'))
+    data4 = self.client.get(url_for('carts.list',username='one',nutrient='nf_calories')).get_data(as_text=True)
+    self.assertFalse('stale' in data4)
+
+    # deleting a cart drops its card
+    db.session.delete(Cart.query.get(1))
+    db.session.commit()
+    self.assertTrue(card_cache.get(1) is None)
+
+  def test_carts_followed_carts_push_mode(self):
+    self.app.config['FEED_MODE'] = 'push'
+    with self.client:
+      self.client.post(url_for('auth.login'), data=
+      { 
+        'email': 'two@two.com', 
+        'username':'two',
+        'password': 'two' 
+      }
+      )
+
+      # carts of followed users appear once backfilled into the feed
+      self.client.get(url_for('core.follow',username='one'), follow_redirects=True)
+      response1 = self.client.get(url_for('carts.followed_carts'))
+      data1 = response1.get_data(as_text=True)
+      self.assertTrue('Cart 4' in data1)
+      self.assertTrue('@one' in data1)
+
+      response2 = self.client.get(url_for('carts.followed_carts',page=2))
+      data2 = response2.get_data(as_text=True)
+      self.assertTrue('Cart 5' in data2)
+      self.assertFalse('Cart 6' in data2)
 
   def test_carts_delete(self):
     with self.client:
@@ -912,4 +1201,384 @@ class FlaskCartsTestCase(unittest.TestCase):
 
       # test that aborting works when cart with given id does not exist 
       response2 = self.client.get(url_for('carts.cart', id=100))
-      self.assertTrue(response2.status_code == 404)
\ No newline at end of file
+      self.assertTrue(response2.status_code == 404)
+
+  def test_carts_conditional_requests(self):
+    # anonymous cart page is public and revalidated with its ETag
+    response1 = self.client.get(url_for('carts.cart', id=1))
+    etag = response1.headers['ETag']
+    self.assertEqual(response1.status_code, 200)
+    self.assertTrue(response1.cache_control.public)
+    self.assertTrue(response1.last_modified is not None)
+    response2 = self.client.get(url_for('carts.cart', id=1), headers={'If-None-Match': etag})
+    self.assertEqual(response2.status_code, 304)
+    self.assertEqual(response2.get_data(), b'')
+    response3 = self.client.get(url_for('carts.cart', id=1), headers={'If-Modified-Since': response1.headers['Last-Modified']})
+    self.assertEqual(response3.status_code, 304)
+
+    # changing the cart bumps its version, so the old ETag no longer matches
+    cart = Cart.query.get(1)
+    cart.remove_food(cart.foods.first())
+    db.session.commit()
+    self.assertEqual(Cart.query.get(1).version, 2)
+    response4 = self.client.get(url_for('carts.cart', id=1), headers={'If-None-Match': etag})
+    self.assertEqual(response4.status_code, 200)
+    self.assertNotEqual(response4.headers['ETag'], etag)
+
+    # anonymous carts list changes with the user's carts
+    response5 = self.client.get(url_for('carts.list', username='one'))
+    etag = response5.headers['ETag']
+    response6 = self.client.get(url_for('carts.list', username='one'), headers={'If-None-Match': etag})
+    self.assertEqual(response6.status_code, 304)
+    self.assertTrue(response5.last_modified is not None)
+    self.assertEqual(self.client.get(url_for('carts.list', username='one'), headers={'If-Modified-Since': response5.headers['Last-Modified']}).status_code, 304)
+    # unknown sort orders are not found, whatever the validators
+    self.assertEqual(self.client.get(url_for('carts.list', username='one', nutrient='nf_unknown'), headers={'If-None-Match': etag}).status_code, 404)
+    cart = Cart()
+    cart.user = User.query.filter_by(username='one').first()
+    db.session.add(cart)
+    db.session.commit()
+    response7 = self.client.get(url_for('carts.list', username='one'), headers={'If-None-Match': etag})
+    self.assertEqual(response7.status_code, 200)
+
+    # deleting a cart and adding another keeps the cart count and version sum, but not the ETag
+    etag = response7.headers['ETag']
+    user = User.query.filter_by(username='one').first()
+    db.session.delete(Cart.query.filter_by(user_id=user.id, version=1).first())
+    db.session.commit()
+    cart = Cart()
+    cart.user = user
+    db.session.add(cart)
+    db.session.commit()
+    response7 = self.client.get(url_for('carts.list', username='one'), headers={'If-None-Match': etag})
+    self.assertEqual(response7.status_code, 200)
+    self.assertNotEqual(response7.headers['ETag'], etag)
+
+    # pages of logged in viewers are private and carry no validators from anonymous pages
+    with self.client:
+      self.client.post(url_for('auth.login'), data=
+      {
+        'email': 'one@one.com',
+        'username':'one',
+        'password': 'one'
+      }
+      )
+      response8 = self.client.get(url_for('carts.cart', id=1), headers={'If-None-Match': response4.headers['ETag']})
+      self.assertEqual(response8.status_code, 200)
+      self.assertTrue(response8.cache_control.private)
+      self.assertTrue(response8.cache_control.no_cache)
+      response9 = self.client.get(url_for('carts.cart', id=1), headers={'If-None-Match': response8.headers['ETag']})
+      self.assertEqual(response9.status_code, 304)
+      response10 = self.client.get(url_for('carts.list', username='one'))
+      self.assertTrue('ETag' not in response10.headers)
+
+  def test_carts_keyset_pagination(self):
+    user = User.query.filter_by(username='one').first()
+
+    # walk forwards and backwards through carts ordered by calories, including ties
+    for i in range(6):
+      cart = Cart()
+      cart.user = user
+      cart.nf_calories = Decimal(i % 3) / 3
+      db.session.add(cart)
+    db.session.commit()
+    expected = [cart.id for cart in user.carts.order_by(Cart.nf_calories.desc(),Cart.id.desc()).all()]
+
+    seen = []
+    cursor = None
+    while True:
+      pagination = KeysetPagination(user.carts,Cart.nf_calories,Cart.id,cursor=cursor,per_page=4)
+      self.assertEqual(pagination.offset,len(seen))
+      seen += [cart.id for cart in pagination.items]
+      if not pagination.has_next:
+        break
+      cursor = pagination.next_cursor
+    self.assertEqual(seen,expected)
+    self.assertTrue(pagination.total is None)
+
+    pagination = KeysetPagination(user.carts,Cart.nf_calories,Cart.id,cursor=pagination.prev_cursor,per_page=4,count=True)
+    self.assertEqual([cart.id for cart in pagination.items],expected[4:8])
+    self.assertEqual(pagination.offset,4)
+    self.assertEqual(pagination.total,11)
+
+    # invalid cursors load the first page
+    pagination = KeysetPagination(user.carts,Cart.timestamp,Cart.id,cursor='not-a-cursor',per_page=4)
+    self.assertEqual(pagination.offset,0)
+    self.assertFalse(pagination.has_prev)
+
+    # cart list in cursor mode
+    self.app.config['CARTS_PAGINATION'] = 'keyset'
+    response1 = self.client.get(url_for('carts.list',username='one'))
+    data1 = response1.get_data(as_text=True)
+    self.assertTrue('Cart 4' in data1)
+    self.assertFalse('Cart 5' in data1)
+    self.assertTrue('cursor=' in data1)
+    self.assertFalse('page=' in data1)
+
+    cursor = KeysetPagination(user.carts,Cart.timestamp,Cart.id,per_page=4).next_cursor
+    response2 = self.client.get(url_for('carts.list',username='one',cursor=cursor))
+    data2 = response2.get_data(as_text=True)
+    self.assertTrue('Cart 5' in data2)
+    self.assertTrue('Cart 8' in data2)
+    self.assertFalse('Cart 9' in data2)
+
+  def test_carts_query_counts(self):
+    self.app.config['USER_CACHE_TTL'] = 30
+    identity_cache.clear()
+    with self.client:
+      self.client.post(url_for('auth.login'), data=
+      { 
+        'email': 'two@two.com', 
+        'username':'two',
+        'password': 'two' 
+      }
+      )
+
+      # followed carts page issues the same number of queries no matter how many users are followed
+      counts = []
+      for i in range(3,6):
+        user = User(email='%d@%d.com' % (i,i),username=str(i),password=str(i))
+        cart = Cart()
+        cart.user = user
+        db.session.add_all([user,cart])
+        db.session.commit()
+        self.client.get(url_for('core.follow',username=str(i)))
+        db.session.remove()
+        with QueryCounter() as counter:
+          response = self.client.get(url_for('carts.followed_carts'))
+        self.assertTrue('@%d' % i in response.get_data(as_text=True))
+        counts.append(counter.count)
+      self.assertEqual(counts,[1,1,1])
+
+      # carts list page
+      db.session.remove()
+      with QueryCounter() as counter:
+        self.client.get(url_for('carts.list',username='one'))
+      self.assertEqual(counter.count,7)
+      db.session.remove()
+      with QueryCounter() as counter:
+        self.client.get(url_for('carts.list',username='one',nutrient='nf_calories'))
+      self.assertEqual(counter.count,7)
+
+      # cart detail page
+      db.session.remove()
+      with QueryCounter() as counter:
+        self.client.get(url_for('carts.cart',id=1))
+      self.assertEqual(counter.count,2)
+    identity_cache.clear()
+
+  def test_carts_deleted_user_snapshot(self):
+    self.app.config['USER_CACHE_TTL'] = 30
+    identity_cache.clear()
+    with self.client:
+      self.client.post(url_for('auth.login'), data={'email':'two@two.com','password':'two'})
+      self.client.get(url_for('carts.followed_carts'))
+      self.assertEqual(len(identity_cache),1)
+
+      # another worker deletes the user while this worker still holds its snapshot: the session is logged out
+      users = User.__table__
+      db.session.execute(users.delete().where(users.c.email == 'two@two.com'))
+      db.session.commit()
+      db.session.remove()
+      response = self.client.get(url_for('carts.add'))
+      self.assertEqual(response.status_code,302)
+      self.assertTrue('/auth/login' in response.location)
+      self.assertEqual(len(identity_cache),0)
+      response = self.client.get(url_for('carts.followed_carts'))
+      self.assertEqual(response.status_code,302)
+    identity_cache.clear()
+
+
+# test class for 'api' blueprint
+class FlaskApiTestCase(FlaskClientTestCase):
+  def setUp(self):
+    super().setUp()
+    user1 = User(email='one@one.com',username='one',password='one')
+    user2 = User(email='two@two.com',username='two',password='two')
+    carts = []
+    for i in range(5):
+      cart = Cart()
+      cart.user = user1
+      food = FoodItem(name='food%d' % i,img_url='',nf_calories=Decimal(i),nf_total_fat=Decimal('0.25'),nf_saturated_fat=Decimal(0),nf_cholesterol=Decimal(0),
+      nf_sodium=Decimal(0),nf_total_carbohydrate=Decimal(0),nf_dietary_fiber=Decimal(0),nf_sugars=Decimal(0),nf_protein=Decimal(0),serving_qty=Decimal(1),serving_unit='Serving')
+      cart.add_food(food)
+      carts.append(cart)
+    db.session.add_all([user1,user2] + carts)
+    db.session.commit()
+    user2.follow(user1)
+    db.session.commit()
+
+  def test_api_user_carts(self):
+    response1 = self.client.get(url_for('api.user_carts',username='one',per_page=2))
+    self.assertEqual(response1.status_code, 200)
+    self.assertEqual(response1.mimetype, 'application/json')
+    data1 = response1.get_json()
+    self.assertEqual([cart['id'] for cart in data1['carts']], [5,4])
+    self.assertEqual(set(data1['carts'][0]), {'id','timestamp','version','username'} | set(nutrient_categories))
+    self.assertEqual(data1['carts'][0]['username'], 'one')
+    self.assertTrue(data1['prev'] is None)
+
+    # decimals are written as numbers with their 2 decimals
+    self.assertTrue('"nf_total_fat":0.25' in response1.get_data(as_text=True))
+    self.assertTrue('"nf_calories":4.00' in response1.get_data(as_text=True))
+
+    # cursor pages
+    data2 = self.client.get(data1['next']).get_json()
+    self.assertEqual([cart['id'] for cart in data2['carts']], [3,2])
+    data3 = self.client.get(data2['next']).get_json()
+    self.assertEqual([cart['id'] for cart in data3['carts']], [1])
+    self.assertTrue(data3['next'] is None)
+    data4 = self.client.get(data3['prev']).get_json()
+    self.assertEqual([cart['id'] for cart in data4['carts']], [3,2])
+
+    # ordered by a nutrient
+    data5 = self.client.get(url_for('api.user_carts',username='one',nutrient='nf_calories',per_page=3)).get_json()
+    self.assertEqual([cart['nf_calories'] for cart in data5['carts']], [4,3,2])
+    self.assertTrue('nutrient=nf_calories' in data5['next'])
+
+    # errors are JSON
+    response6 = self.client.get(url_for('api.user_carts',username='ten'))
+    self.assertEqual(response6.status_code, 404)
+    self.assertEqual(response6.get_json()['error'], 'not found')
+    response7 = self.client.get(url_for('api.user_carts',username='one',nutrient='color'))
+    self.assertEqual(response7.status_code, 400)
+
+  def test_api_followed_carts(self):
+    response1 = self.client.get(url_for('api.followed_carts'))
+    self.assertEqual(response1.status_code, 401)
+    self.assertEqual(response1.get_json()['error'], 'unauthorized')
+
+    with self.client:
+      self.client.post(url_for('auth.login'), data=
+      {
+        'email': 'two@two.com',
+        'username':'two',
+        'password': 'two'
+      }
+      )
+      data2 = self.client.get(url_for('api.followed_carts',per_page=4)).get_json()
+      self.assertEqual([cart['id'] for cart in data2['carts']], [5,4,3,2])
+      data3 = self.client.get(data2['next']).get_json()
+      self.assertEqual([cart['id'] for cart in data3['carts']], [1])
+
+      # materialized feed
+      self.app.config['FEED_MODE'] = 'push'
+      FeedEntry.rebuild()
+      db.session.commit()
+      data4 = self.client.get(url_for('api.followed_carts',per_page=4)).get_json()
+      self.assertEqual([cart['id'] for cart in data4['carts']], [5,4,3,2])
+      self.assertEqual(data4['carts'][0]['username'], 'one')
+
+  def test_api_cart(self):
+    cart = Cart.query.get(2)
+    for i in range(250):
+      nutrients = dict.fromkeys(nutrient_categories, Decimal(0))
+      nutrients['nf_calories'] = Decimal('0.5')
+      cart.add_food(FoodItem(name='extra%d' % i,img_url='',serving_qty=Decimal(1),serving_unit='Serving',**nutrients))
+    db.session.commit()
+
+    response1 = self.client.get(url_for('api.cart',id=2))
+    self.assertTrue(response1.is_streamed)
+    data1 = response1.get_json()
+    self.assertEqual(data1['cart']['id'], 2)
+    self.assertEqual(data1['cart']['nf_calories'], 126)
+    self.assertEqual(len(data1['foods']), 251)
+    self.assertEqual(data1['foods'][0]['name'], 'food1')
+    self.assertEqual(data1['foods'][250]['name'], 'extra249')
+    self.assertEqual(data1['foods'][1]['nf_calories'], 0.5)
+
+    data2 = self.client.get(url_for('api.cart',id=1)).get_json()
+    self.assertEqual([food['name'] for food in data2['foods']], ['food0'])
+    self.assertEqual(self.client.get(url_for('api.cart',id=100)).status_code, 404)
+
+  def test_api_foods(self):
+    FoodCatalog.store_search_results({'common': [{'food_name': 'brownie', 'photo': {'thumb': 'brownie.jpg'}}], 'branded': []})
+    FoodCatalog.store_food('common', {'food_name': 'brownie', 'serving_qty': 1, 'serving_unit': 'square', 'serving_weight_grams': 56,
+      'nf_calories': 227.36, 'nf_total_fat': 10.92, 'nf_saturated_fat': 2.74, 'nf_cholesterol': 9.52, 'nf_sodium': 163.52, 'nf_total_carbohydrate': 35.84,
+      'nf_dietary_fiber': 1.23, 'nf_sugars': 20.49, 'nf_protein': 2.69, 'alt_measures': [{'serving_weight': 56, 'measure': 'square', 'qty': 1},
+      {'serving_weight': 28, 'measure': 'oz', 'qty': 1}], 'photo': {'thumb': 'brownie.jpg'}})
+    db.session.commit()
+    self.app.config['FOOD_SEARCH_POLICY'] = 'local_only'
+
+    data1 = self.client.get(url_for('api.search',q='brown')).get_json()
+    self.assertEqual(data1['foods'], [{'food_name': 'brownie', 'photo': {'thumb': 'brownie.jpg'}}])
+    self.assertEqual(self.client.get(url_for('api.search',q='brown',filter='other')).status_code, 400)
+    self.assertEqual(self.client.get(url_for('api.search')).status_code, 400)
+
+    data2 = self.client.get(url_for('api.food',kind='common',value='brownie')).get_json()
+    self.assertEqual(data2['food']['food_name'], 'brownie')
+    self.assertEqual(data2['food']['nf_calories'], 227.36)
+    self.assertEqual(data2['food']['photo'], 'brownie.jpg')
+    self.assertEqual(data2['food']['measures'], [{'serving_weight': 56, 'measure': 'square'}, {'serving_weight': 28, 'measure': 'oz'}])
+    self.assertTrue(data2['food']['serving'] is None)
+
+    data3 = self.client.get(url_for('api.food',kind='common',value='brownie',serving_unit='28.00',serving_qty=3)).get_json()
+    self.assertEqual(data3['food']['serving'], {'serving_weight': 28, 'measure': 'oz', 'qty': 3})
+    self.assertEqual(data3['food']['nf_calories'], 341.04)
+
+    self.assertEqual(self.client.get(url_for('api.food',kind='common',value='brownie',serving_unit='30')).status_code, 400)
+    self.assertEqual(self.client.get(url_for('api.food',kind='other',value='brownie')).status_code, 404)
+
+
+# test class for read-replica routing, with a second SQLite file standing in for the replica
+class ReplicaRoutingTestCase(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.TemporaryDirectory()
+    self.app = create_app('testing')
+    self.app.config['SQLALCHEMY_BINDS'] = {'replica': 'sqlite:///' + os.path.join(self.tmp.name, 'replica.sqlite')}
+    self.app_context = self.app.app_context()
+    self.app_context.push()
+    db.create_all()
+    db.Model.metadata.create_all(db.get_engine(bind='replica'))
+    self.client = self.app.test_client(use_cookies=True)
+
+  def tearDown(self):
+    db.session.remove()
+    db.drop_all()
+    db.get_engine(bind='replica').dispose()
+    card_cache.clear()
+    self.app_context.pop()
+    self.tmp.cleanup()
+
+  def test_read_only_views_use_replica(self):
+    # 'one' has not been replicated yet
+    db.session.add(User(email='one@one.com',username='one',password='one'))
+    db.session.commit()
+    response = self.client.get(url_for('core.users',username='one'))
+    self.assertTrue('No Results Returned.' in response.get_data(as_text=True))
+
+    # use_primary overrides read_only
+    with self.app.test_request_context():
+      self.assertEqual(read_only(lambda: User.query.count())(), 0)
+      self.assertEqual(use_primary(read_only(lambda: User.query.count()))(), 1)
+      self.assertEqual(read_only(use_primary(lambda: User.query.count()))(), 1)
+
+    # views without a replica bind configured read the primary
+    binds = self.app.config['SQLALCHEMY_BINDS']
+    self.app.config['SQLALCHEMY_BINDS'] = None
+    response = self.client.get(url_for('core.users',username='one'))
+    self.assertFalse('No Results Returned.' in response.get_data(as_text=True))
+    self.app.config['SQLALCHEMY_BINDS'] = binds
+
+  def test_read_your_writes(self):
+    # reads after a write in the same request stay on the primary
+    with self.app.test_request_context():
+      g.db_route = 'replica'
+      self.assertEqual(User.query.count(), 0)
+      db.session.add(User(email='two@two.com',username='two',password='two'))
+      db.session.commit()
+      self.assertEqual(User.query.count(), 1)
+
+    # and so do the user's next requests during REPLICA_STICKY_SECONDS
+    self.client.post(url_for('auth.register'), data = {
+      'email':'one@one.com',
+      'username':'one',
+      'password':'one',
+      'password2':'one'
+    })
+    response = self.client.get(url_for('core.users',username='one'))
+    self.assertFalse('No Results Returned.' in response.get_data(as_text=True))
+
+    self.app.config['REPLICA_STICKY_SECONDS'] = 0
+    response = self.client.get(url_for('core.users',username='one'))
+    self.assertTrue('No Results Returned.' in response.get_data(as_text=True))
@@ -1,9 +1,13 @@
 import unittest
+from unittest import mock
 from sqlalchemy.exc import IntegrityError
 from app import create_app, db
-from app.models import User,FoodItem,Cart,Follow
+from app import jobs
+from app.models import User,FoodItem,Cart,Follow,FeedEntry,FoodCatalog,Job,PendingFood,load_user,identity_cache
+from app.nutrients import NutrientVector
+from nutritionix import nutrient_categories
 from decimal import Decimal
-from datetime import datetime
+from datetime import datetime, timedelta
 
 class FlaskTestCase(unittest.TestCase):
   def setUp(self):
@@ -90,6 +94,49 @@ class UserModelTestCase(FlaskTestCase):
     followed_carts = u1.followed_carts.all()
     self.assertTrue(len(followed_carts) == 2)
 
+  def test_followed_carts_push_mode(self):
+    self.app.config['FEED_MODE'] = 'push'
+    u1 = User(email='one@one.com', username='one', password='one')
+    u2 = User(email='two@two.com',username='two',password='two')
+    u3 = User(email='three@three.com',username='three',password='three')
+    cart1 = Cart()
+    cart1.user = u2
+    db.session.add_all([u1,u2,u3])
+    db.session.commit()
+    self.assertTrue(len(u1.followed_carts.all()) == 0)
+
+    # following backfills existing carts
+    u1.follow(u2)
+    u3.follow(u2)
+    self.assertEqual(u1.followed_carts.all(),[cart1])
+    self.assertTrue(FeedEntry.query.count() == 2)
+
+    # new carts are fanned out to followers
+    cart2 = Cart()
+    cart2.user = u2
+    db.session.add(cart2)
+    db.session.commit()
+    self.assertEqual(u1.followed_carts.order_by(User.followed_carts_timestamp().desc(),Cart.id.desc()).all(),[cart2,cart1])
+    self.assertEqual(FeedEntry.query.filter_by(cart_id=cart2.id).first().timestamp,cart2.timestamp)
+
+    # deleting a cart prunes it from feeds
+    db.session.delete(cart1)
+    db.session.commit()
+    self.assertEqual(u1.followed_carts.all(),[cart2])
+    self.assertEqual(u3.followed_carts.all(),[cart2])
+
+    # unfollowing prunes the followed user's carts
+    u1.unfollow(u2)
+    self.assertTrue(len(u1.followed_carts.all()) == 0)
+    self.assertEqual(u3.followed_carts.all(),[cart2])
+
+    # rebuilding from follows gives the same feeds as pull mode
+    FeedEntry.rebuild()
+    db.session.commit()
+    self.assertTrue(FeedEntry.query.count() == 1)
+    self.app.config['FEED_MODE'] = 'pull'
+    self.assertEqual(u3.followed_carts.all(),[cart2])
+
   def test_follows(self):
     u1 = User(email='one@one.com', username='one', password='one')
     u2 = User(email='two@two.com',username='two',password='two')
@@ -131,6 +178,75 @@ class UserModelTestCase(FlaskTestCase):
     db.session.commit()
     self.assertTrue(Follow.query.count() == 0)
 
+  def test_following_status(self):
+    users = [User(email='%d@%d.com' % (i,i), username=str(i), password=str(i)) for i in range(4)]
+    db.session.add_all(users)
+    db.session.commit()
+
+    # follow and unfollow are idempotent and report whether anything changed
+    self.assertTrue(users[0].follow(users[1]))
+    self.assertFalse(users[0].follow(users[1]))
+    self.assertTrue(users[0].follow(users[2]))
+    self.assertTrue(Follow.query.count() == 2)
+
+    status = users[0].following_status([u.id for u in users[1:]])
+    self.assertEqual(status,{users[1].id:True,users[2].id:True,users[3].id:False})
+    self.assertEqual(users[0].following_status([]),{})
+
+    self.assertTrue(users[0].unfollow(users[1]))
+    self.assertFalse(users[0].unfollow(users[1]))
+    self.assertEqual(users[0].following_status([users[1].id,users[2].id]),{users[1].id:False,users[2].id:True})
+
+
+class LoadUserTestCase(FlaskTestCase):
+  def setUp(self):
+    super().setUp()
+    identity_cache.clear()
+    self.app.config['USER_CACHE_TTL'] = 30
+
+  def tearDown(self):
+    identity_cache.clear()
+    super().tearDown()
+
+  def test_identity_cache(self):
+    u1 = User(email='one@one.com', username='one', password='one')
+    cart = Cart()
+    cart.user = u1
+    db.session.add(u1)
+    db.session.commit()
+
+    # first load queries the database and caches a snapshot
+    self.assertEqual(load_user('1'),u1)
+    self.assertEqual(identity_cache.misses,1)
+    db.session.remove()
+
+    # later loads build the user from the snapshot
+    user = load_user('1')
+    self.assertEqual(identity_cache.hits,1)
+    self.assertEqual(user.username,'one')
+    self.assertEqual(user.email,'one@one.com')
+    self.assertTrue(user.verify_password('one'))
+    self.assertTrue(user.carts.count() == 1)
+
+    # password change invalidates the snapshot
+    user.password = 'two'
+    db.session.commit()
+    self.assertTrue(len(identity_cache) == 0)
+    db.session.remove()
+    self.assertTrue(load_user('1').verify_password('two'))
+
+    # deletion invalidates the snapshot
+    db.session.delete(User.query.get(1))
+    db.session.commit()
+    self.assertTrue(load_user('1') is None)
+
+  def test_identity_cache_disabled(self):
+    self.app.config['USER_CACHE_TTL'] = 0
+    u1 = User(email='one@one.com', username='one', password='one')
+    db.session.add(u1)
+    db.session.commit()
+    self.assertEqual(load_user('1'),u1)
+    self.assertTrue(len(identity_cache) == 0)
 
 class FoodItemModelTestCase(FlaskTestCase):
   def test_decimal_fields(self):
@@ -240,6 +356,194 @@ class CartModelTestCase(FlaskTestCase):
     self.assertTrue(cart2.nf_sugars == Decimal(26))
     self.assertTrue(cart2.nf_protein == Decimal(28))
   
+  def test_add_remove_food(self):
+    food1 = FoodItem(name='food1',
+    img_url="",
+    nf_calories=Decimal(1),
+    nf_total_fat=Decimal(2),
+    nf_cholesterol=Decimal(3),
+    nf_saturated_fat=Decimal(4),
+    nf_sodium=Decimal(5),
+    nf_total_carbohydrate=Decimal(6),
+    nf_dietary_fiber=Decimal(7),
+    nf_sugars=Decimal(8),
+    nf_protein=Decimal(9),
+    serving_qty=Decimal(1),
+    serving_unit='serving')
+
+    food2 = FoodItem(name='food2',
+    img_url="",
+    nf_calories=Decimal(11),
+    nf_total_fat=Decimal(12),
+    nf_cholesterol=Decimal(13),
+    nf_saturated_fat=Decimal(14),
+    nf_sodium=Decimal(15),
+    nf_total_carbohydrate=Decimal(16),
+    nf_dietary_fiber=Decimal(17),
+    nf_sugars=Decimal(18),
+    nf_protein=Decimal(19),
+    serving_qty=Decimal(1),
+    serving_unit='serving')
+
+    cart = Cart()
+    db.session.add(cart)
+    cart.add_food(food1)
+    cart.add_food(food2)
+    db.session.commit()
+    self.assertTrue(food1.cart == cart)
+    self.assertTrue(cart.nf_calories == Decimal(12))
+    self.assertTrue(cart.nf_protein == Decimal(28))
+    self.assertTrue(cart.verify_nutrients())
+
+    cart.remove_food(food1)
+    db.session.commit()
+    self.assertTrue(cart.foods.count() == 1)
+    self.assertTrue(cart.nf_calories == Decimal(11))
+    self.assertTrue(cart.nf_protein == Decimal(19))
+    self.assertTrue(cart.verify_nutrients())
+
+    # full recompute repairs totals that drifted
+    cart.nf_calories = Decimal(100)
+    self.assertFalse(cart.verify_nutrients())
+    cart.update_nutrients()
+    self.assertTrue(cart.nf_calories == Decimal(11))
+    self.assertTrue(cart.verify_nutrients())
+    db.session.commit()
+
+    # deltas are added by the UPDATE itself, so totals changed meanwhile by another request are not overwritten
+    self.assertEqual(cart.nf_calories, Decimal(11))
+    carts = Cart.__table__
+    db.session.execute(carts.update().where(carts.c.id == cart.id).values(nf_calories=carts.c.nf_calories + 100))
+    food3 = FoodItem(name='food3', img_url="", nf_calories=Decimal(1), nf_total_fat=Decimal(1), nf_cholesterol=Decimal(1), nf_saturated_fat=Decimal(1), nf_sodium=Decimal(1),
+      nf_total_carbohydrate=Decimal(1), nf_dietary_fiber=Decimal(1), nf_sugars=Decimal(1), nf_protein=Decimal('0.5'), serving_qty=Decimal(1), serving_unit='serving')
+    food4 = FoodItem(name='food4', img_url="", nf_calories=Decimal(2), nf_total_fat=Decimal(1), nf_cholesterol=Decimal(1), nf_saturated_fat=Decimal(1), nf_sodium=Decimal(1),
+      nf_total_carbohydrate=Decimal(1), nf_dietary_fiber=Decimal(1), nf_sugars=Decimal(1), nf_protein=Decimal('0.25'), serving_qty=Decimal(1), serving_unit='serving')
+    cart.add_food(food3)
+    cart.add_food(food4)
+    db.session.commit()
+    self.assertEqual(cart.nf_calories, Decimal(114))
+    self.assertEqual(cart.nf_protein, Decimal('19.75'))
+
+    # bulk totals too
+    db.session.execute(carts.update().where(carts.c.id == cart.id).values(nf_calories=carts.c.nf_calories + 100))
+    cart.apply_nutrient_totals(dict({category: Decimal(0) for category in nutrient_categories}, nf_calories=Decimal('0.5')))
+    db.session.commit()
+    self.assertEqual(cart.nf_calories, Decimal('214.5'))
+  
+  def test_repair_nutrients(self):
+    foods = [FoodItem(name='food%d' % i,
+    img_url="",
+    nf_calories=Decimal(i),
+    nf_total_fat=Decimal(2),
+    nf_cholesterol=Decimal(3),
+    nf_saturated_fat=Decimal(4),
+    nf_sodium=Decimal(5),
+    nf_total_carbohydrate=Decimal(6),
+    nf_dietary_fiber=Decimal(7),
+    nf_sugars=Decimal(8),
+    nf_protein=Decimal('9.25'),
+    serving_qty=Decimal(1),
+    serving_unit='serving') for i in range(1,4)]
+
+    cart1 = Cart()
+    cart2 = Cart()
+    cart3 = Cart()
+    foods[0].cart = cart1
+    foods[1].cart = cart1
+    foods[2].cart = cart2
+    cart3.nf_calories = Decimal(50)
+    db.session.add_all([cart1,cart2,cart3] + foods)
+    db.session.commit()
+
+    # stored totals were never applied, so every cart is off
+    self.assertEqual(Cart.verify_all_nutrients(),[cart1.id,cart2.id,cart3.id])
+    self.assertEqual(Cart.verify_all_nutrients(cart_ids=[cart2.id]),[cart2.id])
+    self.assertEqual(Cart.verify_all_nutrients(batch_size=2),[cart1.id,cart2.id,cart3.id])
+
+    # single cart repaired with an aggregate query
+    cart1.repair_nutrients()
+    self.assertTrue(cart1.nf_calories == Decimal(3))
+    self.assertTrue(cart1.nf_protein == Decimal('18.5'))
+    self.assertTrue(cart1.verify_nutrients())
+
+    # bulk repair of selected carts
+    self.assertEqual(Cart.repair_all_nutrients(cart_ids=[cart2.id]),1)
+    db.session.commit()
+    db.session.expire_all()
+    self.assertTrue(cart2.nf_calories == Decimal(3))
+    self.assertTrue(cart3.nf_calories == Decimal(50))
+
+    # bulk repair of all carts, resetting carts without foods; carts already right are not written
+    versions = [cart1.version, cart2.version, cart3.version]
+    self.assertEqual(Cart.repair_all_nutrients(batch_size=1),1)
+    db.session.commit()
+    db.session.expire_all()
+    self.assertTrue(cart1.nf_sodium == Decimal(10))
+    self.assertTrue(cart2.nf_protein == Decimal('9.25'))
+    self.assertTrue(cart3.nf_calories == Decimal(0))
+    self.assertEqual([cart1.version, cart2.version, cart3.version],[versions[0], versions[1], versions[2] + 1])
+    self.assertEqual(Cart.verify_all_nutrients(),[])
+    self.assertEqual(Cart.verify_all_nutrients(batch_size=1),[])
+
+    # nothing changes on a rerun, with cart ids given in chunks of batch_size
+    self.assertEqual(Cart.repair_all_nutrients(),0)
+    cart2.nf_calories = Decimal(7)
+    cart3.nf_sugars = Decimal(1)
+    db.session.commit()
+    self.assertEqual(Cart.repair_all_nutrients(cart_ids=[cart1.id,cart2.id,cart3.id],batch_size=2),2)
+    db.session.commit()
+    db.session.expire_all()
+    self.assertEqual([cart2.nf_calories, cart3.nf_sugars],[Decimal(3), Decimal(0)])
+  
+  def test_clone_to(self):
+    user1 = User(email="one@one.com",username="one",password="one")
+    user2 = User(email="two@two.com",username="two",password="two")
+    cart = Cart()
+    cart.user = user1
+    for i in range(1,4):
+      cart.add_food(FoodItem(name='food%d' % i,
+      img_url="img%d" % i,
+      nf_calories=Decimal(i),
+      nf_total_fat=Decimal(2),
+      nf_cholesterol=Decimal(3),
+      nf_saturated_fat=Decimal(4),
+      nf_sodium=Decimal(5),
+      nf_total_carbohydrate=Decimal(6),
+      nf_dietary_fiber=Decimal(7),
+      nf_sugars=Decimal(8),
+      nf_protein=Decimal(9),
+      serving_qty=Decimal(i),
+      serving_unit='serving'))
+    db.session.add_all([user1,user2,cart])
+    db.session.commit()
+
+    clone = cart.clone_to(user2)
+    db.session.commit()
+    self.assertTrue(clone.id != cart.id)
+    self.assertTrue(clone.user == user2)
+    self.assertTrue(clone.nf_calories == Decimal(6))
+    self.assertTrue(clone.nf_protein == Decimal(27))
+    self.assertTrue(clone.verify_nutrients())
+
+    # foods are copied, the originals stay in the source cart
+    foods = clone.foods.order_by(FoodItem.id).all()
+    self.assertEqual([food.name for food in foods],['food1','food2','food3'])
+    self.assertEqual([food.img_url for food in foods],['img1','img2','img3'])
+    self.assertEqual([food.serving_qty for food in foods],[Decimal(1),Decimal(2),Decimal(3)])
+    self.assertTrue(cart.foods.count() == 3)
+    self.assertTrue(FoodItem.query.count() == 6)
+
+    # a food added to a saved cart is part of a clone made before the next commit
+    cart.add_food(FoodItem(name='food4', img_url="img4", nf_calories=Decimal(4), nf_total_fat=Decimal(1), nf_cholesterol=Decimal(1), nf_saturated_fat=Decimal(1), nf_sodium=Decimal(1),
+      nf_total_carbohydrate=Decimal(1), nf_dietary_fiber=Decimal(1), nf_sugars=Decimal(1), nf_protein=Decimal('0.5'), serving_qty=Decimal(1), serving_unit='serving'))
+    self.assertEqual(cart.nf_calories, Decimal(10))
+    clone2 = cart.clone_to(user2)
+    db.session.commit()
+    self.assertEqual(clone2.nf_calories, Decimal(10))
+    self.assertEqual(clone2.nf_protein, Decimal('27.5'))
+    self.assertTrue(clone2.foods.count() == 4)
+    self.assertTrue(clone2.verify_nutrients())
+  
   def test_relationships(self):
     food1 = FoodItem(name='food1',
     img_url="",
@@ -285,4 +589,278 @@ class CartModelTestCase(FlaskTestCase):
     # test relationships are showed in __repr__
     self.assertTrue(food1.__repr__() == 'food1 in Cart of <User one>')
     self.assertTrue(cart1.__repr__() == 'Cart of <User one>')
-    self.assertTrue(user1.__repr__() == '<User one>')
\ No newline at end of file
+    self.assertTrue(user1.__repr__() == '<User one>')
+class FoodCatalogModelTestCase(FlaskTestCase):
+  search_result = {
+    'common': [
+      {'food_name': 'chicken breast', 'photo': {'thumb': 'chicken.jpg'}},
+      {'food_name': 'cheese', 'photo': {'thumb': 'cheese.jpg'}}
+    ],
+    'branded': [
+      {'food_name': 'Chicken McNuggets', 'brand_name': "McDonald's", 'nix_item_id': '513fc9e73fe3ffd40300109f', 'photo': {'thumb': 'nuggets.jpg'}}
+    ]
+  }
+
+  def test_search(self):
+    FoodCatalog.store_search_results(self.search_result)
+    FoodCatalog.store_search_results(self.search_result)
+    db.session.commit()
+    self.assertEqual(FoodCatalog.query.count(), 3)
+
+    self.assertEqual([f.food_name for f in FoodCatalog.search('Chick', 'common')], ['chicken breast'])
+    self.assertEqual([f.food_name for f in FoodCatalog.search('mcdonald chick', 'branded')], ['Chicken McNuggets'])
+    self.assertEqual(FoodCatalog.search('"chicken', 'common')[0].food_name, 'chicken breast')
+    self.assertEqual(FoodCatalog.search('pizza', 'common'), [])
+    self.assertEqual(FoodCatalog.search('  ', 'common'), [])
+    self.assertEqual(FoodCatalog.search('chicken', 'branded')[0].to_search_result(), self.search_result['branded'][0])
+
+    # renamed and deleted entries leave the full-text index
+    entry = FoodCatalog.query.filter_by(food_name='cheese').first()
+    entry.food_name = 'cheddar cheese'
+    db.session.commit()
+    self.assertEqual(FoodCatalog.search('cheddar', 'common'), [entry])
+    db.session.delete(entry)
+    db.session.commit()
+    self.assertEqual(FoodCatalog.search('cheddar', 'common'), [])
+
+  def test_popularity(self):
+    FoodCatalog.store_search_results({'common': [{'food_name': 'chicken breast'}, {'food_name': 'chicken wings'}]})
+    db.session.commit()
+    FoodCatalog.record_use({'food_name': 'Chicken Wings'})
+    db.session.commit()
+    self.assertEqual([f.food_name for f in FoodCatalog.search('chicken', 'common')], ['chicken wings', 'chicken breast'])
+
+  def test_store_food(self):
+    food_info = {'food_name': 'apple', 'serving_qty': 1, 'serving_unit': 'medium', 'nf_calories': 94.64, 'alt_measures': [{'serving_weight': 182, 'measure': 'medium', 'qty': 1}], 'photo': {'thumb': 'apple.jpg'}}
+    self.assertIsNone(FoodCatalog.lookup('common', 'Apple'))
+    FoodCatalog.store_food('common', food_info)
+    FoodCatalog.store_food('common', food_info)
+    db.session.commit()
+    self.assertEqual(FoodCatalog.query.count(), 1)
+    self.assertEqual(FoodCatalog.lookup('common', ' Apple'), food_info)
+
+  def test_seed_from_food_items(self):
+    cart = Cart()
+    for name in ['apple', 'apple', 'banana']:
+      cart.foods.append(FoodItem(name=name, img_url='', nf_calories=0, nf_total_fat=0, nf_saturated_fat=0, nf_cholesterol=0, nf_sodium=0, nf_total_carbohydrate=0, nf_dietary_fiber=0, nf_sugars=0, nf_protein=0, serving_unit='serving'))
+    db.session.add(cart)
+    db.session.commit()
+    self.assertEqual(FoodCatalog.seed_from_food_items(), 2)
+    self.assertEqual(FoodCatalog.seed_from_food_items(), 0)
+    db.session.commit()
+    self.assertEqual([(f.food_name, f.popularity) for f in FoodCatalog.query.order_by(FoodCatalog.popularity.desc())], [('apple', 2), ('banana', 1)])
+
+class PendingFoodModelTestCase(FlaskTestCase):
+  food_info = dict({category: Decimal('1.25') for category in nutrient_categories}, food_name='apple', photo={'thumb':'apple.jpg'}, alt_measures=[])
+
+  def test_expiry_and_size_bound(self):
+    self.app.config['PENDING_FOOD_MAX_ROWS'] = 2
+    tokens = [PendingFood.create(self.food_info, 'medium', Decimal(1)).token for i in range(3)]
+    db.session.commit()
+    self.assertIsNone(PendingFood.get(tokens[0]))
+    self.assertEqual(PendingFood.get(tokens[2]).nf_protein, Decimal('1.25'))
+    self.assertEqual(PendingFood.query.count(), 2)
+
+    # replacing a selection drops the previous record
+    token = PendingFood.create(self.food_info, 'medium', Decimal(2), replace=tokens[2]).token
+    db.session.commit()
+    self.assertIsNone(PendingFood.get(tokens[2]))
+    food = PendingFood.get(token).to_food_item()
+    self.assertEqual((food.name, food.img_url, food.serving_qty, food.nf_calories), ('apple', 'apple.jpg', Decimal(2), Decimal('1.25')))
+
+    # expired records are not returned, and are pruned by the next selection
+    self.app.config['PENDING_FOOD_TTL'] = -1
+    self.assertIsNone(PendingFood.get(token))
+    PendingFood.create(self.food_info, 'medium', Decimal(1))
+    db.session.commit()
+    self.assertEqual(PendingFood.query.count(), 0)
+    self.assertIsNone(PendingFood.get(None))
+
+class JobQueueTestCase(FlaskTestCase):
+  def setUp(self):
+    super().setUp()
+    self.app.config['JOB_QUEUE'] = 'db'
+    self.calls = []
+    jobs.tasks['record_call'] = self.calls.append
+
+  def tearDown(self):
+    jobs.tasks.pop('record_call', None)
+    super().tearDown()
+
+  def test_enqueue_and_dedup(self):
+    self.assertTrue(jobs.enqueue('record_call', 1, dedup_key='one'))
+    self.assertFalse(jobs.enqueue('record_call', 1, dedup_key='one'))
+    self.assertTrue(jobs.enqueue('record_call', 2))
+    self.assertTrue(jobs.enqueue('record_call', 2))
+    db.session.commit()
+    self.assertEqual(Job.query.count(), 3)
+    with self.assertRaises(KeyError):
+      jobs.enqueue('missing')
+
+    # finished jobs are deleted, which frees their dedup key
+    self.assertEqual(jobs.run_pending(), 3)
+    self.assertEqual(self.calls, [1, 2, 2])
+    self.assertEqual(Job.query.count(), 0)
+    self.assertTrue(jobs.enqueue('record_call', 1, dedup_key='one'))
+
+    # delayed jobs are not visible yet
+    jobs.enqueue('record_call', 3, delay=60)
+    db.session.commit()
+    self.assertEqual(jobs.run_pending(), 1)
+    self.assertEqual(self.calls, [1, 2, 2, 1])
+
+    # with the queue off tasks run right away
+    self.app.config['JOB_QUEUE'] = 'off'
+    self.assertFalse(jobs.enqueue('record_call', 4))
+    self.assertEqual(self.calls, [1, 2, 2, 1, 4])
+
+  def test_visibility_timeout(self):
+    jobs.enqueue('record_call', 1)
+    db.session.commit()
+    job = Job.claim(visibility_timeout=60)
+    self.assertEqual((job.attempts, job.task), (1, 'record_call'))
+    self.assertIsNone(Job.claim(visibility_timeout=60))
+    # (another worker's copy of the job)
+    db.session.expunge(job)
+
+    # a job whose worker died is claimed again once its visibility timeout passed, and the old lease cannot finish it
+    Job.query.update({'visible_at': datetime.utcnow() - timedelta(seconds=1)})
+    db.session.commit()
+    retry = Job.claim(visibility_timeout=60)
+    self.assertEqual(retry.attempts, 2)
+
+    # only the current lease can extend the job's visibility timeout
+    self.assertFalse(job.extend(600))
+    self.assertTrue(retry.extend(600))
+    self.assertTrue(Job.query.one().visible_at > datetime.utcnow() + timedelta(seconds=500))
+    job.complete()
+    db.session.commit()
+    self.assertEqual(Job.query.count(), 1)
+    retry.complete()
+    db.session.commit()
+    self.assertEqual(Job.query.count(), 0)
+
+  def test_retries(self):
+    self.app.config['JOB_MAX_ATTEMPTS'] = 2
+    self.app.config['JOB_RETRY_DELAY'] = 0
+    def fail(value):
+      raise ValueError(value)
+    jobs.tasks['record_call'] = fail
+    jobs.enqueue('record_call', 'boom', dedup_key='boom')
+    db.session.commit()
+
+    # a failed job is retried after its backoff and kept as failed after max_attempts
+    self.assertEqual(jobs.run_pending(), 2)
+    job = Job.query.one()
+    self.assertEqual((job.status, job.attempts), ('failed', 2))
+    self.assertTrue('ValueError: boom' in job.last_error)
+    self.assertEqual(jobs.run_pending(), 0)
+    self.assertTrue(jobs.enqueue('record_call', 'boom', dedup_key='boom'))
+
+    self.app.config['JOB_RETRY_DELAY'] = 60
+    db.session.commit()
+    self.assertEqual(jobs.run_pending(), 1)
+    self.assertTrue(Job.query.filter_by(status='queued').one().visible_at > datetime.utcnow() + timedelta(seconds=50))
+
+  def test_fan_out_job(self):
+    self.app.config['FEED_MODE'] = 'push'
+    u1 = User(email='one@one.com', username='one', password='one')
+    u2 = User(email='two@two.com', username='two', password='two')
+    db.session.add_all([u1, u2])
+    db.session.commit()
+    u2.follow(u1)
+    cart = Cart()
+    cart.user = u1
+    db.session.add(cart)
+    db.session.commit()
+
+    # the new cart reaches followers' feeds when its job runs
+    self.assertEqual(u2.followed_carts.count(), 0)
+    self.assertEqual(Job.query.one().dedup_key, 'fan_out_cart:%d' % cart.id)
+    self.assertEqual(jobs.run_pending(), 1)
+    self.assertEqual(u2.followed_carts.all(), [cart])
+
+    # running it again (e.g. after a lost lease) does not duplicate entries
+    jobs.fan_out_cart(cart.id)
+    db.session.commit()
+    self.assertEqual(FeedEntry.query.count(), 1)
+
+  def test_repair_carts_job(self):
+    carts = []
+    for i in range(3):
+      cart = Cart()
+      food = FoodItem(name='apple', img_url='', nf_calories=Decimal(1), nf_total_fat=Decimal(1), nf_saturated_fat=Decimal(1), nf_cholesterol=Decimal(1), nf_sodium=Decimal(1),
+        nf_total_carbohydrate=Decimal(1), nf_dietary_fiber=Decimal(1), nf_sugars=Decimal(1), nf_protein=Decimal(1), serving_qty=Decimal(1), serving_unit='Serving')
+      cart.add_food(food)
+      db.session.add_all([cart, food])
+      carts.append(cart)
+    db.session.commit()
+    for cart in carts:
+      cart.nf_calories = Decimal(5)
+    db.session.commit()
+
+    jobs.enqueue('repair_carts', [carts[0].id])
+    db.session.commit()
+    self.assertEqual(jobs.run_pending(), 1)
+    db.session.expire_all()
+    self.assertEqual([cart.nf_calories for cart in carts], [Decimal(1), Decimal(5), Decimal(5)])
+
+    # carts are repaired one batch per transaction, extending the lease after each batch
+    jobs.enqueue('repair_carts', None, 2)
+    db.session.commit()
+    with mock.patch.object(Job, 'extend', autospec=True, side_effect=Job.extend) as extend:
+      self.assertEqual(jobs.run_pending(), 1)
+    self.assertEqual(extend.call_count, 2)
+    db.session.expire_all()
+    self.assertEqual([cart.nf_calories for cart in carts], [Decimal(1), Decimal(1), Decimal(1)])
+    self.assertEqual(Job.query.count(), 0)
+
+  def test_worker_pool(self):
+    for i in range(5):
+      jobs.enqueue('record_call', i)
+    db.session.commit()
+    pool = jobs.WorkerPool(self.app, threads=2, poll_interval=0.01)
+    pool.start()
+    try:
+      for i in range(500):
+        if len(self.calls) == 5:
+          break
+        pool._stop.wait(0.01)
+    finally:
+      pool.stop()
+    self.assertEqual(sorted(self.calls), [0, 1, 2, 3, 4])
+    db.session.expire_all()
+    self.assertEqual(Job.query.count(), 0)
+
+class NutrientVectorTestCase(unittest.TestCase):
+  def test_arithmetic(self):
+    foods = NutrientVector.from_rows([
+      [Decimal('0.1'), 1, None, 0, 0, 0, 0, 0, 2.5],
+      [Decimal('0.2'), 2, 3, 0, 0, 0, 0, 0, '0.25'],
+      [0.3, 3, 0, 0, 0, 0, 0, 0, 0]
+    ])
+    self.assertEqual(len(foods), 3)
+
+    # fixed-point sums are exact, values come back with 2 decimals
+    totals = foods.sum().to_decimals()
+    self.assertEqual(totals['nf_calories'], Decimal('0.60'))
+    self.assertEqual(str(totals['nf_calories']), '0.60')
+    self.assertEqual(totals['nf_protein'], Decimal('2.75'))
+    self.assertEqual(totals['nf_saturated_fat'], Decimal(3))
+
+    keys, grouped = foods.group_sum([7, 5, 7])
+    self.assertEqual(keys.tolist(), [5, 7])
+    self.assertEqual([row['nf_total_fat'] for row in grouped.to_decimals()], [Decimal(2), Decimal(4)])
+
+    # scaling rounds to hundredths, by one multiplier or one per row
+    self.assertEqual(foods.scale(Decimal('1.5')).to_decimals()[1]['nf_protein'], Decimal('0.38'))
+    self.assertEqual([row['nf_total_fat'] for row in foods.scale([1, 2, 0.5]).to_decimals()], [Decimal(1), Decimal(4), Decimal('1.5')])
+
+    self.assertEqual(foods.equals(foods.scale(1)).tolist(), [True, True, True])
+    self.assertEqual((foods - foods.scale([1, 0, 1])).equals(NutrientVector.zeros(3)).tolist(), [True, False, True])
+    self.assertTrue((foods.sum() + NutrientVector.zeros()).equals(foods.sum()))
+
+    self.assertEqual(NutrientVector.from_objects([{'nf_calories': 1}, FoodItem(name='food',img_url='',nf_calories=2,nf_total_fat=0,nf_saturated_fat=0,nf_cholesterol=0,nf_sodium=0,nf_total_carbohydrate=0,nf_dietary_fiber=0,nf_sugars=0,nf_protein=0)]).sum().to_decimals()['nf_calories'], Decimal(3))
+    self.assertEqual(NutrientVector.from_rows([]).sum().to_decimals()['nf_sugars'], Decimal(0))
+    with self.assertRaises(ValueError):
+      NutrientVector([1, 2, 3])
@@ -1,5 +1,5 @@
-import unittest
-from nutritionix import search_item, get_common_nutrients, get_branded_nutrients, nutrient_categories
+import os, time, asyncio, tempfile, threading, unittest
+from nutritionix import search_item, get_common_nutrients, get_branded_nutrients, nutrient_categories, ResponseCache, NutritionixClient, AsyncNutritionixClient, SingleFlight, normalize_query
 
 class BasicsTestCase(unittest.TestCase):
 
@@ -36,4 +36,167 @@ class BasicsTestCase(unittest.TestCase):
 
     # returns data dict of common and branded foods
     self.assertTrue('common' in search_item('apple'))
-    self.assertTrue('branded' in search_item('apple'))
\ No newline at end of file
+    self.assertTrue('branded' in search_item('apple'))
+
+class ResponseCacheTestCase(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.TemporaryDirectory()
+    self.path = os.path.join(self.tmpdir.name,'cache.sqlite')
+
+  def tearDown(self):
+    self.tmpdir.cleanup()
+
+  def test_get_set(self):
+    cache = ResponseCache(path=self.path)
+    self.assertTrue(cache.get('common:apple') is None)
+    cache.set('common:apple',{'food_name':'apple','nf_calories':95})
+    self.assertEqual(cache.get('common:apple')['nf_calories'],95)
+    self.assertEqual(cache.stats()['hits'],1)
+    self.assertEqual(cache.stats()['misses'],1)
+
+    # returned values can be mutated without affecting the cache
+    cache.get('common:apple')['nf_calories'] = 0
+    self.assertEqual(cache.get('common:apple')['nf_calories'],95)
+
+  def test_disk_tier(self):
+    cache1 = ResponseCache(path=self.path)
+    cache1.set('branded:123',{'food_name':'Big Mac'})
+
+    # a new cache (e.g. after restart) reads from disk and promotes the entry to memory
+    cache2 = ResponseCache(path=self.path)
+    self.assertEqual(cache2.get('branded:123')['food_name'],'Big Mac')
+    self.assertEqual(cache2.stats()['disk_hits'],1)
+    self.assertEqual(cache2.get('branded:123')['food_name'],'Big Mac')
+    self.assertEqual(cache2.stats()['hits'],1)
+
+  def test_ttl(self):
+    cache = ResponseCache(path=self.path,ttl=0.05)
+    cache.set('common:apple',{'food_name':'apple'})
+    self.assertFalse(cache.get('common:apple') is None)
+    time.sleep(0.1)
+    self.assertTrue(cache.get('common:apple') is None)
+
+  def test_lru_eviction(self):
+    cache = ResponseCache(maxsize=2)
+    cache.set('a',1)
+    cache.set('b',2)
+    cache.get('a')
+    cache.set('c',3)
+    self.assertEqual(cache.get('a'),1)
+    self.assertTrue(cache.get('b') is None)
+    self.assertEqual(cache.get('c'),3)
+
+  def test_disk_eviction(self):
+    cache = ResponseCache(path=self.path,max_disk_entries=2)
+    for key in ['a','b','c']:
+      cache.set(key,key)
+    cache.prune()
+    cache = ResponseCache(path=self.path)
+    self.assertTrue(cache.get('a') is None)
+    self.assertEqual(cache.get('c'),'c')
+
+  def test_set_path(self):
+    # memory only until a disk tier is configured
+    cache = ResponseCache()
+    cache.set('common:apple',{'food_name':'apple'})
+    self.assertFalse(os.path.exists(self.path))
+    cache.set_path(self.path)
+    cache.set('common:pear',{'food_name':'pear'})
+    self.assertTrue(os.path.exists(self.path))
+    self.assertEqual(ResponseCache(path=self.path).get('common:pear')['food_name'],'pear')
+
+  def test_normalize_query(self):
+    self.assertEqual(normalize_query('  Big   MAC '),'big mac')
+
+class NutritionixClientTestCase(unittest.TestCase):
+  def test_session_configuration(self):
+    client = NutritionixClient(headers={'x-app-id':'id','x-app-key':'key'},pool_size=4,connect_timeout=1,read_timeout=2,retries=5)
+    self.assertEqual(client.session.headers['x-app-id'],'id')
+    self.assertEqual(client.timeout,(1,2))
+
+    adapter = client.session.get_adapter('https://trackapi.nutritionix.com')
+    self.assertEqual(adapter._pool_maxsize,4)
+    self.assertEqual(adapter.max_retries.total,5)
+    self.assertTrue(429 in adapter.max_retries.status_forcelist)
+    self.assertTrue(503 in adapter.max_retries.status_forcelist)
+    # read timeouts fail right away instead of waiting read_timeout again on every retry
+    self.assertEqual(adapter.max_retries.read,0)
+    client.close()
+
+  def test_cached_responses_skip_network(self):
+    cache = ResponseCache()
+    cache.set('common:big mac',{'food_name':'Big Mac'})
+    cache.set('branded:513fc9e73fe3ffd40300109f',{'food_name':'Big Mac'})
+    cache.set('search:big mac',{'common':[],'branded':[]})
+
+    client = NutritionixClient(cache=cache,retries=0)
+    self.assertEqual(client.get_common_nutrients('  Big Mac')['food_name'],'Big Mac')
+    self.assertEqual(client.get_branded_nutrients('513fc9e73fe3ffd40300109f')['food_name'],'Big Mac')
+    self.assertTrue('common' in client.search_item('BIG MAC'))
+    self.assertEqual(cache.stats()['hits'],3)
+
+class AsyncNutritionixClientTestCase(unittest.TestCase):
+  def test_gather_nutrients(self):
+    cache = ResponseCache()
+    cache.set('common:big mac',{'food_name':'big mac'})
+    cache.set('common:sushi',{'food_name':'sushi'})
+    cache.set('branded:513fc9e73fe3ffd40300109f',{'food_name':'Big Mac'})
+
+    async def run():
+      async with AsyncNutritionixClient(cache=cache) as client:
+        return await client.gather_nutrients([('common','sushi'),('branded','513fc9e73fe3ffd40300109f'),('common','Big Mac')],concurrency=2)
+
+    # results come back in the order requested, with branded refs routed to the branded endpoint
+    results = asyncio.run(run())
+    self.assertEqual([food['food_name'] for food in results],['sushi','Big Mac','big mac'])
+    self.assertEqual(cache.stats()['hits'],3)
+
+class SingleFlightTestCase(unittest.TestCase):
+  def run_concurrently(self, singleflight, key, fn, count=8):
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(singleflight.do(key,fn))) for i in range(count)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    return results
+
+  def test_concurrent_calls_are_coalesced(self):
+    singleflight = SingleFlight()
+    calls = []
+    def fn():
+      calls.append(1)
+      time.sleep(0.2)
+      return {'food_name':'big mac'}
+
+    results = self.run_concurrently(singleflight,'common:big mac',fn)
+    self.assertEqual(len(calls),1)
+    self.assertEqual(singleflight.shared,7)
+    self.assertTrue(all(result == {'food_name':'big mac'} for result in results))
+
+    # every caller gets its own copy of the result
+    self.assertEqual(len(set(id(result) for result in results)),8)
+
+    # finished flights are not reused
+    singleflight.do('common:big mac',fn)
+    self.assertEqual(len(calls),2)
+
+  def test_errors_propagate(self):
+    singleflight = SingleFlight()
+    with self.assertRaises(ValueError):
+      singleflight.do('common:big mac',lambda: int('not a number'))
+    self.assertEqual(singleflight.do('common:big mac',lambda: 1),1)
+
+  def test_lock_dir(self):
+    with tempfile.TemporaryDirectory() as lock_dir:
+      singleflight = SingleFlight(lock_dir=lock_dir)
+      self.assertEqual(singleflight.do('common:sushi',lambda: 'sushi'),'sushi')
+
+  def test_client_caches_flight_result(self):
+    cache = ResponseCache()
+    client = NutritionixClient(cache=cache,singleflight=SingleFlight())
+    def fn():
+      value = {'food_name':'sushi'}
+      return value, True
+    self.assertEqual(client._fetch('common:sushi',fn),{'food_name':'sushi'})
+    self.assertEqual(client._fetch('common:sushi',lambda: (None,False)),{'food_name':'sushi'})